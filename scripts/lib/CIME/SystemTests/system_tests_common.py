@@ -10,10 +10,11 @@ from CIME.case_st_archive import case_st_archive
 from CIME.test_status import *
 from CIME.check_lockedfiles import *
 from CIME.hist_utils import *
+from CIME.cpl_log import get_cpl_log_summary
 
 import CIME.build as build
 
-import shutil, glob, gzip, time, traceback
+import shutil, glob, time, traceback
 
 logger = logging.getLogger(__name__)
 
@@ -30,6 +31,7 @@ class SystemTestsCommon(object):
         self._caseroot = caseroot
         self._orig_caseroot = caseroot
         self._runstatus = None
+        self._use_build_cache = True
         self._casebaseid = self._case.get_value("CASEBASEID")
         self._test_status = TestStatus(test_dir=caseroot, test_name=self._casebaseid)
         self._init_environment(caseroot)
@@ -70,12 +72,13 @@ class SystemTestsCommon(object):
 
             case_setup(self._case, reset=True, test_mode=True)
 
-    def build(self, sharedlib_only=False, model_only=False):
+    def build(self, sharedlib_only=False, model_only=False, use_build_cache=True):
         """
         Do NOT override this method, this method is the framework that
         controls the build phase. build_phase is the extension point
         that subclasses should use.
         """
+        self._use_build_cache = use_build_cache
         success = True
         for phase_name, phase_bool in [(SHAREDLIB_BUILD_PHASE, not model_only),
                                        (MODEL_BUILD_PHASE, not sharedlib_only)]:
@@ -118,7 +121,8 @@ class SystemTestsCommon(object):
         Perform an individual build
         """
         build.case_build(self._caseroot, case=self._case,
-                         sharedlib_only=sharedlib_only, model_only=model_only)
+                         sharedlib_only=sharedlib_only, model_only=model_only,
+                         use_build_cache=self._use_build_cache)
 
     def clean_build(self, comps=None):
         if comps is None:
@@ -226,12 +230,21 @@ class SystemTestsCommon(object):
     def _coupler_log_indicates_run_complete(self):
         newestcpllogfile = self._get_latest_cpl_log()
         logger.debug("Latest Coupler log file is %s" % newestcpllogfile)
-        # Exception is raised if the file is not compressed
         try:
-            if "SUCCESSFUL TERMINATION" in gzip.open(newestcpllogfile, 'rb').read():
-                return True
-        except:
+            summary = get_cpl_log_summary(newestcpllogfile)
+        except (IOError, OSError) as e:
+            logger.info("Could not read %s, assuming run failed: %s" % (newestcpllogfile, e))
+            return False
+
+        # The log is only compressed if the run completed
+        if summary is None:
+            logger.info("No coupler log found, assuming run failed")
+        elif not summary.compressed:
             logger.info("%s is not compressed, assuming run failed"%newestcpllogfile)
+        elif not summary.complete:
+            logger.info("%s does not indicate SUCCESSFUL TERMINATION, assuming run failed"%newestcpllogfile)
+        else:
+            return True
         return False
 
     def _component_compare_copy(self, suffix):
@@ -255,31 +268,17 @@ class SystemTestsCommon(object):
         Examine memory usage as recorded in the cpl log file and look for unexpected
         increases.
         """
-        memlist = []
-        meminfo = re.compile(r".*model date =\s+(\w+).*memory =\s+(\d+\.?\d+).*highwater")
-        if cpllog is not None and os.path.isfile(cpllog):
-            with gzip.open(cpllog, "rb") as f:
-                for line in f:
-                    m = meminfo.match(line)
-                    if m:
-                        memlist.append((float(m.group(1)), float(m.group(2))))
-        # Remove the last mem record, it's sometimes artificially high
-        if len(memlist) > 0:
-            memlist.pop()
-        return memlist
+        summary = get_cpl_log_summary(cpllog)
+        # The last mem record is left out, it's sometimes artificially high
+        return [] if summary is None else summary.get_mem_usage()
 
     def _get_throughput(self, cpllog):
         """
         Examine memory usage as recorded in the cpl log file and look for unexpected
         increases.
         """
-        if cpllog is not None and os.path.isfile(cpllog):
-            with gzip.open(cpllog, "rb") as f:
-                cpltext = f.read()
-                m = re.search(r"# simulated years / cmp-day =\s+(\d+\.\d+)\s",cpltext)
-                if m:
-                    return float(m.group(1))
-        return None
+        summary = get_cpl_log_summary(cpllog)
+        return None if summary is None else summary.throughput
 
     def _check_for_memleak(self):
         """
@@ -16,7 +16,7 @@ class Compsets(GenericXML):
         if files is None:
             files = Files()
         schema = files.get_schema("COMPSETS_SPEC_FILE")
-        GenericXML.__init__(self, infile, schema=schema)
+        GenericXML.__init__(self, infile, schema=schema, use_index=True)
         self.groups={}
 
     def get_compset_match(self, name):
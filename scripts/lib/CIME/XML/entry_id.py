@@ -200,6 +200,7 @@ class EntryID(GenericXML):
         expect(subgroup is None, "Subgroup not supported")
         str_value = self.get_valid_value_string(node, value, vid, ignore_type)
         node.set("value", str_value)
+        self._change_count += 1
         return value
 
     def get_valid_value_string(self, node, value,vid=None,  ignore_type=False):
@@ -131,6 +131,8 @@ class EnvBatch(EnvBase):
 
             self.root.append(new_job_group)
 
+        self._change_count += 1
+
     def cleanupnode(self, node):
         if node.get("id") == "batch_system":
             fnode = node.find(".//file")
@@ -151,6 +153,7 @@ class EnvBatch(EnvBase):
             self.root.append(deepcopy(batchobj.batch_system_node))
         if batchobj.machine_node is not None:
             self.root.append(deepcopy(batchobj.machine_node))
+        self._change_count += 1
 
     def make_batch_script(self, input_template, job, case, total_tasks, tasks_per_node, num_nodes, thread_count):
         expect(os.path.exists(input_template), "input file '{}' does not exist".format(input_template))
@@ -10,14 +10,31 @@ import getpass
 
 logger = logging.getLogger(__name__)
 
+_PLAIN_TAG_RE = re.compile(r'^[\w-]+$')
+
+_REFERENCE_RE = re.compile(r'\${?(\w+)}?')
+_ENV_REF_RE   = re.compile(r'\$ENV\{(\w+)\}')
+_SHELL_REF_RE = re.compile(r'\$SHELL\{([^}]+)\}')
+_MATH_RE      = re.compile(r'\s[+-/*]\s')
+
 class GenericXML(object):
 
-    def __init__(self, infile=None, schema=None):
+    def __init__(self, infile=None, schema=None, use_index=False):
         """
         Initialize an object
+
+        If use_index is True an index of (tag, attribute, value) to nodes is
+        built after each read and attribute queries from the root of the tree
+        are answered from it. Only use it for files that are not modified
+        through direct ElementTree calls.
         """
         logger.debug("Initializing %s" , infile)
         self.tree = None
+        self._use_index = use_index
+        self._index = None
+        self._index_hits = 0
+        self._index_misses = 0
+        self._change_count = 0
 
         if infile == None:
             # if file is not defined just return
@@ -41,12 +58,15 @@ class GenericXML(object):
             self.root.set("id", os.path.basename(infile))
             self.root.set("version", "2.0")
             self.tree = ET.ElementTree(root)
+            if self._use_index:
+                self._build_index()
 
     def read(self, infile, schema=None):
         """
         Read and parse an xml file into the object
         """
         logger.debug("read: " + infile)
+        self._change_count += 1
         if self.tree:
             self.root.append(ET.parse(infile).getroot())
         else:
@@ -56,6 +76,9 @@ class GenericXML(object):
         if schema is not None and self.get_version() > 1.0:
             self.validate_xml_file(infile, schema)
 
+        if self._use_index:
+            self._build_index()
+
         logger.debug("File version is %s"%str(self.get_version()))
 
     def get_version(self):
@@ -74,14 +97,19 @@ class GenericXML(object):
 
         xmlstr = self.get_raw_record()
 
+        # Write to a temporary file and rename it so that processes reading
+        # outfile concurrently never see a partially written file
+        tmpfile = "%s.%d.tmp" % (outfile, os.getpid())
+
         # xmllint provides a better format option for the output file
         xmllint = find_executable("xmllint")
         if xmllint is not None:
-            run_cmd_no_fail("%s --format --output %s -"%(xmllint,outfile), input_str=xmlstr)
+            run_cmd_no_fail("%s --format --output %s -"%(xmllint,tmpfile), input_str=xmlstr)
         else:
             doc = minidom.parseString(xmlstr)
-            with open(outfile,'w') as xmlout:
+            with open(tmpfile,'w') as xmlout:
                 doc.writexml(xmlout,addindent='  ')
+        os.rename(tmpfile, outfile)
 
     def get_node(self, nodename, attributes=None, root=None, xpath=None):
         """
@@ -118,43 +146,119 @@ class GenericXML(object):
 
         expect(attributes is None or xpath is None,
                " Arguments attributes and xpath are exclusive")
-        if xpath is None:
-            xpath = ".//"+nodename
 
         if attributes:
-            # xml.etree has limited support for xpath and does not allow more than
-            # one attribute in an xpath query so we query seperately for each attribute
-            # and create a result with the intersection of those lists
-
+            # Only attributes with a value take part in the match, if there
+            # are none nothing matches
+            match_attributes = []
             for key, value in attributes.iteritems():
                 if value is not None:
                     expect(isinstance(value, basestring),
                            " Bad value passed for key %s"%key)
-                    xpath = ".//%s[@%s=\'%s\']" % (nodename, key, value)
-                    logger.debug("xpath is %s"%xpath)
-
-                    try:
-                        newnodes = root.findall(xpath)
-                    except Exception as e:
-                        expect(False, "Bad xpath search term '%s', error: %s" % (xpath, e))
-
-                    if not nodes:
-                        nodes = newnodes
-                    else:
-                        for node in nodes[:]:
-                            if node not in newnodes:
-                                nodes.remove(node)
-                    if not nodes:
-                        return []
+                    match_attributes.append((key, value))
+            if not match_attributes:
+                return []
+
+            if self._is_indexed(nodename, root):
+                nodes = self._get_indexed_nodes(nodename, match_attributes)
+            else:
+                # A single search with one predicate per attribute replaces
+                # the intersection of one search per attribute
+                self._index_misses += 1
+                xpath = ".//%s%s" % (nodename, "".join("[@%s=\'%s\']" % (key, value)
+                                                       for key, value in match_attributes))
+                logger.debug("xpath is %s"%xpath)
+                try:
+                    nodes = root.findall(xpath)
+                except Exception as e:
+                    expect(False, "Bad xpath search term '%s', error: %s" % (xpath, e))
+
+        elif xpath is None and self._is_indexed(nodename, root):
+            nodes = self._get_indexed_nodes(nodename, [])
 
         else:
+            if xpath is None:
+                xpath = ".//"+nodename
             logger.debug("xpath: %s" , xpath)
+            self._index_misses += 1
             nodes = root.findall(xpath)
 
         logger.debug("Returning %s nodes (%s)" , len(nodes), nodes)
 
         return nodes
 
+    def _build_index(self):
+        """
+        Build the lookup index for every node below self.root
+        """
+        self._index = {}
+        self._index_order = {}
+        self._index_order_dirty = False
+        for node in self.root.iter():
+            if node is not self.root:
+                self._index_node(node)
+
+    def _index_node(self, node):
+        """
+        Add node, but not its children, to the lookup index. The node is
+        given the last position in document order.
+        """
+        self._index.setdefault((node.tag, None, None), set()).add(node)
+        for key, value in node.attrib.iteritems():
+            self._index.setdefault((node.tag, key, value), set()).add(node)
+        self._index_order[node] = len(self._index_order)
+
+    def _is_indexed(self, nodename, root):
+        """
+        The index can answer searches by plain tag name from self.root
+        """
+        return self._index is not None and root is self.root and \
+            _PLAIN_TAG_RE.match(nodename) is not None
+
+    def _get_indexed_nodes(self, nodename, match_attributes):
+        """
+        Return, in document order, the nodes named nodename below self.root
+        that match all of the (key, value) pairs in match_attributes.
+        """
+        self._index_hits += 1
+        if match_attributes:
+            candidates = [self._index.get((nodename, key, value), set()) for key, value in match_attributes]
+        else:
+            candidates = [self._index.get((nodename, None, None), set())]
+        candidates.sort(key=len)
+        if not candidates[0]:
+            return []
+        matches = candidates[0].intersection(*candidates[1:])
+
+        # Guard against attributes changed after the node was indexed
+        matches = [node for node in matches
+                   if all(node.get(key) == value for key, value in match_attributes)]
+
+        if self._index_order_dirty:
+            self._index_order = dict((node, pos) for pos, node in enumerate(self.root.iter()))
+            self._index_order_dirty = False
+        matches.sort(key=self._index_order.get)
+        return matches
+
+    def get_index_stats(self):
+        """
+        Return a tuple (hits, misses) counting the get_nodes calls answered
+        from the lookup index and those that had to search the tree.
+
+        >>> obj = GenericXML(infile="/nonexistent/file.xml", use_index=True)
+        >>> node = ET.Element("entry", {"id":"A"})
+        >>> obj.add_child(node)
+        >>> obj.get_nodes("entry", {"id":"A"}) == [node]
+        True
+        >>> obj.get_nodes("entry", {"id":"B"})
+        []
+        >>> obj.get_nodes("value", root=node)
+        []
+        >>> obj.get_index_stats()
+        (2, 1)
+        """
+        return self._index_hits, self._index_misses
+
     def add_child(self, node, root=None):
         """
         Add element node to self at root
@@ -162,6 +266,12 @@ class GenericXML(object):
         if root is None:
             root = self.root
         self.root.append(node)
+        self._change_count += 1
+        if self._index is not None:
+            # node is now the last child of self.root so its subtree comes
+            # last in document order
+            for subnode in node.iter():
+                self._index_node(subnode)
 
     def get_value(self, item, attribute=None, resolved=True, subgroup=None): # pylint: disable=unused-argument
         """
@@ -178,8 +288,11 @@ class GenericXML(object):
     def set_value(self, vid, value, subgroup=None, ignore_type=True): # pylint: disable=unused-argument
         """
         ignore_type is not used in this flavor
+
+        Only node text changes here, which is not part of the lookup index.
         """
         valnodes = self.get_nodes(vid)
+        self._change_count += 1
         if valnodes:
             for node in valnodes:
                 node.text = value
@@ -203,10 +316,6 @@ class GenericXML(object):
         'hi'
         """
         logger.debug("raw_value %s" % raw_value)
-        reference_re = re.compile(r'\${?(\w+)}?')
-        env_ref_re   = re.compile(r'\$ENV\{(\w+)\}')
-        shell_ref_re = re.compile(r'\$SHELL\{([^}]+)\}')
-        math_re = re.compile(r'\s[+-/*]\s')
         item_data = raw_value
 
         if item_data is None:
@@ -215,18 +324,18 @@ class GenericXML(object):
         if type(item_data) is not str:
             return item_data
 
-        for m in env_ref_re.finditer(item_data):
+        for m in _ENV_REF_RE.finditer(item_data):
             logger.debug("look for %s in env" % item_data)
             env_var = m.groups()[0]
             expect(env_var in os.environ, "Undefined env var '%s'" % env_var)
             item_data = item_data.replace(m.group(), os.environ[env_var])
 
-        for s in shell_ref_re.finditer(item_data):
+        for s in _SHELL_REF_RE.finditer(item_data):
             logger.debug("execute %s in shell" % item_data)
             shell_cmd = s.groups()[0]
             item_data = item_data.replace(s.group(), run_cmd_no_fail(shell_cmd))
 
-        for m in reference_re.finditer(item_data):
+        for m in _REFERENCE_RE.finditer(item_data):
             var = m.groups()[0]
             logger.debug("find: %s" % var)
             ref = self.get_value(var)
@@ -242,7 +351,7 @@ class GenericXML(object):
             elif var == "USER":
                 item_data = item_data.replace(m.group(), getpass.getuser())
 
-        if math_re.search(item_data):
+        if _MATH_RE.search(item_data):
             try:
                 tmp = eval(item_data)
             except:
@@ -256,6 +365,12 @@ class GenericXML(object):
         subnode = ET.Element(subnode_name)
         subnode.text = subnode_text
         node.append(subnode)
+        self._change_count += 1
+        if self._index is not None:
+            # subnode is not last in document order unless node is, so
+            # positions are recomputed on the next indexed lookup
+            self._index_node(subnode)
+            self._index_order_dirty = True
         return node
 
     def validate_xml_file(self, filename, schema):
@@ -281,6 +396,7 @@ class GenericXML(object):
         element_node = self.get_optional_node(element_name, attributes, root, xpath)
         if element_node is not None:
             element_node.text = new_text
+            self._change_count += 1
             return new_text
         return None
 
@@ -294,6 +410,22 @@ class GenericXML(object):
             expect(False, "Could not write file %s, xml formatting error '%s'" % (self.filename, e))
         return xmlstr
 
+    def get_change_count(self):
+        """
+        Return a counter that increases whenever the content of this object
+        is changed through its methods, callers caching derived data can
+        compare it to detect changes.
+
+        >>> obj = GenericXML()
+        >>> obj.get_change_count()
+        0
+        >>> obj = GenericXML(infile="/nonexistent/file.xml")
+        >>> obj.add_child(ET.Element("entry", {"id":"A"}))
+        >>> obj.get_change_count()
+        1
+        """
+        return self._change_count
+
     def get_id(self):
         xmlid = self.root.get("id")
         if xmlid is not None:
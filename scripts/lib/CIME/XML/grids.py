@@ -19,7 +19,7 @@ class Grids(GenericXML):
         logger.debug(" Grid specification file is %s" % infile)
         schema = files.get_schema("GRIDS_SPEC_FILE")
 
-        GenericXML.__init__(self, infile, schema)
+        GenericXML.__init__(self, infile, schema, use_index=True)
         self._version = self.get_version()
 
         self._comp_gridnames = self._get_grid_names()
@@ -18,7 +18,7 @@ class Pes(GenericXML):
             files = Files()
         schema = files.get_schema("PES_SPEC_FILE")
         logger.debug("DEBUG: infile is %s"%infile)
-        GenericXML.__init__(self, infile, schema=schema)
+        GenericXML.__init__(self, infile, schema=schema, use_index=True)
 
     def find_pes_layout(self, grid, compset, machine, pesize_opts='M', mpilib=None):
         opes_ntasks = {}
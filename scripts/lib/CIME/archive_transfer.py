@@ -0,0 +1,184 @@
+"""
+File transfers for short term archiving.
+
+Moves are done with a rename whenever the source and the destination are on
+the same file system.  Copies on the same file system are made as reflinks
+(copy-on-write clones) where the file system supports them.  Hardlinks are
+deliberately not used for copies: the files that are copied to the archive
+stay in RUNDIR and may be reopened for writing by the model (e.g. history
+files that are still being filled), which would modify the archived file as
+well.  Everything else is copied with large buffers and verified with a
+checksum before a moved source file is removed.
+"""
+
+from CIME.XML.standard_module_setup import *
+
+import errno, fcntl, shutil, threading, time, zlib
+
+logger = logging.getLogger(__name__)
+
+_COPY_BUFSIZE = 16 * 1024 * 1024
+
+# linux ioctl that clones the extents of one file into another (btrfs, xfs, ...)
+_FICLONE = 0x40049409
+
+class TransferStats(object):
+    """
+    Thread safe summary of the transfers of an archiving pass
+
+    >>> stats = TransferStats()
+    >>> stats.record("rename", 3 * 1024 * 1024)
+    >>> stats.record("copy", 1024 * 1024, copied=True)
+    >>> stats.nfiles, stats.nbytes, stats.copied_bytes
+    (2, 4194304, 1048576)
+    >>> stats.get_methods()
+    'copy 1, rename 1'
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._methods = {}
+        self.nfiles = 0
+        self.nbytes = 0
+        self.copied_bytes = 0
+
+    def record(self, method, nbytes, copied=False):
+        with self._lock:
+            self._methods[method] = self._methods.get(method, 0) + 1
+            self.nfiles += 1
+            self.nbytes += nbytes
+            if copied:
+                self.copied_bytes += nbytes
+
+    def get_methods(self):
+        return ", ".join(["%s %d" % item for item in sorted(self._methods.items())])
+
+    def log_summary(self):
+        if self.nfiles == 0:
+            return
+        elapsed = max(time.time() - self._start, 1e-6)
+        megabytes = 1024.0 * 1024.0
+        logger.info("archived %d files, %.1f MB (%.1f MB copied) in %.2f seconds, %.1f MB/s (%s)" %
+                    (self.nfiles, self.nbytes / megabytes, self.copied_bytes / megabytes, elapsed,
+                     self.nbytes / megabytes / elapsed, self.get_methods()))
+
+###############################################################################
+def _file_checksum(path):
+###############################################################################
+    checksum = 0
+    with open(path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(_COPY_BUFSIZE), b""):
+            checksum = zlib.crc32(chunk, checksum)
+    return checksum & 0xffffffff
+
+###############################################################################
+def _same_filesystem(srcfile, destfile):
+###############################################################################
+    destdir = os.path.dirname(os.path.abspath(destfile))
+    return os.stat(srcfile).st_dev == os.stat(destdir).st_dev
+
+###############################################################################
+def _reflink(srcfile, destfile):
+###############################################################################
+    """
+    Try to clone srcfile into destfile, returns False if the file system
+    does not support it
+    """
+    try:
+        with open(srcfile, "rb") as fin:
+            with open(destfile, "wb") as fout:
+                fcntl.ioctl(fout.fileno(), _FICLONE, fin.fileno())
+        return True
+    except (IOError, OSError):
+        if os.path.isfile(destfile):
+            os.remove(destfile)
+        return False
+
+###############################################################################
+def _verified_copy(srcfile, destfile):
+###############################################################################
+    """
+    Copy the data of srcfile to destfile and compare checksums of both
+    """
+    sendfile = getattr(os, "sendfile", None)
+    with open(srcfile, "rb") as fin:
+        with open(destfile, "wb") as fout:
+            if sendfile is not None:
+                # data stays in the kernel, checksum the source separately
+                offset, size = 0, os.fstat(fin.fileno()).st_size
+                while offset < size:
+                    sent = sendfile(fout.fileno(), fin.fileno(), offset, min(_COPY_BUFSIZE, size - offset))
+                    if sent == 0:
+                        break
+                    offset += sent
+                checksum = None
+            else:
+                checksum = 0
+                for chunk in iter(lambda: fin.read(_COPY_BUFSIZE), b""):
+                    checksum = zlib.crc32(chunk, checksum)
+                    fout.write(chunk)
+                checksum &= 0xffffffff
+
+    if checksum is None:
+        checksum = _file_checksum(srcfile)
+    if _file_checksum(destfile) != checksum:
+        os.remove(destfile)
+        expect(False, "checksum mismatch copying %s to %s" % (srcfile, destfile))
+
+###############################################################################
+def copy_file(srcfile, destfile, stats=None):
+###############################################################################
+    """
+    Copy srcfile to destfile, like shutil.copy
+
+    >>> import tempfile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> with open(os.path.join(tmpdir, "a"), "w") as fd: fd.write("data")
+    >>> stats = TransferStats()
+    >>> copy_file(os.path.join(tmpdir, "a"), os.path.join(tmpdir, "b"), stats)
+    >>> move_file(os.path.join(tmpdir, "a"), os.path.join(tmpdir, "c"), stats)
+    >>> sorted(os.listdir(tmpdir)), open(os.path.join(tmpdir, "b")).read()
+    (['b', 'c'], 'data')
+    >>> stats.nfiles, stats.nbytes
+    (2, 8)
+    >>> shutil.rmtree(tmpdir)
+    """
+    if os.path.isdir(destfile):
+        destfile = os.path.join(destfile, os.path.basename(srcfile))
+    size = os.path.getsize(srcfile)
+
+    if _same_filesystem(srcfile, destfile) and _reflink(srcfile, destfile):
+        method = "reflink"
+    else:
+        _verified_copy(srcfile, destfile)
+        method = "copy"
+    shutil.copymode(srcfile, destfile)
+
+    if stats is not None:
+        stats.record(method, size, copied=(method == "copy"))
+
+###############################################################################
+def move_file(srcfile, destfile, stats=None):
+###############################################################################
+    """
+    Move srcfile to destfile, like shutil.move. The source is only removed
+    after a copy across file systems has been verified.
+    """
+    if os.path.isdir(destfile):
+        destfile = os.path.join(destfile, os.path.basename(srcfile))
+    size = os.path.getsize(srcfile)
+
+    try:
+        os.rename(srcfile, destfile)
+        method = "rename"
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        _verified_copy(srcfile, destfile)
+        shutil.copystat(srcfile, destfile)
+        os.remove(srcfile)
+        method = "copy"
+
+    if stats is not None:
+        stats.record(method, size, copied=(method == "copy"))
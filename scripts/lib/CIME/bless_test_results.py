@@ -1,11 +1,11 @@
 import CIME.compare_namelists, CIME.simple_compare
 from CIME.test_scheduler import NAMELIST_PHASE
-from CIME.utils import run_cmd, expect, get_scripts_root, get_model
+from CIME.utils import run_cmd, expect, get_scripts_root, get_model, run_in_pool, print_timing_summary
 from CIME.test_status import *
 from CIME.hist_utils import generate_baseline, compare_baseline
 from CIME.case import Case
 
-import os, glob, time
+import os, glob, time, sys
 
 ###############################################################################
 def bless_namelists(test_name, report_only, force, baseline_name, baseline_root):
@@ -54,74 +54,110 @@ def bless_history(test_name, testcase_dir_for_test, baseline_name, baseline_root
                 return True, None
 
 ###############################################################################
-def bless_test_results(baseline_name, baseline_root, test_root, compiler, test_id=None, namelists_only=False, hist_only=False, report_only=False, force=False, bless_tests=None, no_skip_pass=False):
+def _bless_test(test_dir, baseline_name, baseline_root, compiler, namelists_only, hist_only,
+                report_only, force, bless_tests, no_skip_pass):
 ###############################################################################
-    test_id_glob = "*%s*%s*" % (compiler, baseline_name) if test_id is None else "*%s" % test_id
-    test_status_files = glob.glob("%s/%s/%s" % (test_root, test_id_glob, TEST_STATUS_FILENAME))
-    expect(test_status_files, "No matching test cases found in for %s/%s/%s" % (test_root, test_id_glob, TEST_STATUS_FILENAME))
+    """
+    Bless the results of one test. Returns None if the test does not match
+    bless_tests, otherwise (test_name, broken_blesses) where broken_blesses is
+    a list of (test_name, reason)
+    """
+    ts = TestStatus(test_dir=test_dir)
+    test_name = ts.get_name()
+    if not (bless_tests in [[], None] or CIME.utils.match_any(test_name, bless_tests)):
+        return None
 
     broken_blesses = []
-    for test_status_file in test_status_files:
-        test_dir = os.path.dirname(test_status_file)
-        ts = TestStatus(test_dir=test_dir)
-        test_name = ts.get_name()
-        if (bless_tests in [[], None] or CIME.utils.match_any(test_name, bless_tests)):
-            overall_result = ts.get_overall_test_status()
-
-            # See if we need to bless namelist
-            if (not hist_only):
-                if no_skip_pass:
-                    nl_bless = True
-                else:
-                    nl_bless = ts.get_status(NAMELIST_PHASE) != TEST_PASS_STATUS
-            else:
-                nl_bless = False
-
-            # See if we need to bless baselines
-            if (not namelists_only):
-                run_result = ts.get_status(RUN_PHASE)
-                if (run_result is None):
-                    broken_blesses.append((test_name, "no run phase"))
-                    logging.warning("Test '%s' did not make it to run phase" % test_name)
-                    hist_bless = False
-                elif (run_result != TEST_PASS_STATUS):
-                    broken_blesses.append((test_name, "test did not pass"))
-                    logging.warning("Test '%s' did not pass, not safe to bless" % test_name)
-                    hist_bless = False
-                elif no_skip_pass:
-                    hist_bless = True
-                else:
-                    hist_bless = ts.get_status(BASELINE_PHASE) != TEST_PASS_STATUS
-            else:
-                hist_bless = False
+    overall_result = ts.get_overall_test_status()
+
+    # See if we need to bless namelist
+    if (not hist_only):
+        if no_skip_pass:
+            nl_bless = True
+        else:
+            nl_bless = ts.get_status(NAMELIST_PHASE) != TEST_PASS_STATUS
+    else:
+        nl_bless = False
+
+    # See if we need to bless baselines
+    if (not namelists_only):
+        run_result = ts.get_status(RUN_PHASE)
+        if (run_result is None):
+            broken_blesses.append((test_name, "no run phase"))
+            logging.warning("Test '%s' did not make it to run phase" % test_name)
+            hist_bless = False
+        elif (run_result != TEST_PASS_STATUS):
+            broken_blesses.append((test_name, "test did not pass"))
+            logging.warning("Test '%s' did not pass, not safe to bless" % test_name)
+            hist_bless = False
+        elif no_skip_pass:
+            hist_bless = True
+        else:
+            hist_bless = ts.get_status(BASELINE_PHASE) != TEST_PASS_STATUS
+    else:
+        hist_bless = False
 
-            # Now, do the bless
-            if not nl_bless and not hist_bless:
-                print "Nothing to bless for test:", test_name, " overall status:", overall_result
+    # Now, do the bless
+    if not nl_bless and not hist_bless:
+        print "Nothing to bless for test:", test_name, " overall status:", overall_result
+    else:
+
+        print "###############################################################################"
+        print "Blessing results for test:", test_name, "most recent result:", overall_result
+        print "###############################################################################"
+        if not force:
+            time.sleep(2)
+
+        # Bless namelists
+        if nl_bless:
+            success, reason = bless_namelists(test_name, report_only, force, baseline_name, baseline_root)
+            if not success:
+                broken_blesses.append((test_name, reason))
+
+        # Bless hist files
+        if hist_bless:
+            if "HOMME" in test_name:
+                success = False
+                reason = "HOMME tests cannot be blessed with bless_for_tests"
             else:
+                success, reason = bless_history(test_name, test_dir, baseline_name, baseline_root, compiler, report_only, force)
+
+            if (not success):
+                broken_blesses.append((test_name, reason))
 
-                print "###############################################################################"
-                print "Blessing results for test:", test_name, "most recent result:", overall_result
-                print "###############################################################################"
-                if not force:
-                    time.sleep(2)
-
-                # Bless namelists
-                if nl_bless:
-                    success, reason = bless_namelists(test_name, report_only, force, baseline_name, baseline_root)
-                    if not success:
-                        broken_blesses.append((test_name, reason))
-
-                # Bless hist files
-                if hist_bless:
-                    if "HOMME" in test_name:
-                        success = False
-                        reason = "HOMME tests cannot be blessed with bless_for_tests"
-                    else:
-                        success, reason = bless_history(test_name, test_dir, baseline_name, baseline_root, compiler, report_only, force)
-
-                    if (not success):
-                        broken_blesses.append((test_name, reason))
+    return test_name, broken_blesses
+
+###############################################################################
+def bless_test_results(baseline_name, baseline_root, test_root, compiler, test_id=None, namelists_only=False, hist_only=False, report_only=False, force=False, bless_tests=None, no_skip_pass=False, parallel=1, verbose=False):
+###############################################################################
+    """
+    Bless the results of all matching tests. Up to parallel tests are handled
+    at the same time, their output is still reported in test order. The time
+    spent on each test is reported if verbose is set or parallel is larger
+    than one. Blessing asks for confirmation unless
+    force or report_only is set, so parallel requires one of them.
+    """
+    test_id_glob = "*%s*%s*" % (compiler, baseline_name) if test_id is None else "*%s" % test_id
+    test_status_files = glob.glob("%s/%s/%s" % (test_root, test_id_glob, TEST_STATUS_FILENAME))
+    expect(test_status_files, "No matching test cases found in for %s/%s/%s" % (test_root, test_id_glob, TEST_STATUS_FILENAME))
+    expect(parallel <= 1 or force or report_only,
+           "Blessing tests in parallel requires --force or --report-only")
+
+    broken_blesses = []
+    start_time = time.time()
+    timings = []
+    args_list = [(os.path.dirname(test_status_file), baseline_name, baseline_root, compiler, namelists_only,
+                  hist_only, report_only, force, bless_tests, no_skip_pass)
+                 for test_status_file in test_status_files]
+    for result, output, elapsed in run_in_pool(_bless_test, args_list, parallel):
+        sys.stdout.write(output)
+        if result is not None:
+            test_name, test_broken_blesses = result
+            broken_blesses.extend(test_broken_blesses)
+            timings.append((test_name, elapsed))
+
+    if verbose or parallel > 1:
+        print_timing_summary(timings, start_time)
 
     # Make sure user knows that some tests were not blessed
     success = True
@@ -3,13 +3,29 @@ functions for building CIME models
 """
 from CIME.XML.standard_module_setup  import *
 from CIME.utils                 import get_model, analyze_build_log, stringify_bool, run_and_log_case_status
-from CIME.provenance            import save_build_provenance
+from CIME.provenance            import save_build_provenance, save_sharedlib_build_times
 from CIME.preview_namelists     import create_namelists, create_dirs
 from CIME.check_lockedfiles     import check_lockedfiles, lock_file, unlock_file
-import glob, shutil, time, threading, gzip, subprocess
+from CIME.build_cache           import BuildCache
+import glob, shutil, time, threading, gzip, subprocess, fcntl
 
 logger = logging.getLogger(__name__)
 
+# Make variables of the shared libraries in the case Makefile, whose rules
+# give the order in which the libraries have to be built
+_SHAREDLIB_MAKE_VARS = {
+    "MPISERIAL"   : "mpi-serial",
+    "GPTLLIB"     : "gptl",
+    "MCTLIBS"     : "mct",
+    "PIOLIB"      : "pio",
+    "CSMSHARELIB" : "csm_share",
+}
+# The case Makefile has no rule for gptl, but with mpi-serial the gptl
+# build includes the mpi.h of the mpi-serial build (src/share/timing/Makefile)
+_GPTL_DEPENDENCIES = ["mpi-serial"]
+_MAKE_RULE_RE = re.compile(r"^\$\((\w+)\)\s*:(?!=)(.*)$")
+_MAKE_VAR_RE = re.compile(r"\$\((\w+)\)")
+
 ###############################################################################
 def _build_model(build_threaded, exeroot, clm_config_opts, incroot, complist,
                  lid, caseroot, cimeroot, compiler):
@@ -111,6 +127,33 @@ def _build_model(build_threaded, exeroot, clm_config_opts, incroot, complist,
 
     return logs
 
+###############################################################################
+def _get_sharedpath(compiler, mpilib, debug, threaded):
+###############################################################################
+    """
+    Return the path, relative to SHAREDLIBROOT and EXEROOT, of the shared
+    libraries for this build configuration
+
+    >>> _get_sharedpath("intel", "mpt", True, False)
+    'intel/mpt/debug/nothreads'
+    """
+    debugdir = "debug" if debug else "nodebug"
+    threaddir = "threads" if threaded else "nothreads"
+    logger.debug("compiler=%s mpilib=%s debugdir=%s threaddir=%s"%
+                 (compiler,mpilib,debugdir,threaddir))
+    return os.path.join(compiler, mpilib, debugdir, threaddir)
+
+###############################################################################
+def get_sharedlib_dir(case):
+###############################################################################
+    """
+    Return the directory the shared libraries of this case are built in.
+    Cases returning the same directory can reuse each other's libraries.
+    """
+    sharedpath = _get_sharedpath(case.get_value("COMPILER"), case.get_value("MPILIB"),
+                                 case.get_value("DEBUG"), case.get_build_threaded())
+    return os.path.join(os.path.abspath(case.get_value("SHAREDLIBROOT")), sharedpath)
+
 ###############################################################################
 def _build_checks(case, build_threaded, comp_interface, use_esmf_lib,
                   debug, compiler, mpilib, complist, ninst_build, smp_value,
@@ -145,12 +188,7 @@ def _build_checks(case, build_threaded, comp_interface, use_esmf_lib,
     os.environ["NINST_VALUE"] = inststr
 
 
-    debugdir = "debug" if debug else "nodebug"
-    threaddir = "threads" if (os.environ["SMP"] == "TRUE" or build_threaded) else "nothreads"
-    sharedpath = os.path.join(compiler, mpilib, debugdir, threaddir)
-
-    logger.debug("compiler=%s mpilib=%s debugdir=%s threaddir=%s"%
-                 (compiler,mpilib,debugdir,threaddir))
+    sharedpath = _get_sharedpath(compiler, mpilib, debug, os.environ["SMP"] == "TRUE" or build_threaded)
 
     expect( ninst_build == ninst_value or ninst_build == "0",
             """
@@ -222,7 +260,8 @@ ERROR MPILIB is mpi-serial and USE_ESMF_LIB IS TRUE
     return sharedpath
 
 ###############################################################################
-def _build_libraries(case, exeroot, sharedpath, caseroot, cimeroot, libroot, lid, compiler):
+def _build_libraries(case, exeroot, sharedpath, caseroot, cimeroot, libroot, lid, compiler,
+                     use_build_cache=True):
 ###############################################################################
 
     shared_lib = os.path.join(exeroot, sharedpath, "lib")
@@ -236,7 +275,40 @@ def _build_libraries(case, exeroot, sharedpath, caseroot, cimeroot, libroot, lid
         libs.insert(0, mpilib)
     logs = []
     sharedlibroot = os.path.abspath(case.get_value("SHAREDLIBROOT"))
-    for lib in libs:
+
+    # Cases sharing SHAREDLIBROOT may build the same configuration at the
+    # same time, only one of them may build it while the others wait and
+    # then find the libraries up to date
+    lock_dir = os.path.join(sharedlibroot, sharedpath)
+    if not os.path.isdir(lock_dir):
+        os.makedirs(lock_dir)
+    with open(os.path.join(lock_dir, ".sharedlib_build.lock"), "w") as lock_fd:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        try:
+            installdir = os.path.join(exeroot, sharedpath)
+            build_cache = BuildCache() if use_build_cache else None
+            cache_key = None
+            if build_cache is not None and build_cache.is_enabled():
+                cache_key = build_cache.get_key(case, sharedpath,
+                                                include_clm=_builds_clm_sharedlib(case))
+
+            if cache_key is None or not build_cache.restore(cache_key, installdir, case):
+                _build_libraries_locked(case, exeroot, sharedpath, caseroot, cimeroot, libs,
+                                        sharedlibroot, lid, compiler, logs)
+                if cache_key is not None:
+                    build_cache.publish(cache_key, installdir, case)
+        finally:
+            fcntl.flock(lock_fd, fcntl.LOCK_UN)
+
+    return logs
+
+###############################################################################
+def _build_libraries_locked(case, exeroot, sharedpath, caseroot, cimeroot, libs,
+                            sharedlibroot, lid, compiler, logs):
+###############################################################################
+    build_times = {}
+
+    def build_lib(lib):
         if lib == "csm_share":
             # csm_share adds its own dir name
             full_lib_path = os.path.join(sharedlibroot, sharedpath)
@@ -254,47 +326,171 @@ def _build_libraries(case, exeroot, sharedpath, caseroot, cimeroot, libroot, lid
             my_file = "PYTHONPATH=%s:%s:$PYTHONPATH %s"%(os.path.join(cimeroot,"scripts","Tools"),
                                                           os.path.join(cimeroot,"scripts","lib"), my_file)
         logger.info("Building %s with output to file %s"%(lib,file_build))
+        t1 = time.time()
         stat = run_cmd("%s %s %s %s" %
                        (my_file, full_lib_path, os.path.join(exeroot,sharedpath), caseroot),
                        from_dir=exeroot, combine_output=True, arg_stdout=file_build)[0]
+        build_times[lib] = time.time() - t1
 
         analyze_build_log(lib, file_build, compiler)
-        expect(stat == 0, "ERROR: buildlib.%s failed, cat %s" % (lib, file_build))
         logs.append(file_build)
+        if stat != 0:
+            return "ERROR: buildlib.%s failed, cat %s" % (lib, file_build)
+
         if lib == "pio":
             bldlog = open(file_build, "r")
             for line in bldlog:
                 if re.search("Current setting for", line):
                     logger.warn(line)
 
+        logger.info("%s built in %f seconds" % (lib, build_times[lib]))
+        return None
+
+    # Every library runs make with GMAKE_J jobs, only start as many libraries
+    # at once as the build node has cores for
+    max_parallel = max(1, case.get_value("MAX_TASKS_PER_NODE") / case.get_value("GMAKE_J"))
+    errors = _build_in_dependency_order(libs, _get_sharedlib_dependencies(case, libs), max_parallel, build_lib)
+    save_sharedlib_build_times(case, build_times, lid=lid)
+    expect(not errors, "\n".join(errors))
 
     # clm not a shared lib for ACME
-    if get_model() != "acme":
-        comp_lnd = case.get_value("COMP_LND")
-        clm_config_opts = case.get_value("CLM_CONFIG_OPTS")
-        if comp_lnd == "clm" and not "clm4_0" in clm_config_opts:
-            logging.info("         - Building clm4_5/clm5_0 Library ")
-            esmfdir = "esmf" if case.get_value("USE_ESMF_LIB") else "noesmf"
-            bldroot = os.path.join(sharedlibroot, sharedpath, case.get_value("COMP_INTERFACE"), esmfdir, "clm","obj" )
-            libroot = os.path.join(exeroot, sharedpath, case.get_value("COMP_INTERFACE"), esmfdir, "lib")
-            incroot = os.path.join(exeroot, sharedpath, case.get_value("COMP_INTERFACE"), esmfdir, "include")
-            file_build = os.path.join(exeroot, "lnd.bldlog.%s" %  lid)
-            config_lnd_dir = os.path.dirname(case.get_value("CONFIG_LND_FILE"))
-
-            for ndir in [bldroot, libroot, incroot]:
-                if (not os.path.isdir(ndir)):
-                    os.makedirs(ndir)
-
-            smp = "SMP" in os.environ and os.environ["SMP"] == "TRUE"
-            # thread_bad_results captures error output from thread (expected to be empty)
-            # logs is a list of log files to be compressed and added to the case logs/bld directory
-            thread_bad_results = []
-            _build_model_thread(config_lnd_dir, "lnd", caseroot, libroot, bldroot, incroot,
-                                file_build, thread_bad_results, smp, compiler)
-            logs.append(file_build)
-            expect(not thread_bad_results, "\n".join(thread_bad_results))
+    if _builds_clm_sharedlib(case):
+        logging.info("         - Building clm4_5/clm5_0 Library ")
+        esmfdir = "esmf" if case.get_value("USE_ESMF_LIB") else "noesmf"
+        bldroot = os.path.join(sharedlibroot, sharedpath, case.get_value("COMP_INTERFACE"), esmfdir, "clm","obj" )
+        libroot = os.path.join(exeroot, sharedpath, case.get_value("COMP_INTERFACE"), esmfdir, "lib")
+        incroot = os.path.join(exeroot, sharedpath, case.get_value("COMP_INTERFACE"), esmfdir, "include")
+        file_build = os.path.join(exeroot, "lnd.bldlog.%s" %  lid)
+        config_lnd_dir = os.path.dirname(case.get_value("CONFIG_LND_FILE"))
+
+        for ndir in [bldroot, libroot, incroot]:
+            if (not os.path.isdir(ndir)):
+                os.makedirs(ndir)
+
+        smp = "SMP" in os.environ and os.environ["SMP"] == "TRUE"
+        # thread_bad_results captures error output from thread (expected to be empty)
+        # logs is a list of log files to be compressed and added to the case logs/bld directory
+        thread_bad_results = []
+        _build_model_thread(config_lnd_dir, "lnd", caseroot, libroot, bldroot, incroot,
+                            file_build, thread_bad_results, smp, compiler)
+        logs.append(file_build)
+        expect(not thread_bad_results, "\n".join(thread_bad_results))
 
-    return logs
+###############################################################################
+def _builds_clm_sharedlib(case):
+###############################################################################
+    """
+    clm4_5/clm5_0 is built along with the shared libraries for cesm
+    """
+    if get_model() == "acme":
+        return False
+    clm_config_opts = case.get_value("CLM_CONFIG_OPTS")
+    return case.get_value("COMP_LND") == "clm" and not "clm4_0" in clm_config_opts
+
+###############################################################################
+def _parse_sharedlib_dependencies(lines):
+###############################################################################
+    """
+    Return a dict shared library -> shared libraries it depends on, from
+    the rules of the case Makefile
+
+    >>> deps = _parse_sharedlib_dependencies([
+    ...     "$(MCTLIBS)  : $(MPISERIAL)",
+    ...     "$(PIOLIB) : $(MPISERIAL) $(GPTLLIB)",
+    ...     "$(CSMSHARELIB):  $(MCTLIBS) $(PIOLIB) $(GPTLLIB)",
+    ...     "  $(OBJS):  $(CSMSHARELIB)",
+    ...     "$(EXEC_SE): $(OBJS) $(ULIBDEP) $(CSMSHARELIB) $(MCTLIBS) $(PIOLIB) $(GPTLLIB)"])
+    >>> sorted(deps.items())
+    [('csm_share', ['mct', 'pio', 'gptl']), ('mct', ['mpi-serial']), ('pio', ['mpi-serial', 'gptl'])]
+    """
+    dependencies = {}
+    for line in lines:
+        m = _MAKE_RULE_RE.match(line)
+        if m is None or m.group(1) not in _SHAREDLIB_MAKE_VARS:
+            continue
+        lib = _SHAREDLIB_MAKE_VARS[m.group(1)]
+        for var in _MAKE_VAR_RE.findall(m.group(2)):
+            if var in _SHAREDLIB_MAKE_VARS and _SHAREDLIB_MAKE_VARS[var] not in dependencies.get(lib, []):
+                dependencies.setdefault(lib, []).append(_SHAREDLIB_MAKE_VARS[var])
+    return dependencies
+
+###############################################################################
+def _get_sharedlib_dependencies(case, libs):
+###############################################################################
+    """
+    Return the dependencies of the shared libraries in libs as given by the
+    case Makefile. If the Makefile cannot be read each library depends on
+    all the libraries before it in libs, i.e. they are built one at a time.
+    """
+    makefile = os.path.join(case.get_value("CASETOOLS"), "Makefile")
+    try:
+        with open(makefile, "r") as fd:
+            dependencies = _parse_sharedlib_dependencies(fd)
+    except IOError:
+        dependencies = {}
+
+    if not dependencies:
+        logger.warning("No shared library rules found in %s, building the shared libraries serially" % makefile)
+        return dict([(lib, libs[:idx]) for idx, lib in enumerate(libs)])
+
+    dependencies.setdefault("gptl", []).extend(_GPTL_DEPENDENCIES)
+    return dependencies
+
+###############################################################################
+def _build_in_dependency_order(items, dependencies, max_parallel, build_item):
+###############################################################################
+    """
+    Call build_item for each of items in its own thread, with at most
+    max_parallel threads at once. An item is only started once all of
+    the items it depends on, that are in items, have finished. build_item
+    returns an error message or None. Once an item fails no new items are
+    started. Returns the list of error messages.
+
+    >>> done = []
+    >>> def build(item):
+    ...     done.append(item)
+    ...     return "fail %s" % item if item == "b" else None
+    >>> _build_in_dependency_order(["a", "b", "c"], {"c": ["a"]}, 2, build)
+    ['fail b']
+    >>> done.index("a") < done.index("c") if "c" in done else True
+    True
+    >>> del done[:]
+    >>> _build_in_dependency_order(["c", "b", "a"], {"c": ["a", "b"], "b": ["a"]}, 3, build)
+    ['fail b']
+    >>> done
+    ['a', 'b']
+    """
+    pending = list(items)
+    running = set()
+    finished = set()
+    errors = []
+    cond = threading.Condition()
+
+    def run_item(item):
+        try:
+            error = build_item(item)
+        except (SystemExit, Exception) as e:
+            error = "ERROR: building %s failed with exception '%s'" % (item, e)
+        with cond:
+            running.remove(item)
+            finished.add(item)
+            if error:
+                errors.append(error)
+            cond.notify()
+
+    with cond:
+        while running or (pending and not errors):
+            for item in list(pending):
+                if errors or len(running) >= max_parallel:
+                    break
+                if all(dep in finished or dep not in items for dep in dependencies.get(item, [])):
+                    pending.remove(item)
+                    running.add(item)
+                    threading.Thread(target=run_item, args=(item,)).start()
+            if running:
+                cond.wait()
+
+    return errors
 
 ###############################################################################
 def _build_model_thread(config_dir, compclass, caseroot, libroot, bldroot, incroot, file_build,
@@ -368,7 +564,7 @@ def _clean_impl(case, cleanlist, clean_all):
     case.flush()
 
 ###############################################################################
-def _case_build_impl(caseroot, case, sharedlib_only, model_only):
+def _case_build_impl(caseroot, case, sharedlib_only, model_only, use_build_cache):
 ###############################################################################
 
     t1 = time.time()
@@ -511,7 +707,7 @@ def _case_build_impl(caseroot, case, sharedlib_only, model_only):
 
     if not model_only:
         logs = _build_libraries(case, exeroot, sharedpath, caseroot,
-                               cimeroot, libroot, lid, compiler)
+                               cimeroot, libroot, lid, compiler, use_build_cache=use_build_cache)
 
     if not sharedlib_only:
         os.environ["INSTALL_SHAREDPATH"] = os.path.join(exeroot, sharedpath) # for MPAS makefile generators
@@ -564,9 +760,9 @@ def post_build(case, logs):
     save_build_provenance(case, lid=lid)
 
 ###############################################################################
-def case_build(caseroot, case, sharedlib_only=False, model_only=False):
+def case_build(caseroot, case, sharedlib_only=False, model_only=False, use_build_cache=True):
 ###############################################################################
-    functor = lambda: _case_build_impl(caseroot, case, sharedlib_only, model_only)
+    functor = lambda: _case_build_impl(caseroot, case, sharedlib_only, model_only, use_build_cache)
     return run_and_log_case_status(functor, "case.build", caseroot=caseroot)
 
 ###############################################################################
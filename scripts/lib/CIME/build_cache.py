@@ -0,0 +1,351 @@
+"""
+Local cache of built shared libraries.
+
+The installed shared libraries of a case (EXEROOT/<sharedpath>) only depend
+on the build configuration, the machine setup and the source code, so cases
+with the same inputs can reuse a previous build instead of rebuilding mct,
+pio, gptl and csm_share from scratch.  Entries are keyed by a hash of those
+inputs and the cache is kept below a size limit by evicting the least
+recently used entries.
+
+The cache is off unless a cache location is set in the [main] section of
+~/.cime/config:
+    BUILD_CACHE_ROOT=/path/to/cache     (no default, the cache is disabled if unset)
+    BUILD_CACHE_MAX_SIZE=10240          (in MB, 0 disables the cache)
+"""
+
+from CIME.XML.standard_module_setup import *
+from CIME.utils import get_cime_config, get_model
+from CIME.XML.env_run import EnvRun
+
+import glob, hashlib, tarfile, shutil, tempfile
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_MAX_SIZE_MB = 10240
+
+_ARTIFACTS_FILE = "sharedlibs.tar"
+_METADATA_FILE = "metadata"
+
+# Case values that change what the shared library build produces
+_KEY_VARIABLES = ["MACH", "OS", "COMPILER", "MPILIB", "DEBUG",
+                  "COMP_INTERFACE", "USE_ESMF_LIB", "PIO_VERSION", "PIO_CONFIG_OPTS",
+                  "GMAKE", "NINST_VALUE", "NINST_ATM", "NINST_ICE", "NINST_GLC",
+                  "NINST_LND", "NINST_OCN", "NINST_ROF", "NINST_WAV", "NINST_ESP"]
+
+# Files in CASEROOT with the compiler and machine settings of the build,
+# the case copy of the machines Makefile in CASETOOLS is hashed as well
+_KEY_CASE_FILES = ["Macros.make", "env_mach_specific.xml"]
+_OPTIONAL_KEY_CASE_FILES = ["Macros.cmake"]
+
+# Additional values for cesm, where clm is built as part of the shared libraries
+_CLM_KEY_VARIABLES = ["COMP_LND", "CLM_CONFIG_OPTS", "CLM_USE_PETSC"]
+
+###############################################################################
+def _hash_file(hasher, path):
+###############################################################################
+    with open(path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(1 << 20), b""):
+            hasher.update(chunk)
+
+###############################################################################
+def _hash_directory(hasher, path):
+###############################################################################
+    """
+    Add the names and contents of all files below path to hasher
+    """
+    if not os.path.isdir(path):
+        return
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            filepath = os.path.join(dirpath, filename)
+            hasher.update(os.path.relpath(filepath, path))
+            _hash_file(hasher, filepath)
+
+###############################################################################
+def _hash_source_revision(hasher, srcdir):
+###############################################################################
+    """
+    Add the git revision of srcdir, including any local modifications, to
+    hasher. Returns False if the revision of srcdir cannot be determined.
+    """
+    stat, head, _ = run_cmd("git rev-parse HEAD", from_dir=srcdir)
+    if stat != 0:
+        return False
+    hasher.update(head)
+
+    stat, changed, _ = run_cmd("git ls-files --modified --others --exclude-standard", from_dir=srcdir)
+    if stat != 0:
+        return False
+    for relpath in sorted(set(changed.splitlines())):
+        hasher.update(relpath)
+        filepath = os.path.join(srcdir, relpath)
+        if os.path.isfile(filepath):
+            _hash_file(hasher, filepath)
+
+    return True
+
+###############################################################################
+def _select_evictions(entries, max_size):
+###############################################################################
+    """
+    Given a list of (last_used, size, name) for the cache entries, return the
+    names of the least recently used entries that have to be removed to bring
+    the total size down to max_size
+
+    >>> _select_evictions([(3, 10, "c"), (1, 10, "a"), (2, 10, "b")], 30)
+    []
+    >>> _select_evictions([(3, 10, "c"), (1, 10, "a"), (2, 10, "b")], 25)
+    ['a']
+    >>> _select_evictions([(3, 10, "c"), (1, 10, "a"), (2, 10, "b")], 10)
+    ['a', 'b']
+    >>> _select_evictions([(3, 10, "c"), (1, 10, "a")], 5)
+    ['a', 'c']
+    """
+    total_size = sum([size for _, size, _ in entries])
+    evictions = []
+    for _, size, name in sorted(entries):
+        if total_size <= max_size:
+            break
+        evictions.append(name)
+        total_size -= size
+
+    return evictions
+
+###############################################################################
+def _find_unsafe_member(members, installdir):
+###############################################################################
+    """
+    Return the name of the first of the TarInfo members that must not be
+    extracted into installdir, None if all are safe. Only regular files and
+    directories that stay below installdir are extracted, links could make
+    later members write anywhere.
+
+    >>> def member(name, type=tarfile.REGTYPE):
+    ...     info = tarfile.TarInfo(name)
+    ...     info.type = type
+    ...     return info
+    >>> _find_unsafe_member([member("lib", tarfile.DIRTYPE), member("lib/libpio.a")], "/install")
+    >>> _find_unsafe_member([member("lib/../../etc/passwd")], "/install")
+    'lib/../../etc/passwd'
+    >>> _find_unsafe_member([member("/etc/passwd")], "/install")
+    '/etc/passwd'
+    >>> _find_unsafe_member([member("lib/libpio.a", tarfile.SYMTYPE)], "/install")
+    'lib/libpio.a'
+    >>> _find_unsafe_member([member("lib/libpio.a", tarfile.LNKTYPE)], "/install")
+    'lib/libpio.a'
+    """
+    installdir = os.path.realpath(installdir)
+    for member in members:
+        path = os.path.realpath(os.path.join(installdir, member.name))
+        if not (member.isfile() or member.isdir()) or \
+                (path != installdir and not path.startswith(os.path.join(installdir, ""))):
+            return member.name
+
+    return None
+
+class BuildCache(object):
+
+    def __init__(self, cache_root=None, max_size=None):
+        """
+        Open the build cache at cache_root, holding at most max_size bytes.
+        Defaults are read from ~/.cime/config, the cache is disabled if no
+        cache_root is given or configured.
+        """
+        cime_config = get_cime_config()
+        if cache_root is None and cime_config.has_option("main", "BUILD_CACHE_ROOT"):
+            cache_root = os.path.expanduser(cime_config.get("main", "BUILD_CACHE_ROOT"))
+        if cache_root is None:
+            max_size = 0
+        elif max_size is None:
+            max_size_mb = _DEFAULT_MAX_SIZE_MB
+            if cime_config.has_option("main", "BUILD_CACHE_MAX_SIZE"):
+                max_size_mb = int(cime_config.get("main", "BUILD_CACHE_MAX_SIZE"))
+            max_size = max_size_mb * 1024 * 1024
+
+        self._cache_root = None if cache_root is None else os.path.abspath(cache_root)
+        self._max_size = max_size
+
+    def is_enabled(self):
+        return self._max_size > 0
+
+    def get_key(self, case, sharedpath, include_clm=False):
+        """
+        Return the cache key for the shared libraries of case, or None if the
+        build inputs cannot be fully determined (e.g. the source code is not
+        in a git repository)
+        """
+        caseroot = case.get_value("CASEROOT")
+        hasher = hashlib.sha1()
+        hasher.update(get_model())
+        # sharedpath also encodes whether the build is threaded
+        hasher.update(sharedpath)
+
+        key_variables = _KEY_VARIABLES + (_CLM_KEY_VARIABLES if include_clm else [])
+        for variable in key_variables:
+            hasher.update("%s=%s\n" % (variable, case.get_value(variable)))
+
+        case_files = [os.path.join(caseroot, case_file) for case_file in _KEY_CASE_FILES]
+        case_files.append(os.path.join(case.get_value("CASETOOLS"), "Makefile"))
+        for path in case_files:
+            if not os.path.isfile(path):
+                logger.debug("Not using build cache, %s does not exist" % path)
+                return None
+            hasher.update(os.path.basename(path))
+            _hash_file(hasher, path)
+
+        for case_file in _OPTIONAL_KEY_CASE_FILES:
+            path = os.path.join(caseroot, case_file)
+            if os.path.isfile(path):
+                hasher.update(case_file)
+                _hash_file(hasher, path)
+
+        # The buildlib scripts, hashed by content since they are not
+        # necessarily part of the source revision below
+        buildlib_scripts = glob.glob(os.path.join(case.get_value("CIMEROOT"), "src", "build_scripts", "buildlib.*"))
+        for path in sorted(buildlib_scripts):
+            hasher.update(os.path.basename(path))
+            _hash_file(hasher, path)
+
+        source_dirs = [os.path.join(case.get_value("CIMEROOT"), "src")]
+        source_mods = ["src.share"]
+        if include_clm:
+            config_lnd_dir = os.path.dirname(case.get_value("CONFIG_LND_FILE"))
+            source_dirs.append(os.path.dirname(config_lnd_dir))
+            source_mods.append("src.clm")
+
+        for source_dir in source_dirs:
+            if not _hash_source_revision(hasher, source_dir):
+                logger.debug("Not using build cache, cannot determine source revision of %s" % source_dir)
+                return None
+
+        for source_mod in source_mods:
+            hasher.update(source_mod)
+            _hash_directory(hasher, os.path.join(caseroot, "SourceMods", source_mod))
+
+        return hasher.hexdigest()
+
+    def restore(self, key, installdir, case):
+        """
+        Restore the shared libraries for key into installdir. Returns True
+        on a cache hit.
+        """
+        entry = os.path.join(self._cache_root, key)
+        try:
+            metadata = self._read_metadata(entry)
+            with tarfile.open(os.path.join(entry, _ARTIFACTS_FILE), "r") as tfd:
+                members = tfd.getmembers()
+                unsafe_member = _find_unsafe_member(members, installdir)
+                if unsafe_member is not None:
+                    logger.warning("Ignoring build cache entry %s, it contains the unsafe member %s" %
+                                   (entry, unsafe_member))
+                    raise tarfile.TarError("unsafe member %s" % unsafe_member)
+                tfd.extractall(installdir, members)
+            # Mark the entry as recently used
+            os.utime(os.path.join(entry, _METADATA_FILE), None)
+        except (IOError, OSError, tarfile.TarError):
+            logger.info("Build cache miss for key %s" % key)
+            return False
+
+        # The pio build updates the valid PIO_TYPENAME values of the case,
+        # do the same for the case reusing its libraries
+        if "PIO_TYPENAME" in metadata:
+            _set_pio_typename_valid_values(case, metadata["PIO_TYPENAME"])
+
+        logger.info("Build cache hit for key %s, restored shared libraries built by %s" %
+                    (key, metadata.get("CASEROOT")))
+        return True
+
+    def publish(self, key, installdir, case):
+        """
+        Store the shared libraries in installdir under key and evict old
+        entries if the cache grew above its size limit
+        """
+        if not os.path.isdir(self._cache_root):
+            os.makedirs(self._cache_root)
+
+        entry = os.path.join(self._cache_root, key)
+        if os.path.isdir(entry):
+            return
+
+        # Build the entry next to its final location and rename it into place,
+        # so that other builds never see a partially written entry
+        tmpentry = tempfile.mkdtemp(prefix=".%s." % key, dir=self._cache_root)
+        try:
+            # Links are not restored, store the files they point to
+            with tarfile.open(os.path.join(tmpentry, _ARTIFACTS_FILE), "w", dereference=True) as tfd:
+                for item in sorted(os.listdir(installdir)):
+                    tfd.add(os.path.join(installdir, item), arcname=item)
+
+            caseroot = case.get_value("CASEROOT")
+            pio_typename = EnvRun(caseroot).get_valid_values("PIO_TYPENAME")
+            with open(os.path.join(tmpentry, _METADATA_FILE), "w") as fd:
+                fd.write("CASEROOT %s\n" % caseroot)
+                if pio_typename is not None:
+                    fd.write("PIO_TYPENAME %s\n" % ",".join(pio_typename))
+
+            os.rename(tmpentry, entry)
+            logger.info("Published shared libraries to build cache with key %s" % key)
+        except (IOError, OSError, tarfile.TarError) as e:
+            # Another build may have published the same key first
+            logger.debug("Could not publish build cache entry %s: %s" % (key, e))
+        finally:
+            if os.path.isdir(tmpentry):
+                shutil.rmtree(tmpentry, ignore_errors=True)
+
+        self._evict()
+
+    def _read_metadata(self, entry):
+        metadata = {}
+        with open(os.path.join(entry, _METADATA_FILE), "r") as fd:
+            for line in fd:
+                name, _, value = line.rstrip("\n").partition(" ")
+                metadata[name] = value
+        return metadata
+
+    def _evict(self):
+        """
+        Remove least recently used entries until the cache fits in its size limit
+        """
+        entries = []
+        for key in os.listdir(self._cache_root):
+            entry = os.path.join(self._cache_root, key)
+            if key.startswith(".") or not os.path.isdir(entry):
+                continue
+            try:
+                last_used = os.path.getmtime(os.path.join(entry, _METADATA_FILE))
+                size = sum([os.path.getsize(os.path.join(entry, item)) for item in os.listdir(entry)])
+            except OSError:
+                continue
+            entries.append((last_used, size, key))
+
+        for key in _select_evictions(entries, self._max_size):
+            logger.info("Evicting build cache entry %s" % key)
+            # Rename first so concurrent restores never see a partial entry
+            entry = os.path.join(self._cache_root, key)
+            trash = tempfile.mkdtemp(prefix=".evict.", dir=self._cache_root)
+            try:
+                os.rename(entry, os.path.join(trash, key))
+            except OSError:
+                pass
+            shutil.rmtree(trash, ignore_errors=True)
+
+###############################################################################
+def _set_pio_typename_valid_values(case, valid_values):
+###############################################################################
+    """
+    Same update of the PIO_TYPENAME valid values that buildlib.pio does
+    after building pio
+    """
+    case.set_valid_values("PIO_TYPENAME", valid_values)
+    # nothing means use the general default
+    valid_values += ",nothing"
+
+    for comp in case.get_values("COMP_CLASSES"):
+        comp_pio_typename = "%s_PIO_TYPENAME" % comp
+        case.set_valid_values(comp_pio_typename, valid_values)
+        current_value = case.get_value(comp_pio_typename)
+        if current_value not in valid_values:
+            logger.warn("Resetting PIO_TYPENAME to netcdf for component %s" % comp)
+            case.set_value(comp_pio_typename, "netcdf")
@@ -5,7 +5,7 @@ All interaction with and between the module files in XML/ takes place
 through the Case module.
 """
 from copy import deepcopy
-import glob, os, shutil, math, string
+import glob, os, shutil, math, string, tempfile, cPickle
 from CIME.XML.standard_module_setup import *
 
 from CIME.utils                     import expect, get_cime_root, append_status
@@ -37,6 +37,124 @@ from CIME.aprun import get_aprun_cmd_for_case
 
 logger = logging.getLogger(__name__)
 
+_VALUE_REFERENCE_RE = re.compile(r'\${?(\w+)}?')
+
+# Marks a value missing from the value cache, None is a valid value
+_MISSING = object()
+
+# Pickled env file objects of a case, used by read_xml to avoid parsing the
+# env files again when none of them changed since the snapshot was written
+ENV_SNAPSHOT_FILE = ".env_snapshot.pkl"
+_ENV_SNAPSHOT_VERSION = 3
+_ENV_CLASSES = (EnvCase, EnvRun, EnvBuild, EnvMachPes, EnvBatch, EnvTest,
+                EnvMachSpecific, EnvArchive)
+
+# Values whose resolution does not only depend on the variables they
+# reference, see GenericXML.get_resolved_value
+_UNROUTABLE_VALUE_RE = re.compile(r'\$(ENV|SHELL)\{|\s[+-/*]\s|\${?(CIMEROOT|SRCROOT|USER)(?!\w)')
+
+# Attributes computed by initialize_derived_attributes
+_DERIVED_ATTRIBUTES = ("thread_count", "total_tasks", "tasks_per_node", "num_nodes",
+                       "spare_nodes", "tasks_per_numa", "cores_per_task")
+
+def _get_env_file_names(env_file):
+    """
+    Return the entry ids and element tags of env_file, the names it may
+    have a value for
+    """
+    names = set(node.get("id") for node in env_file.get_nodes("entry"))
+    names.update(node.tag for node in env_file.root.iter() if isinstance(node.tag, basestring))
+    names.discard(None)
+    return frozenset(names)
+
+def _get_env_file_stats(snapshot_key):
+    """
+    Return the size, modification time and inode of the env files recorded
+    in snapshot_key, keyed by file name
+
+    >>> _get_env_file_stats((3, "/case", [("env_case.xml", 10, 1.5, 7)], []))
+    {'env_case.xml': (10, 1.5, 7)}
+    >>> _get_env_file_stats(None)
+    {}
+    """
+    if snapshot_key is None:
+        return {}
+    return dict((basename, (size, mtime, ino)) for basename, size, mtime, ino in snapshot_key[2])
+
+def _get_lookup_names(item, components):
+    """
+    Return item and the names it can refer to as a component variable,
+    see EnvBase.check_if_comp_var
+
+    >>> sorted(_get_lookup_names("NTASKS_ATM", ["CPL", "ATM"]))
+    ['NTASKS', 'NTASKS_ATM']
+    >>> sorted(_get_lookup_names("ATM_NCPL", ["ATM"]))
+    ['ATM_NCPL', 'NCPL']
+    """
+    names = set([item])
+    for comp in components:
+        if "_" + comp in item:
+            names.add(item.replace("_" + comp, "", 1))
+        elif comp + "_" in item:
+            names.add(item.replace(comp + "_", "", 1))
+    return names
+
+class _LazyEnvFile(object):
+    """
+    Stand-in for an env file object of a case opened read-only. The object
+    is unpickled from the env snapshot the first time it is used, names
+    holds the entry ids and element tags of the file so that lookups can be
+    routed without loading it.
+    """
+
+    def __init__(self, filename, names, pickled):
+        self.__dict__.update(_filename=filename, names=names, _pickled=pickled, _env_file=None)
+
+    def get_env_file(self):
+        if self._env_file is None:
+            logger.debug("Loading %s from env snapshot" % self._filename)
+            self.__dict__["_env_file"] = cPickle.loads(self._pickled)
+            self.__dict__["_pickled"] = None
+        return self._env_file
+
+    def is_loaded(self):
+        return self._env_file is not None
+
+    def get_change_count(self):
+        return 0 if self._env_file is None else self._env_file.get_change_count()
+
+    @property
+    def filename(self):
+        return self._filename if self._env_file is None else self._env_file.filename
+
+    def __getattr__(self, name):
+        if name.startswith("__") or name in self.__dict__:
+            raise AttributeError(name)
+        return getattr(self.get_env_file(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.get_env_file(), name, value)
+
+    def __iter__(self):
+        return iter(self.get_env_file())
+
+def _derived_attribute(name):
+    """
+    Property for an attribute set by initialize_derived_attributes, which is
+    only called when one of them is first needed
+    """
+    def getter(self):
+        if self._derived_attributes_pending:
+            self._derived_attributes_pending = False
+            if self.get_value("CASEROOT") is not None:
+                self.initialize_derived_attributes()
+        return self._derived_attributes[name]
+
+    def setter(self, value):
+        self._derived_attributes[name] = value
+
+    return property(getter, setter)
+
 class Case(object):
     """
     https://github.com/ESMCI/cime/wiki/Developers-Introduction
@@ -62,7 +180,18 @@ class Case(object):
     the case object creates and manipulates the Case env classes
     by reading and interpreting the CIME config classes.
 
+    A case opened read-only loads its env files on demand from the env
+    snapshot, the derived attributes are computed when first used.
+
     """
+    thread_count = _derived_attribute("thread_count")
+    total_tasks = _derived_attribute("total_tasks")
+    tasks_per_node = _derived_attribute("tasks_per_node")
+    num_nodes = _derived_attribute("num_nodes")
+    spare_nodes = _derived_attribute("spare_nodes")
+    tasks_per_numa = _derived_attribute("tasks_per_numa")
+    cores_per_task = _derived_attribute("cores_per_task")
+
     def __init__(self, case_root=None, read_only=True):
 
         if case_root is None:
@@ -77,6 +206,18 @@ class Case(object):
         self._env_entryid_files = []
         self._env_generic_files = []
         self._files = []
+        # COMP_CLASSES from the env snapshot, used to route lookups to
+        # lazily loaded env files
+        self._lazy_components = None
+        # Size, modification time and inode of every env file when the env
+        # file objects were loaded, keyed by file name
+        self._env_file_stats = {}
+
+        # The change counts of the env files and the resolved values keyed by
+        # the arguments of the lookup, replaced as a whole when they change
+        self._value_cache = (None, {})
+        self._value_cache_hits = 0
+        self._value_cache_misses = 0
 
         self.read_xml()
 
@@ -100,16 +241,10 @@ class Case(object):
         self._is_env_loaded = False
         # these are user_mods as defined in the compset
         # Command Line user_mods are handled seperately
-        self.thread_count = None
-        self.total_tasks = None
-        self.tasks_per_node = None
-        self.num_nodes = None
-        self.spare_nodes = None
-        self.tasks_per_numa = None
-        self.cores_per_task = None
-        # check if case has been configured and if so initialize derived
-        if self.get_value("CASEROOT") is not None:
-            self.initialize_derived_attributes()
+        # Derived attributes are initialized on first use if the case has
+        # been configured
+        self._derived_attributes = dict.fromkeys(_DERIVED_ATTRIBUTES)
+        self._derived_attributes_pending = True
 
     def check_if_comp_var(self, vid):
         vid = vid
@@ -126,6 +261,7 @@ class Case(object):
         These are derived variables which can be used in the config_* files
         for variable substitution using the {{ var }} syntax
         """
+        self._derived_attributes_pending = False
         env_mach_pes  = self.get_env("mach_pes")
         env_mach_spec = self.get_env('mach_specific')
         comp_classes  = self.get_values("COMP_CLASSES")
@@ -183,6 +319,14 @@ class Case(object):
                 files += " "+env_file.filename
             expect(False,"Object(s) %s seem to have newer data than the corresponding case file"%files)
 
+        snapshot_key = self._get_env_snapshot_key()
+        self._env_file_stats = _get_env_file_stats(snapshot_key)
+        if self._read_env_snapshot(snapshot_key):
+            self._files = self._env_entryid_files + self._env_generic_files
+            self._clear_value_cache()
+            return
+
+        self._lazy_components = None
         self._env_entryid_files = []
         self._env_entryid_files.append(EnvCase(self._caseroot, components=None))
         components = self._env_entryid_files[0].get_values("COMP_CLASSES")
@@ -196,11 +340,144 @@ class Case(object):
         self._env_generic_files.append(EnvMachSpecific(self._caseroot))
         self._env_generic_files.append(EnvArchive(self._caseroot))
         self._files = self._env_entryid_files + self._env_generic_files
+        self._clear_value_cache()
+        self._write_env_snapshot(snapshot_key)
+
+    def _get_env_snapshot_key(self):
+        """
+        Return the data a snapshot must have been written with to be valid:
+        the case root, the size, modification time and inode of every env
+        file and the modification times of the modules defining the env
+        classes. Returns None if the case has no env files yet.
+        """
+        caseroot = os.path.abspath(self._caseroot)
+        env_files = sorted(glob.glob(os.path.join(caseroot, "env_*.xml")))
+        if not os.path.join(caseroot, "env_case.xml") in env_files:
+            return None
+
+        env_file_stats = []
+        for env_file in env_files:
+            try:
+                stat = os.stat(env_file)
+            except OSError:
+                return None
+            env_file_stats.append((os.path.basename(env_file), stat.st_size, stat.st_mtime, stat.st_ino))
+
+        module_mtimes = []
+        for cls in set(base for env_class in _ENV_CLASSES for base in env_class.__mro__):
+            module_file = getattr(sys.modules[cls.__module__], "__file__", None)
+            if module_file is not None:
+                module_file = os.path.realpath(module_file)
+                if module_file.endswith((".pyc", ".pyo")):
+                    module_file = module_file[:-1]
+                module_mtimes.append((module_file, os.path.getmtime(module_file)))
+
+        return (_ENV_SNAPSHOT_VERSION, caseroot, env_file_stats, sorted(module_mtimes))
+
+    def _read_env_snapshot(self, snapshot_key):
+        """
+        Load the env file objects from the snapshot if it matches
+        snapshot_key, returns True on success. In read-only mode the objects
+        are only unpickled when first used.
+
+        The snapshot holds the key, an index with the COMP_CLASSES of the
+        case and the file name, kind and names of every env file, and the
+        list of pickled env file objects.
+        """
+        snapshot_file = os.path.join(self._caseroot, ENV_SNAPSHOT_FILE)
+        if snapshot_key is None or not os.path.isfile(snapshot_file):
+            return False
+
+        try:
+            with open(snapshot_file, "rb") as fd:
+                if cPickle.load(fd) != snapshot_key:
+                    logger.debug("Env snapshot %s is out of date" % snapshot_file)
+                    return False
+                components, file_index = cPickle.load(fd)
+                pickled_files = cPickle.load(fd)
+
+            entryid_files, generic_files = [], []
+            for (basename, is_entryid, names), pickled in zip(file_index, pickled_files):
+                if self._force_read_only:
+                    env_file = _LazyEnvFile(os.path.join(self._caseroot, basename), names, pickled)
+                else:
+                    env_file = cPickle.loads(pickled)
+                (entryid_files if is_entryid else generic_files).append(env_file)
+        except Exception as e:
+            logger.debug("Could not read env snapshot %s: %s" % (snapshot_file, e))
+            return False
+
+        self._env_entryid_files, self._env_generic_files = entryid_files, generic_files
+        self._lazy_components = components if self._force_read_only else None
+        logger.debug("Read env files from snapshot %s" % snapshot_file)
+        return True
+
+    def _write_env_snapshot(self, snapshot_key):
+        """
+        Save the env file objects for later instances of Case. Only cases
+        opened for writing write the snapshot, queries never modify the case
+        directory. Failing to write the snapshot is not an error.
+        """
+        if snapshot_key is None or self._force_read_only or not os.access(self._caseroot, os.W_OK):
+            return
+
+        snapshot_file = os.path.join(self._caseroot, ENV_SNAPSHOT_FILE)
+        tmpfile = None
+        try:
+            components = self._env_entryid_files[0].get_values("COMP_CLASSES")
+            file_index, pickled_files = [], []
+            for env_file in self._env_entryid_files + self._env_generic_files:
+                file_index.append((os.path.basename(env_file.filename),
+                                   env_file in self._env_entryid_files,
+                                   _get_env_file_names(env_file)))
+                pickled_files.append(cPickle.dumps(env_file, cPickle.HIGHEST_PROTOCOL))
+
+            fd, tmpfile = tempfile.mkstemp(prefix=ENV_SNAPSHOT_FILE, dir=self._caseroot)
+            with os.fdopen(fd, "wb") as fd:
+                cPickle.dump(snapshot_key, fd, cPickle.HIGHEST_PROTOCOL)
+                cPickle.dump((components, file_index), fd, cPickle.HIGHEST_PROTOCOL)
+                cPickle.dump(pickled_files, fd, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmpfile, snapshot_file)
+        except Exception as e:
+            logger.debug("Could not write env snapshot %s: %s" % (snapshot_file, e))
+            if tmpfile is not None and os.path.exists(tmpfile):
+                os.remove(tmpfile)
 
     def get_case_root(self):
         """Returns the root directory for this case."""
         return self._caseroot
 
+    def _get_env_files_for(self, item, env_files=None):
+        """
+        Return the files of env_files (default the entry id files) that may
+        have a value for item, in lookup order. Env files that are not loaded
+        yet are skipped unless they have an entry or element named like item.
+        """
+        if env_files is None:
+            env_files = self._env_entryid_files
+        if self._lazy_components is None:
+            return env_files
+
+        return self._filter_lazy_files(env_files, _get_lookup_names(item, self._lazy_components))
+
+    def _get_resolving_files(self, item):
+        """
+        Return the entry id files that may change item in
+        get_resolved_value, in lookup order
+        """
+        if self._lazy_components is None or _UNROUTABLE_VALUE_RE.search(item):
+            return self._env_entryid_files
+
+        names = set()
+        for var in _VALUE_REFERENCE_RE.findall(item):
+            names.update(_get_lookup_names(var, self._lazy_components))
+        return self._filter_lazy_files(self._env_entryid_files, names)
+
+    def _filter_lazy_files(self, env_files, names):
+        return [env_file for env_file in env_files
+                if not isinstance(env_file, _LazyEnvFile) or env_file.is_loaded()
+                or not names.isdisjoint(env_file.names)]
+
     def get_env(self, short_name, allow_missing=False):
         full_name = "env_%s.xml" % (short_name)
         for env_file in self._files:
@@ -237,11 +514,36 @@ class Case(object):
                 self.schedule_rewrite(env_file)
         for env_file in self._env_files_that_need_rewrite:
             env_file.write()
+        if self._env_files_that_need_rewrite:
+            self._update_env_snapshot()
         self._env_files_that_need_rewrite = set()
 
+    def _update_env_snapshot(self):
+        """
+        Called after the env files that need a rewrite were written. The
+        objects only match the other env files if these did not change since
+        they were loaded, otherwise the snapshot is removed.
+        """
+        snapshot_key = self._get_env_snapshot_key()
+        env_file_stats = _get_env_file_stats(snapshot_key)
+        rewritten = set(os.path.basename(env_file.filename) for env_file in self._env_files_that_need_rewrite)
+        for basename in rewritten:
+            self._env_file_stats[basename] = env_file_stats.get(basename)
+
+        if snapshot_key is not None and env_file_stats == self._env_file_stats:
+            self._write_env_snapshot(snapshot_key)
+        else:
+            snapshot_file = os.path.join(self._caseroot, ENV_SNAPSHOT_FILE)
+            logger.debug("Env files changed on disk, removing env snapshot %s" % snapshot_file)
+            if os.path.isfile(snapshot_file):
+                try:
+                    os.remove(snapshot_file)
+                except OSError as e:
+                    logger.debug("Could not remove env snapshot %s: %s" % (snapshot_file, e))
+
     def get_values(self, item, attribute=None, resolved=True, subgroup=None):
         results = []
-        for env_file in self._env_entryid_files:
+        for env_file in self._get_env_files_for(item):
             # Wait and resolve in self rather than in env_file
             results = env_file.get_values(item, attribute, resolved=False, subgroup=subgroup)
             if len(results) > 0:
@@ -258,7 +560,7 @@ class Case(object):
                     new_results = results
                 return new_results
 
-        for env_file in self._env_generic_files:
+        for env_file in self._get_env_files_for(item, self._env_generic_files):
             results = env_file.get_values(item, attribute, resolved=False, subgroup=subgroup)
             if len(results) > 0:
                 if resolved:
@@ -274,8 +576,27 @@ class Case(object):
         return results
 
     def get_value(self, item, attribute=None, resolved=True, subgroup=None):
+        attribute_key = None if attribute is None else tuple(sorted(attribute.items()))
+        key = ("value", item, attribute_key, resolved, subgroup)
+        values = self._get_value_cache()
+        result = values.get(key, _MISSING)
+        if result is not _MISSING:
+            self._value_cache_hits += 1
+            return result
+
+        self._value_cache_misses += 1
+        result = self._get_value(item, attribute, resolved, subgroup)
+        if resolved:
+            raw_attribute = None if attribute is None else dict(attribute)
+            raw_value = self.get_value(item, raw_attribute, resolved=False, subgroup=subgroup)
+        else:
+            raw_value = None
+        self._cache_value(values, key, result, raw_value)
+        return result
+
+    def _get_value(self, item, attribute=None, resolved=True, subgroup=None):
         result = None
-        for env_file in self._env_entryid_files:
+        for env_file in self._get_env_files_for(item):
             # Wait and resolve in self rather than in env_file
             result = env_file.get_value(item, attribute, resolved=False, subgroup=subgroup)
 
@@ -287,7 +608,7 @@ class Case(object):
                         result = convert_to_type(result, vtype, item)
                 return result
 
-        for env_file in self._env_generic_files:
+        for env_file in self._get_env_files_for(item, self._env_generic_files):
 
             result = env_file.get_value(item, attribute, resolved=False, subgroup=subgroup)
 
@@ -344,7 +665,7 @@ class Case(object):
 
     def get_type_info(self, item):
         result = None
-        for env_file in self._env_entryid_files:
+        for env_file in self._get_env_files_for(item):
             result = env_file.get_type_info(item)
             if result is not None:
                 return result
@@ -352,18 +673,83 @@ class Case(object):
         return result
 
     def get_resolved_value(self, item, recurse=0):
+        if recurse > 0 or not item or "$" not in item:
+            return self._get_resolved_value(item, recurse)
+
+        key = ("resolved", item)
+        values = self._get_value_cache()
+        result = values.get(key, _MISSING)
+        if result is not _MISSING:
+            self._value_cache_hits += 1
+            return result
+
+        self._value_cache_misses += 1
+        result = self._get_resolved_value(item)
+        self._cache_value(values, key, result, item)
+        return result
+
+    def _get_resolved_value(self, item, recurse=0):
         num_unresolved = item.count("$") if item else 0
         recurse_limit = 10
         if (num_unresolved > 0 and recurse < recurse_limit ):
-            for env_file in self._env_entryid_files:
+            for env_file in self._get_resolving_files(item):
                 item = env_file.get_resolved_value(item)
             if ("$" not in item):
                 return item
             else:
-                item = self.get_resolved_value(item, recurse=recurse+1)
+                item = self._get_resolved_value(item, recurse=recurse+1)
 
         return item
 
+    def get_value_cache_stats(self):
+        """
+        Return a tuple (hits, misses) for the cache of get_value and
+        get_resolved_value results.
+        """
+        return self._value_cache_hits, self._value_cache_misses
+
+    def _get_change_counts(self):
+        return tuple(env_file.get_change_count() for env_file in self._files)
+
+    def _get_value_cache(self):
+        """
+        Return the dict of cached values for the current change counts of
+        the env files. A new dict replaces the cached values if an env file
+        was changed since they were cached, through Case.set_value or
+        directly through the env file. Lookups and stores use the returned
+        dict, so a value is never read from or stored in the cache of
+        another generation.
+        """
+        change_counts = self._get_change_counts()
+        value_cache = self._value_cache
+        if value_cache[0] != change_counts:
+            value_cache = (change_counts, {})
+            self._value_cache = value_cache
+        return value_cache[1]
+
+    def _clear_value_cache(self):
+        self._value_cache = (None, {})
+
+    def _cache_value(self, values, key, result, raw_value):
+        """
+        Store result under key in values, unless raw_value or, recursively, a variable
+        it references refers to the environment or the shell.
+        """
+        referenced = set()
+        pending = [raw_value]
+        while pending:
+            text = pending.pop()
+            if type(text) is not str or "$" not in text:
+                continue
+            if "$ENV{" in text or "$SHELL{" in text:
+                return
+            for name in _VALUE_REFERENCE_RE.findall(text):
+                if name not in referenced:
+                    referenced.add(name)
+                    pending.append(self.get_value(name, resolved=False))
+
+        values[key] = result
+
     def set_value(self, item, value, subgroup=None, ignore_type=False, allow_undefined=False):
         """
         If a file has been defined, and the variable is in the file,
@@ -374,11 +760,14 @@ class Case(object):
             self._caseroot = value
         result = None
 
-        for env_file in self._env_entryid_files:
+        for env_file in self._get_env_files_for(item):
             result = env_file.set_value(item, value, subgroup, ignore_type)
             if (result is not None):
                 logger.debug("Will rewrite file %s %s",env_file.filename, item)
                 self._env_files_that_need_rewrite.add(env_file)
+                # Values can depend on item without referencing it, e.g. a
+                # negative NTASKS is scaled by PES_PER_NODE in EnvMachPes
+                self._clear_value_cache()
                 return result
 
         expect(allow_undefined or result is not None,
@@ -389,11 +778,12 @@ class Case(object):
         Update or create a valid_values entry for item and populate it
         """
         result = None
-        for env_file in self._env_entryid_files:
+        for env_file in self._get_env_files_for(item):
             result = env_file.set_valid_values(item, valid_values)
             if (result is not None):
                 logger.debug("Will rewrite file %s %s",env_file.filename, item)
                 self._env_files_that_need_rewrite.add(env_file)
+                self._clear_value_cache()
                 return result
 
     def set_lookup_value(self, item, value):
@@ -1332,6 +1722,7 @@ class Case(object):
                     break
 
         self._files = self._env_entryid_files + self._env_generic_files
+        self._clear_value_cache()
 
     def update_env(self, new_object, env_file):
         """
@@ -1349,4 +1740,5 @@ class Case(object):
             self._env_files_that_need_rewrite.remove(old_object)
         self._files.remove(old_object)
         self._files.append(new_object)
+        self._clear_value_cache()
         self.schedule_rewrite(new_object)
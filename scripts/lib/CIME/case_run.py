@@ -5,7 +5,7 @@ from CIME.check_lockedfiles         import check_lockedfiles
 from CIME.get_timing                import get_timing
 from CIME.provenance                import save_prerun_provenance, save_postrun_provenance
 from CIME.preview_namelists         import create_namelists
-from CIME.case_st_archive           import case_st_archive, restore_from_archive
+from CIME.case_st_archive           import case_st_archive, restore_from_archive, IncrementalArchiver
 
 import shutil, time, sys, os, glob
 
@@ -102,7 +102,18 @@ def _run_model_impl(case, lid, skip_pnl=False):
 
     while loop:
         loop = False
-        stat = run_cmd(cmd, from_dir=rundir)[0]
+
+        # Archive closed history files while the model runs
+        archiver = None
+        if case.get_value("DOUT_S") and case.get_value("DOUT_S_INCREMENTAL"):
+            archiver = IncrementalArchiver(case)
+            archiver.start()
+        try:
+            stat = run_cmd(cmd, from_dir=rundir)[0]
+        finally:
+            if archiver is not None:
+                archiver.stop()
+
         model_logfile = os.path.join(rundir, model + ".log." + lid)
         # Determine if failure was due to a failed node, if so, try to restart
         if stat != 0:
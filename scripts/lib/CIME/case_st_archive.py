@@ -2,25 +2,186 @@
 short term archiving
 """
 
-import shutil, glob, re, os
+import shutil, glob, re, os, fnmatch, collections, threading
+from multiprocessing.dummy import Pool as ThreadPool
 
 from CIME.XML.standard_module_setup import *
 from CIME.case_submit               import submit
 from CIME.XML.env_archive           import EnvArchive
+from CIME.archive_transfer          import TransferStats, copy_file, move_file
 from CIME.utils                     import run_and_log_case_status
 from os.path                        import isdir, join
 
 logger = logging.getLogger(__name__)
 
+# Default number of files that are moved or copied at once
+DEFAULT_NUM_WORKERS = 4
+
+# Seconds between checks of the rpointer files by the incremental archiver
+INCREMENTAL_INTERVAL_SEC = 60
+
+###############################################################################
+def _glob_to_regex(pattern):
+###############################################################################
+    """
+    Regex matching the same file names as the glob pattern
+
+    >>> regex = re.compile(_glob_to_regex("case.cpl*.r*.nc"))
+    >>> [bool(regex.search(name)) for name in ("case.cpl.r.0001-01-02-00000.nc", "xcase.cpl.r.nc", "case.cpl.r.nc.base")]
+    [True, False, False]
+    """
+    return "^" + fnmatch.translate(pattern)
+
+class _RundirIndex(object):
+    """
+    In-memory listing of RUNDIR so that the directory is only read once per
+    archiving pass. Files are matched against all the archiving patterns in
+    a single pass over the listing, and files that the archiving plan moves
+    or removes are taken out of the index.
+
+    >>> index = _RundirIndex(files=["c.cam.r.0001.nc", "c.cam.h0.0001.nc", "c.clm2.h0.0001.nc"])
+    >>> index.classify([r"c\.cam", r"\.h0", r"\.r\."])
+    >>> index.match(r"c\.cam", r"\.h0")
+    ['c.cam.h0.0001.nc']
+    >>> index.match(r"\.h0")
+    ['c.cam.h0.0001.nc', 'c.clm2.h0.0001.nc']
+    >>> index.remove("c.cam.h0.0001.nc")
+    >>> index.match(r"\.h0")
+    ['c.clm2.h0.0001.nc']
+    >>> index.contains("c.cam.h0.0001.nc")
+    False
+    """
+
+    def __init__(self, rundir=None, files=None):
+        if files is None:
+            files = os.listdir(rundir)
+        self._files = set(files)
+        self._matches = {}
+
+    def classify(self, patterns):
+        """
+        Match every file against all of the (new) patterns in one pass
+        """
+        new_patterns = [(pattern, re.compile(pattern), set())
+                        for pattern in set(patterns) if pattern not in self._matches]
+        if not new_patterns:
+            return
+
+        for filename in self._files:
+            for _, regex, matches in new_patterns:
+                if regex.search(filename):
+                    matches.add(filename)
+
+        for pattern, _, matches in new_patterns:
+            self._matches[pattern] = matches
+
+    def match(self, *patterns):
+        """
+        Return the sorted names of the files matching all of patterns
+        """
+        self.classify(patterns)
+        result = self._files
+        for pattern in patterns:
+            result = result & self._matches[pattern]
+        return sorted(result)
+
+    def contains(self, filename):
+        return filename in self._files
+
+    def remove(self, filename):
+        self._files.discard(filename)
+
+class _ArchivePlan(object):
+    """
+    The ordered file operations of an archiving pass. Operations on the
+    same source file are run in the order they were added, operations on
+    different files may run concurrently.
+    """
+
+    def __init__(self):
+        self._dirs = []
+        self._ops = collections.OrderedDict()
+
+    def add_dir(self, dirpath):
+        if dirpath not in self._dirs and not os.path.exists(dirpath):
+            self._dirs.append(dirpath)
+
+    def _add(self, key, op):
+        if op not in self._ops.setdefault(key, []):
+            self._ops[key].append(op)
+
+    def copy(self, srcfile, destfile):
+        self._add(srcfile, ("copy", srcfile, destfile))
+
+    def move(self, srcfile, destfile):
+        self._add(srcfile, ("move", srcfile, destfile))
+
+    def remove(self, srcfile):
+        self._add(srcfile, ("remove", srcfile, None))
+
+    def write(self, destfile, contents):
+        self._add(destfile, ("write", destfile, contents))
+
+    def describe(self):
+        lines = ["mkdir %s" % dirpath for dirpath in self._dirs]
+        for ops in self._ops.values():
+            for op, path, arg in ops:
+                if op == "remove":
+                    lines.append("remove %s" % path)
+                elif op == "write":
+                    lines.append("write %s" % path)
+                else:
+                    lines.append("%s %s -> %s" % (op, path, arg))
+        return "\n".join(lines)
+
+    def execute(self, num_workers):
+        for dirpath in self._dirs:
+            if not os.path.exists(dirpath):
+                os.makedirs(dirpath)
+                logger.debug("created directory %s" % dirpath)
+
+        groups = self._ops.values()
+        if not groups:
+            return
+
+        stats = TransferStats()
+        pool = ThreadPool(max(1, min(num_workers, len(groups))))
+        try:
+            pool.map(lambda ops: _run_archive_ops(ops, stats), groups)
+        finally:
+            pool.close()
+            pool.join()
+        stats.log_summary()
+
 ###############################################################################
-def _get_datenames(case):
+def _run_archive_ops(ops, stats):
+###############################################################################
+    for op, path, arg in ops:
+        if op == "copy":
+            copy_file(path, arg, stats)
+            logger.info("copying \n%s to \n%s" % (path, arg))
+        elif op == "move":
+            move_file(path, arg, stats)
+            logger.info("moving \n%s to \n%s" % (path, arg))
+        elif op == "write":
+            logger.info("writing rpointer_file %s" % path)
+            with open(path, "w") as fd:
+                fd.write(arg)
+        else:
+            logger.info("removing interim restart file %s" % path)
+            try:
+                os.remove(path)
+            except OSError:
+                logger.warn("unable to remove interim restart file %s" % path)
+
+###############################################################################
+def _get_datenames(case, rundir_index):
 ###############################################################################
 
     logger.debug('In get_datename...')
     rundir = case.get_value('RUNDIR')
-    expect(isdir(rundir), 'Cannot open directory %s ' % rundir)
     casename = case.get_value("CASE")
-    files = sorted(glob.glob(os.path.join(rundir, casename + '.cpl*.r*.nc')))
+    files = rundir_index.match(_glob_to_regex(casename + '.cpl*.r*.nc'))
     if not files:
         expect(False, 'Cannot find a %s.cpl*.r.*.nc file in directory %s ' % (casename, rundir))
     datenames = []
@@ -52,7 +213,7 @@ def _get_ninst_info(case, compclass):
 
 ###############################################################################
 def _archive_rpointer_files(case, archive, archive_entry, archive_restdir,
-                            datename, datename_is_last):
+                            datename, datename_is_last, rundir_index, plan):
 ###############################################################################
 
     # archive the rpointer files associated with datename
@@ -63,9 +224,8 @@ def _archive_rpointer_files(case, archive, archive_entry, archive_restdir,
     if datename_is_last:
         # Copy of all rpointer files for latest restart date
         rundir = case.get_value("RUNDIR")
-        rpointers = glob.glob(os.path.join(rundir, 'rpointer.*'))
-        for rpointer in rpointers:
-            shutil.copy(rpointer, os.path.join(archive_restdir, os.path.basename(rpointer)))
+        for rpointer in rundir_index.match(_glob_to_regex('rpointer.*')):
+            plan.copy(os.path.join(rundir, rpointer), os.path.join(archive_restdir, rpointer))
     else:
         # Generate rpointer file(s) for interim restarts for the one datename and each
         # possible value of ninst_strings
@@ -94,54 +254,35 @@ def _archive_rpointer_files(case, archive, archive_entry, archive_restdir,
 
                     # write out the respect files with the correct contents
                     rpointer_file = os.path.join(archive_restdir, rpointer_file)
-                    logger.info("writing rpointer_file %s" % rpointer_file)
-                    f = open(rpointer_file, 'w')
-                    for output in rpointer_content.split(','):
-                        f.write("%s \n" %output)
-                    f.close()
+                    plan.write(rpointer_file,
+                               "".join(["%s \n" % output for output in rpointer_content.split(',')]))
 
 
 ###############################################################################
-def _archive_log_files(case):
+def _archive_log_files(case, rundir_index, plan):
 ###############################################################################
 
     dout_s_root = case.get_value("DOUT_S_ROOT")
     rundir = case.get_value("RUNDIR")
     archive_logdir = os.path.join(dout_s_root, 'logs')
-    if not os.path.exists(archive_logdir):
-        os.makedirs(archive_logdir)
-        logger.debug("created directory %s " %archive_logdir)
+    plan.add_dir(archive_logdir)
 
-    logfiles = glob.glob(os.path.join(rundir, '*.log.*'))
-    for logfile in logfiles:
-        srcfile = join(rundir, os.path.basename(logfile))
-        destfile = join(archive_logdir, os.path.basename(logfile))
-        shutil.move(srcfile, destfile)
-        logger.info("moving \n%s to \n%s" %(srcfile, destfile))
+    for logfile in rundir_index.match(_glob_to_regex('*.log.*')):
+        srcfile = join(rundir, logfile)
+        destfile = join(archive_logdir, logfile)
+        plan.move(srcfile, destfile)
+        rundir_index.remove(logfile)
 
 
 ###############################################################################
-def _archive_history_files(case, archive, archive_entry,
-                           compclass, compname, histfiles_savein_rundir):
+def _get_history_patterns(case, archive, archive_entry, compclass, compname):
 ###############################################################################
     """
-    perform short term archiving on history files in rundir
+    Return the regexes for the history files of archive_entry
     """
-
-    # determine history archive directory (create if it does not exist)
-    dout_s_root = case.get_value("DOUT_S_ROOT")
     casename = case.get_value("CASE")
-    archive_histdir = os.path.join(dout_s_root, compclass, 'hist')
-    if not os.path.exists(archive_histdir):
-        os.makedirs(archive_histdir)
-        logger.debug("created directory %s" %archive_histdir)
-
-    # determine ninst and ninst_string
     ninst, ninst_string = _get_ninst_info(case, compclass)
-
-    # archive history files - the only history files that kept in the
-    # run directory are those that are needed for restarts
-    rundir = case.get_value("RUNDIR")
+    patterns = []
     for suffix in archive.get_hist_file_extensions(archive_entry):
         for i in range(ninst):
             if compname == 'dart':
@@ -151,26 +292,43 @@ def _archive_history_files(case, archive, archive_entry,
                     newsuffix = casename + '.' + compname + ".*" + ninst_string[i] + suffix
                 else:
                     newsuffix = casename + '.' + compname + ".*" + suffix
-            logger.debug("short term archiving suffix is %s " %newsuffix)
-            pfile = re.compile(newsuffix)
-            histfiles = [f for f in os.listdir(rundir) if pfile.search(f)]
-            if histfiles:
-                logger.debug("hist files are %s " %histfiles)
-                for histfile in histfiles:
-                    srcfile = join(rundir, histfile)
-                    expect(os.path.isfile(srcfile),
-                           "history file %s does not exist " %srcfile)
-                    destfile = join(archive_histdir, histfile)
-                    if histfile in histfiles_savein_rundir:
-                        logger.info("copying \n%s to \n%s " %(srcfile, destfile))
-                        shutil.copy(srcfile, destfile)
-                    else:
-                        logger.info("moving \n%s to \n%s " %(srcfile, destfile))
-                        shutil.move(srcfile, destfile)
+            patterns.append(newsuffix)
+    return patterns
+
+###############################################################################
+def _archive_history_files(case, archive, archive_entry,
+                           compclass, compname, histfiles_savein_rundir,
+                           rundir_index, plan):
+###############################################################################
+    """
+    perform short term archiving on history files in rundir
+    """
+
+    # determine history archive directory (create if it does not exist)
+    dout_s_root = case.get_value("DOUT_S_ROOT")
+    archive_histdir = os.path.join(dout_s_root, compclass, 'hist')
+    plan.add_dir(archive_histdir)
+
+    # archive history files - the only history files that kept in the
+    # run directory are those that are needed for restarts
+    rundir = case.get_value("RUNDIR")
+    for newsuffix in _get_history_patterns(case, archive, archive_entry, compclass, compname):
+        logger.debug("short term archiving suffix is %s " %newsuffix)
+        histfiles = rundir_index.match(newsuffix)
+        if histfiles:
+            logger.debug("hist files are %s " %histfiles)
+            for histfile in histfiles:
+                srcfile = join(rundir, histfile)
+                destfile = join(archive_histdir, histfile)
+                if histfile in histfiles_savein_rundir:
+                    plan.copy(srcfile, destfile)
+                else:
+                    plan.move(srcfile, destfile)
+                    rundir_index.remove(histfile)
 
 
 ###############################################################################
-def get_histfiles_for_restarts(case, archive, archive_entry, restfile):
+def get_histfiles_for_restarts(case, archive, archive_entry, restfile, rundir_index=None):
 ###############################################################################
 
     # determine history files that are needed for restarts
@@ -195,145 +353,166 @@ def get_histfiles_for_restarts(case, archive, archive_entry, restfile):
                     histfile = matchobj.group(1).strip()
                     histfile = os.path.basename(histfile)
                     # append histfile to the list ONLY if it exists in rundir before the archiving
-                    if os.path.isfile(os.path.join(rundir,histfile)):
+                    if rundir_index is not None:
+                        exists = rundir_index.contains(histfile)
+                    else:
+                        exists = os.path.isfile(os.path.join(rundir,histfile))
+                    if exists:
                         histfiles.append(histfile)
     return histfiles
 
+###############################################################################
+def _get_restart_patterns(case, archive, archive_entry, compclass, compname, datename):
+###############################################################################
+    """
+    Return a list with the regexes that the restart files of archive_entry
+    for datename have to match, for each restart file extension and instance
+    """
+    casename = case.get_value("CASE")
+    ninst, ninst_strings = _get_ninst_info(case, compclass)
+    patterns = []
+    for suffix in archive.get_rest_file_extensions(archive_entry):
+        for i in range(ninst):
+            prefix_pattern = r"%s\.%s\d*.*" % (casename, compname)
+            if "dart" not in prefix_pattern:
+                if ninst_strings:
+                    patterns.append((prefix_pattern, ninst_strings[i] + suffix + datename))
+                else:
+                    patterns.append((prefix_pattern, suffix + datename))
+            else:
+                patterns.append((suffix,))
+    return patterns
+
 ###############################################################################
 def _archive_restarts(case, archive, archive_entry,
-                      compclass, compname, datename, datename_is_last):
+                      compclass, compname, datename, datename_is_last,
+                      rundir_index, plan):
 ###############################################################################
 
     # determine directory for archiving restarts based on datename
     dout_s_root = case.get_value("DOUT_S_ROOT")
     rundir = case.get_value("RUNDIR")
-    casename = case.get_value("CASE")
     archive_restdir = join(dout_s_root, 'rest', datename)
     if datename_is_last or case.get_value('DOUT_S_SAVE_INTERIM_RESTART_FILES') \
        or case.get_value("TEST"):
-        if not os.path.exists(archive_restdir):
-            os.makedirs(archive_restdir)
+        plan.add_dir(archive_restdir)
 
     # archive the rpointer file(s) for this datename and all possible ninst_strings
     _archive_rpointer_files(case, archive, archive_entry, archive_restdir,
-                            datename, datename_is_last)
-
-    # determine ninst and ninst_string
-    ninst, ninst_strings = _get_ninst_info(case, compclass)
+                            datename, datename_is_last, rundir_index, plan)
 
     # move all but latest restart files into the archive restart directory
     # copy latest restart files to archive restart directory
     histfiles_savein_rundir = []
 
-    # get file_extension suffixes
-    for suffix in archive.get_rest_file_extensions(archive_entry):
-        for i in range(ninst):
-            restfiles = ""
-            pattern = r"%s\.%s\d*.*" % (casename, compname)
-            if "dart" not in pattern:
-                pfile = re.compile(pattern)
-                files = [f for f in os.listdir(rundir) if pfile.search(f)]
-                if ninst_strings:
-                    pattern = ninst_strings[i] + suffix + datename
-                    pfile = re.compile(pattern)
-                    restfiles = [f for f in files if pfile.search(f)]
-                else:
-                    pattern = suffix + datename
-                    pfile = re.compile(pattern)
-                    restfiles = [f for f in files if pfile.search(f)]
-            else:
-                pattern = suffix
-                pfile = re.compile(pattern)
-                restfiles = [f for f in os.listdir(rundir) if pfile.search(f)]
+    for patterns in _get_restart_patterns(case, archive, archive_entry, compclass, compname, datename):
+        for restfile in rundir_index.match(*patterns):
 
-            for restfile in restfiles:
-                restfile = os.path.basename(restfile)
+            # obtain array of history files for restarts
+            # need to do this before archiving restart files
+            histfiles_for_restart = get_histfiles_for_restarts(case, archive,
+                                                               archive_entry, restfile,
+                                                               rundir_index=rundir_index)
 
-                # obtain array of history files for restarts
-                # need to do this before archiving restart files
-                histfiles_for_restart = get_histfiles_for_restarts(case, archive,
-                                                                   archive_entry, restfile)
+            if datename_is_last and histfiles_for_restart:
+                for histfile in histfiles_for_restart:
+                    if histfile not in histfiles_savein_rundir:
+                        histfiles_savein_rundir.append(histfile)
 
-                if datename_is_last and histfiles_for_restart:
-                    for histfile in histfiles_for_restart:
-                        if histfile not in histfiles_savein_rundir:
-                            histfiles_savein_rundir.append(histfile)
-
-                # archive restart files and all history files that are needed for restart
-                # Note that the latest file should be copied and not moved
-                if datename_is_last:
-                    srcfile = os.path.join(rundir, restfile)
+            # archive restart files and all history files that are needed for restart
+            # Note that the latest file should be copied and not moved
+            if datename_is_last:
+                srcfile = os.path.join(rundir, restfile)
+                destfile = os.path.join(archive_restdir, restfile)
+                plan.copy(srcfile, destfile)
+                for histfile in histfiles_for_restart:
+                    srcfile = os.path.join(rundir, histfile)
+                    destfile = os.path.join(archive_restdir, histfile)
+                    expect(rundir_index.contains(histfile),
+                           "restart file %s does not exist " %srcfile)
+                    plan.copy(srcfile, destfile)
+            else:
+                # Only archive intermediate restarts if requested - otherwise remove them
+                srcfile = os.path.join(rundir, restfile)
+                if case.get_value('DOUT_S_SAVE_INTERIM_RESTART_FILES'):
                     destfile = os.path.join(archive_restdir, restfile)
-                    shutil.copy(srcfile, destfile)
-                    logger.info("copying \n%s to \n%s" %(srcfile, destfile))
+                    plan.move(srcfile, destfile)
+                    rundir_index.remove(restfile)
+
+                    # need to copy the history files needed for interim restarts - since
+                    # have not archived all of the history files yet
                     for histfile in histfiles_for_restart:
                         srcfile = os.path.join(rundir, histfile)
                         destfile = os.path.join(archive_restdir, histfile)
-                        expect(os.path.isfile(srcfile),
-                               "restart file %s does not exist " %srcfile)
-                        shutil.copy(srcfile, destfile)
-                        logger.info("copying \n%s to \n%s" %(srcfile, destfile))
+                        expect(rundir_index.contains(histfile),
+                               "hist file %s does not exist " %srcfile)
+                        plan.copy(srcfile, destfile)
                 else:
-                    # Only archive intermediate restarts if requested - otherwise remove them
-                    if case.get_value('DOUT_S_SAVE_INTERIM_RESTART_FILES'):
-                        srcfile = os.path.join(rundir, restfile)
-                        destfile = os.path.join(archive_restdir, restfile)
-                        logger.info("moving \n%s to \n%s" %(srcfile, destfile))
-                        expect(os.path.isfile(srcfile),
-                               "restart file %s does not exist " %srcfile)
-                        shutil.move(srcfile, destfile)
-                        logger.info("moving \n%s to \n%s" %(srcfile, destfile))
-
-                        # need to copy the history files needed for interim restarts - since
-                        # have not archived all of the history files yet
-                        for histfile in histfiles_for_restart:
-                            srcfile = os.path.join(rundir, histfile)
-                            destfile = os.path.join(archive_restdir, histfile)
-                            expect(os.path.isfile(srcfile),
-                                   "hist file %s does not exist " %srcfile)
-                            shutil.copy(srcfile, destfile)
-                            logger.info("copying \n%s to \n%s" %(srcfile, destfile))
-                    else:
-                        srcfile = os.path.join(rundir, restfile)
-                        logger.info("removing interim restart file %s" %srcfile)
-                        if (os.path.isfile(srcfile)):
-                            try:
-                                os.remove(srcfile)
-                            except OSError:
-                                logger.warn("unable to remove interim restart file %s" %srcfile)
-                        else:
-                            logger.warn("interim restart file %s does not exist" %srcfile)
+                    plan.remove(srcfile)
+                    rundir_index.remove(restfile)
 
     return histfiles_savein_rundir
 
 ###############################################################################
-def _archive_process(case, archive):
+def _get_archive_entries(case, archive):
 ###############################################################################
     """
-    Parse config_archive.xml and perform short term archiving
+    Return (archive_entry, compname, compclass) for the components of the case
     """
-
-    logger.debug('In archive_process...')
     compset_comps = case.get_compset_components()
     compset_comps.append('cpl')
     compset_comps.append('dart')
 
-    # archive log files
-    _archive_log_files(case)
-
+    archive_entries = []
     for archive_entry in archive.get_entries():
         # determine compname and compclass
         compname, compclass = archive.get_entry_info(archive_entry)
 
         # check for validity of compname
-        if compname not in compset_comps:
-            continue
+        if compname in compset_comps:
+            archive_entries.append((archive_entry, compname, compclass))
+    return archive_entries
+
+###############################################################################
+def _archive_process(case, archive, dry_run=False, num_workers=DEFAULT_NUM_WORKERS):
+###############################################################################
+    """
+    Parse config_archive.xml and perform short term archiving
+
+    RUNDIR is listed once and all the files to archive are planned from that
+    listing before any of them is touched, the planned moves and copies are
+    then run by num_workers at once. With dry_run the plan is only logged.
+    """
+
+    logger.debug('In archive_process...')
+    rundir = case.get_value("RUNDIR")
+    expect(isdir(rundir), 'Cannot open directory %s ' % rundir)
+    rundir_index = _RundirIndex(rundir)
+    plan = _ArchivePlan()
+
+    # archive log files
+    _archive_log_files(case, rundir_index, plan)
+
+    archive_entries = _get_archive_entries(case, archive)
 
+    # Match the files against the patterns of all components at once
+    casename = case.get_value("CASE")
+    datenames = _get_datenames(case, rundir_index)
+    patterns = [_glob_to_regex('rpointer.*')]
+    for archive_entry, compname, compclass in archive_entries:
+        patterns.extend(_get_history_patterns(case, archive, archive_entry, compclass, compname))
+        for datename in datenames:
+            for restart_patterns in _get_restart_patterns(case, archive, archive_entry,
+                                                          compclass, compname, datename):
+                patterns.extend(restart_patterns)
+    rundir_index.classify(patterns)
+
+    for archive_entry, compname, compclass in archive_entries:
         # archive restarts and all necessary associated fields (e.g. rpointer files)
         logger.info('-------------------------------------------')
         logger.info('doing short term archiving for %s (%s)' % (compname, compclass))
         logger.info('-------------------------------------------')
-        datenames = _get_datenames(case)
+        datenames = _get_datenames(case, rundir_index)
         for datename in datenames:
             datename_is_last = False
             if datename == datenames[-1]:
@@ -342,14 +521,174 @@ def _archive_process(case, archive):
             # archive restarts
             histfiles_savein_rundir = _archive_restarts(case, archive, archive_entry,
                                                         compclass, compname,
-                                                        datename, datename_is_last)
+                                                        datename, datename_is_last,
+                                                        rundir_index, plan)
 
             # if the last datename for restart files, then archive history files
             # for this compname
             if datename_is_last:
                 logger.info("histfiles_savein_rundir %s " %histfiles_savein_rundir)
                 _archive_history_files(case, archive, archive_entry,
-                                       compclass, compname, histfiles_savein_rundir)
+                                       compclass, compname, histfiles_savein_rundir,
+                                       rundir_index, plan)
+
+    if dry_run:
+        logger.info("st_archive plan for case %s:\n%s" % (casename, plan.describe()))
+    else:
+        plan.execute(num_workers)
+
+###############################################################################
+def _split_histfile_date(histfile):
+###############################################################################
+    """
+    Split a history file name into its history stream and date, returns None
+    if the name does not end with a date
+
+    >>> _split_histfile_date("case.cam.h0.0001-01-02-00000.nc")
+    ('case.cam.h0', '0001-01-02-00000')
+    >>> _split_histfile_date("case.pop.h.0001-01.nc")
+    ('case.pop.h', '0001-01')
+    >>> _split_histfile_date("case.cam.h0.nc") is None
+    True
+    """
+    matchobj = re.match(r"(.*)\.(\d{4}-\d{2}(?:-\d{2}(?:-\d{5})?)?)\.nc$", histfile)
+    if matchobj is None:
+        return None
+    return matchobj.group(1), matchobj.group(2)
+
+###############################################################################
+def _get_closed_histfiles(histfiles):
+###############################################################################
+    """
+    Return the history files that are not the newest file of their history
+    stream, the model has finished writing those
+
+    >>> _get_closed_histfiles(["c.cam.h0.0001-01-03-00000.nc", "c.cam.h0.0001-01-02-00000.nc",
+    ...                        "c.cam.h1.0001-01-02-00000.nc", "c.cam.h0.nc"])
+    ['c.cam.h0.0001-01-02-00000.nc']
+    """
+    streams = {}
+    for histfile in histfiles:
+        split = _split_histfile_date(histfile)
+        if split is not None:
+            streams.setdefault(split[0], []).append((split[1], histfile))
+
+    closed = []
+    for dated_files in streams.values():
+        closed.extend([histfile for _, histfile in sorted(dated_files)[:-1]])
+    return sorted(closed)
+
+###############################################################################
+def _archive_closed_history_files(case, archive, rundir_index, plan):
+###############################################################################
+    """
+    Move the history files that are closed and not needed to restart from any
+    of the restart sets in RUNDIR to the archive. Interim restart sets are
+    archived with their history files by case_st_archive after the run.
+    """
+    casename = case.get_value("CASE")
+    cpl_restarts = rundir_index.match(_glob_to_regex(casename + '.cpl*.r*.nc'))
+    if not cpl_restarts:
+        return
+    datenames = _get_datenames(case, rundir_index)
+
+    archive_entries = _get_archive_entries(case, archive)
+    patterns = []
+    for archive_entry, compname, compclass in archive_entries:
+        patterns.extend(_get_history_patterns(case, archive, archive_entry, compclass, compname))
+        for datename in datenames:
+            for restart_patterns in _get_restart_patterns(case, archive, archive_entry,
+                                                          compclass, compname, datename):
+                patterns.extend(restart_patterns)
+    rundir_index.classify(patterns)
+
+    rundir = case.get_value("RUNDIR")
+    dout_s_root = case.get_value("DOUT_S_ROOT")
+    for archive_entry, compname, compclass in archive_entries:
+        histfiles_savein_rundir = set()
+        for datename in datenames:
+            for restart_patterns in _get_restart_patterns(case, archive, archive_entry,
+                                                          compclass, compname, datename):
+                for restfile in rundir_index.match(*restart_patterns):
+                    histfiles_savein_rundir.update(get_histfiles_for_restarts(case, archive, archive_entry,
+                                                                              restfile, rundir_index=rundir_index))
+
+        archive_histdir = os.path.join(dout_s_root, compclass, 'hist')
+        for pattern in _get_history_patterns(case, archive, archive_entry, compclass, compname):
+            for histfile in _get_closed_histfiles(rundir_index.match(pattern)):
+                if histfile not in histfiles_savein_rundir:
+                    plan.add_dir(archive_histdir)
+                    plan.move(join(rundir, histfile), join(archive_histdir, histfile))
+                    rundir_index.remove(histfile)
+
+class IncrementalArchiver(object):
+    """
+    Archives history files in the background while the model runs. Each time
+    the rpointer files in RUNDIR change, i.e. a new set of restart files has
+    been written, the history files that the model has closed since are moved
+    to DOUT_S_ROOT, except those that a restart set in RUNDIR still needs.
+    Everything else is left to case_st_archive after the run.
+    """
+
+    def __init__(self, case, interval=INCREMENTAL_INTERVAL_SEC, num_workers=DEFAULT_NUM_WORKERS):
+        caseroot = case.get_value("CASEROOT")
+        self._case = case
+        self._archive = EnvArchive(infile=os.path.join(caseroot, 'env_archive.xml'))
+        self._rundir = case.get_value("RUNDIR")
+        self._interval = interval
+        self._num_workers = num_workers
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._rpointer_signature = None
+
+    def _get_rpointer_signature(self):
+        signature = []
+        for filename in sorted(os.listdir(self._rundir)):
+            if filename.startswith("rpointer."):
+                try:
+                    stat = os.stat(os.path.join(self._rundir, filename))
+                except OSError:
+                    continue
+                signature.append((filename, stat.st_mtime, stat.st_size))
+        return signature
+
+    def archive_pass(self):
+        """
+        Archive the closed history files if the rpointer files advanced since
+        the last pass, returns True if a pass was done
+        """
+        signature = self._get_rpointer_signature()
+        if signature == self._rpointer_signature:
+            return False
+        self._rpointer_signature = signature
+
+        rundir_index = _RundirIndex(self._rundir)
+        plan = _ArchivePlan()
+        _archive_closed_history_files(self._case, self._archive, rundir_index, plan)
+        plan.execute(self._num_workers)
+        return True
+
+    def _run(self):
+        while not self._stop_event.wait(self._interval):
+            try:
+                self.archive_pass()
+            except (Exception, SystemExit) as e:
+                logger.warn("incremental short term archiving failed: %s" % e)
+
+    def start(self):
+        logger.info("starting incremental short term archiving of %s" % self._rundir)
+        # Only restart sets written during this run trigger archiving
+        self._rpointer_signature = self._get_rpointer_signature()
+        self._thread = threading.Thread(target=self._run, name="st_archive")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+            logger.info("stopped incremental short term archiving")
 
 ###############################################################################
 def restore_from_archive(case):
@@ -370,10 +709,13 @@ def restore_from_archive(case):
         shutil.copy(item, rundir)
 
 ###############################################################################
-def case_st_archive(case, no_resubmit=False):
+def case_st_archive(case, no_resubmit=False, dry_run=False, num_workers=DEFAULT_NUM_WORKERS):
 ###############################################################################
     """
     Create archive object and perform short term archiving
+
+    With dry_run the files that would be archived are only logged. num_workers
+    is the maximum number of files that are moved or copied at once.
     """
     caseroot = case.get_value("CASEROOT")
 
@@ -381,7 +723,7 @@ def case_st_archive(case, no_resubmit=False):
     if dout_s_root is None or dout_s_root == 'UNSET':
         expect(False,
                'XML variable DOUT_S_ROOT is required for short-term achiver')
-    if not isdir(dout_s_root):
+    if not isdir(dout_s_root) and not dry_run:
         os.makedirs(dout_s_root)
 
     dout_s_save_interim = case.get_value('DOUT_S_SAVE_INTERIM_RESTART_FILES')
@@ -395,7 +737,11 @@ def case_st_archive(case, no_resubmit=False):
     logger.info("st_archive starting")
 
     archive = EnvArchive(infile=os.path.join(caseroot, 'env_archive.xml'))
-    functor = lambda: _archive_process(case, archive)
+    if dry_run:
+        _archive_process(case, archive, dry_run=True)
+        return True
+
+    functor = lambda: _archive_process(case, archive, num_workers=num_workers)
     run_and_log_case_status(functor, "st_archive", caseroot=caseroot)
 
     logger.info("st_archive completed")
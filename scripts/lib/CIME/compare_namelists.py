@@ -1,9 +1,20 @@
-import os, re, logging
+import os, re, logging, hashlib, json, tempfile
 
 from collections import OrderedDict
-from CIME.utils  import expect
+from CIME.utils  import expect, get_cime_config
 logger=logging.getLogger(__name__)
 
+# Maximum total size (in bytes of namelist text) of the parsed namelists
+# that are kept in memory
+_CACHE_MAX_SIZE = 64 * 1024 * 1024
+
+# Directory, next to the baseline namelist files, that holds the on-disk cache
+_DISK_CACHE_DIRNAME = ".namelist_cache"
+
+# Version of the parse results in the disk cache, bump it whenever a change
+# to the namelist parsing changes what is returned for the same text
+_CACHE_VERSION = 1
+
 # pragma pylint: disable=unsubscriptable-object
 
 ###############################################################################
@@ -528,6 +539,151 @@ def _compare_namelists(gold_namelists, comp_namelists, case):
 
     return comments
 
+###############################################################################
+def _to_str(value):
+###############################################################################
+    """
+    Convert the unicode strings that json returns back to str
+
+    >>> _to_str(json.loads('{"nml": {"val": ["1", "2"]}}', object_pairs_hook=OrderedDict))
+    OrderedDict([('nml', OrderedDict([('val', ['1', '2'])]))])
+    """
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    elif isinstance(value, list):
+        return [_to_str(item) for item in value]
+    elif isinstance(value, OrderedDict):
+        return OrderedDict([(_to_str(key), _to_str(item)) for key, item in value.iteritems()])
+    else:
+        return value
+
+class _ParsedNamelistCache(object):
+    """
+    Cache of parsed namelist files, keyed by file path and content digest, so
+    that a baseline file shared by many comparisons of a process is only
+    parsed once. The
+    least recently used entries are evicted once the namelist text of all
+    entries exceeds max_size bytes.
+
+    Files that fail to parse are cached too, the same error is raised again
+    for them.
+
+    The cache is not shared between processes, e.g. the workers of
+    compare_test_results -j. With use_disk_cache, the parsed form is also
+    stored in a .namelist_cache directory next to the file so that other
+    processes can reuse it.
+
+    >>> cache = _ParsedNamelistCache(max_size=30)
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> nlfile = os.path.join(tmpdir, "drv_in")
+    >>> with open(nlfile, "w") as fd: fd.write("&nml\\n val = 1\\n/\\n")
+    >>> cache.get(nlfile)
+    OrderedDict([('nml', OrderedDict([('val', '1')]))])
+    >>> cache.get(nlfile) is cache.get(nlfile), cache.hits, cache.misses
+    (True, 2, 1)
+    >>> with open(nlfile, "w") as fd: fd.write("&nml\\n val = 2\\n/\\n")
+    >>> cache.get(nlfile)
+    OrderedDict([('nml', OrderedDict([('val', '2')]))])
+    >>> len(cache._entries)
+    1
+    >>> import shutil; shutil.rmtree(tmpdir)
+    """
+
+    def __init__(self, max_size=_CACHE_MAX_SIZE):
+        self._entries = OrderedDict()
+        self._size = 0
+        self._max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filename, use_disk_cache=False):
+        """
+        Return the parsed namelists of filename, the result must not be modified
+        """
+        with open(filename, "r") as fd:
+            text = fd.read()
+        digest = hashlib.sha1(text).hexdigest()
+        key = (os.path.abspath(filename), digest)
+
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            result = _read_disk_cache(filename, digest) if use_disk_cache else None
+            if result is None:
+                try:
+                    result = (True, _parse_namelists(text.split("\n"), filename))
+                except SystemExit as e:
+                    result = (False, str(e))
+                if use_disk_cache:
+                    _write_disk_cache(filename, digest, result)
+
+            entry = (len(text), result)
+            self._size += len(text)
+            while self._entries and self._size > self._max_size:
+                _, (size, _) = self._entries.popitem(last=False)
+                self._size -= size
+        else:
+            self.hits += 1
+
+        # Most recently used entries are at the end
+        self._entries[key] = entry
+        success, result = entry[1]
+        if not success:
+            raise SystemExit(result)
+        return result
+
+###############################################################################
+def _get_disk_cache_file(filename):
+###############################################################################
+    return os.path.join(os.path.dirname(os.path.abspath(filename)), _DISK_CACHE_DIRNAME,
+                        os.path.basename(filename) + ".json")
+
+###############################################################################
+def _read_disk_cache(filename, digest):
+###############################################################################
+    try:
+        with open(_get_disk_cache_file(filename), "r") as fd:
+            data = json.load(fd, object_pairs_hook=OrderedDict)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if not isinstance(data, dict) or data.get("version") != _CACHE_VERSION or data.get("digest") != digest:
+        return None
+    return bool(data["success"]), _to_str(data["result"])
+
+###############################################################################
+def _write_disk_cache(filename, digest, result):
+###############################################################################
+    """
+    Store result in the disk cache, silently skipped if the directory of
+    filename is not writable
+    """
+    cache_file = _get_disk_cache_file(filename)
+    try:
+        if not os.path.isdir(os.path.dirname(cache_file)):
+            os.makedirs(os.path.dirname(cache_file))
+        # Write to a temporary file and rename it so that concurrent readers
+        # never see a partial file
+        fd, tmpfile = tempfile.mkstemp(prefix=".", dir=os.path.dirname(cache_file))
+        with os.fdopen(fd, "w") as fd:
+            json.dump({"version" : _CACHE_VERSION, "digest" : digest, "success" : result[0], "result" : result[1]}, fd)
+        os.rename(tmpfile, cache_file)
+    except (IOError, OSError) as e:
+        logger.debug("Could not write namelist cache %s: %s" % (cache_file, e))
+
+_PARSED_NAMELISTS = _ParsedNamelistCache()
+
+###############################################################################
+def _use_disk_cache():
+###############################################################################
+    """
+    The disk cache for baseline namelists is enabled with
+    NAMELIST_DISK_CACHE=TRUE in the [main] section of ~/.cime/config
+    """
+    cime_config = get_cime_config()
+    return cime_config.has_option("main", "NAMELIST_DISK_CACHE") and \
+        cime_config.get("main", "NAMELIST_DISK_CACHE").upper() == "TRUE"
+
 ###############################################################################
 def compare_namelist_files(gold_file, compare_file, case=None):
 ###############################################################################
@@ -537,8 +693,8 @@ def compare_namelist_files(gold_file, compare_file, case=None):
     expect(os.path.exists(gold_file), "File not found: %s" % gold_file)
     expect(os.path.exists(compare_file), "File not found: %s" % compare_file)
 
-    gold_namelists = _parse_namelists(open(gold_file, "r").readlines(), gold_file)
-    comp_namelists = _parse_namelists(open(compare_file, "r").readlines(), compare_file)
+    gold_namelists = _PARSED_NAMELISTS.get(gold_file, use_disk_cache=_use_disk_cache())
+    comp_namelists = _PARSED_NAMELISTS.get(compare_file)
 
     comments = _compare_namelists(gold_namelists, comp_namelists, case)
     return comments == "", comments
@@ -547,7 +703,7 @@ def compare_namelist_files(gold_file, compare_file, case=None):
 def is_namelist_file(file_path):
 ###############################################################################
     try:
-        compare_namelist_files(file_path, file_path)
+        _PARSED_NAMELISTS.get(file_path)
     except SystemExit as e:
         assert "does not appear to be a namelist file" in str(e), str(e)
         return False
@@ -1,11 +1,11 @@
 import CIME.compare_namelists, CIME.simple_compare
-from CIME.utils import expect, get_model, append_status
+from CIME.utils import expect, get_model, append_status, run_in_pool, print_timing_summary
 from CIME.test_status import *
 from CIME.hist_utils import compare_baseline
 from CIME.case_cmpgen_namelists import case_cmpgen_namelists
 from CIME.case import Case
 
-import os, glob, logging
+import os, glob, logging, time, sys
 
 ###############################################################################
 def compare_namelists(case, baseline_name, baseline_root, logfile_name, compiler):
@@ -34,7 +34,102 @@ def compare_history(case, baseline_name, baseline_root, log_id, compiler):
     return result, comments
 
 ###############################################################################
-def compare_test_results(baseline_name, baseline_root, test_root, compiler, test_id=None, compare_tests=None, namelists_only=False, hist_only=False):
+def _compare_test(test_dir, baseline_name, baseline_root, compiler, compare_tests,
+                  namelists_only, hist_only, log_id, logfile_name):
+###############################################################################
+    """
+    Compare one test with its baselines. Returns None if the test does not
+    match compare_tests, (test_name, brief_result, pass_or_skip) otherwise.
+    """
+    ts = TestStatus(test_dir=test_dir)
+    test_name = ts.get_name()
+    if not (compare_tests in [[], None] or CIME.utils.match_any(test_name, compare_tests)):
+        return None
+
+    all_pass_or_skip = True
+    append_status(
+        "Comparing against baseline with compare_test_results:\n" +
+        "Baseline: %s\n"%(baseline_name) +
+        "In baseline_root: %s"%(baseline_root),
+        logfile_name,
+        caseroot=test_dir)
+
+    if (not hist_only):
+        nl_compare_result = None
+        nl_compare_comment = ""
+        nl_result = ts.get_status(SETUP_PHASE)
+        if (nl_result is None):
+            nl_compare_result = "SKIP"
+            nl_compare_comment = "Test did not make it to setup phase"
+            nl_do_compare = False
+        else:
+            nl_do_compare = True
+    else:
+        nl_do_compare = False
+
+    detailed_comments = ""
+    if (not namelists_only):
+        compare_result = None
+        compare_comment = ""
+        run_result = ts.get_status(RUN_PHASE)
+        if (run_result is None):
+            compare_result = "SKIP"
+            compare_comment = "Test did not make it to run phase"
+            do_compare = False
+        elif (run_result != TEST_PASS_STATUS):
+            compare_result = "SKIP"
+            compare_comment = "Run phase did not pass"
+            do_compare = False
+        else:
+            do_compare = True
+    else:
+        do_compare = False
+
+    if nl_do_compare or do_compare:
+        with Case(test_dir) as case:
+            if nl_do_compare:
+                nl_success = compare_namelists(case, baseline_name, baseline_root, logfile_name, compiler)
+                if nl_success:
+                    nl_compare_result = TEST_PASS_STATUS
+                    nl_compare_comment = ""
+                else:
+                    nl_compare_result = TEST_FAIL_STATUS
+                    nl_compare_comment = "See %s/%s" % (test_dir, logfile_name)
+                    all_pass_or_skip = False
+
+            if do_compare:
+                success, detailed_comments = compare_history(case, baseline_name, baseline_root, log_id, compiler)
+                if success:
+                    compare_result = TEST_PASS_STATUS
+                else:
+                    compare_result = TEST_FAIL_STATUS
+                    all_pass_or_skip = False
+
+                # Following the logic in SystemTestsCommon._compare_baseline:
+                # We'll print the comment if it's a brief one-liner; otherwise
+                # the comment will only appear in the log file
+                if "\n" not in detailed_comments:
+                    compare_comment = detailed_comments
+
+    brief_result = ""
+    if not hist_only:
+        brief_result += "%s %s %s %s\n" % (nl_compare_result, test_name, NAMELIST_PHASE, nl_compare_comment)
+
+    if not namelists_only:
+        brief_result += "%s %s %s" % (compare_result, test_name, BASELINE_PHASE)
+        if compare_comment:
+            brief_result += " %s" % compare_comment
+        brief_result += "\n"
+
+    append_status(brief_result, logfile_name, caseroot=test_dir)
+
+    if detailed_comments:
+        append_status("Detailed comments:\n" + detailed_comments, logfile_name, caseroot=test_dir)
+
+    return test_name, brief_result, all_pass_or_skip
+
+###############################################################################
+def compare_test_results(baseline_name, baseline_root, test_root, compiler, test_id=None, compare_tests=None, namelists_only=False, hist_only=False, parallel=1, verbose=False):
     """Compares with baselines for all matching tests
 
     Outputs results for each test to stdout (one line per test); possible status
@@ -44,7 +139,13 @@ def compare_test_results(baseline_name, baseline_root, test_root, compiler, test
 
     In addition, creates files named compare.log.BASELINE_NAME.TIMESTAMP in each
     test directory, which contain more detailed output. Also creates
-    *.cprnc.out.BASELINE_NAME.TIMESTAMP files in each run directory.
+    *.cprnc.out.BASELINE_NAME.TIMESTAMP files in each run directory for the
+    history files that differ from their baselines. cprnc is not run for
+    bit-for-bit identical history files, so they have no such file.
+
+    Up to parallel tests are compared at the same time, the results are still
+    reported in test order. The time spent on each test is reported if verbose
+    is set or more than one test is compared at the same time.
 
     Returns True if all tests generated either PASS or SKIP results, False if
     there was at least one FAIL result.
@@ -62,90 +163,22 @@ def compare_test_results(baseline_name, baseline_root, test_root, compiler, test
 
     all_pass_or_skip = True
 
-    for test_status_file in test_status_files:
-        test_dir = os.path.dirname(test_status_file)
-        ts = TestStatus(test_dir=test_dir)
-        test_name = ts.get_name()
-        if (compare_tests in [[], None] or CIME.utils.match_any(test_name, compare_tests)):
-            append_status(
-                "Comparing against baseline with compare_test_results:\n" +
-                "Baseline: %s\n"%(baseline_name) +
-                "In baseline_root: %s"%(baseline_root),
-                logfile_name,
-                caseroot=test_dir)
-
-            if (not hist_only):
-                nl_compare_result = None
-                nl_compare_comment = ""
-                nl_result = ts.get_status(SETUP_PHASE)
-                if (nl_result is None):
-                    nl_compare_result = "SKIP"
-                    nl_compare_comment = "Test did not make it to setup phase"
-                    nl_do_compare = False
-                else:
-                    nl_do_compare = True
-            else:
-                nl_do_compare = False
-
-            detailed_comments = ""
-            if (not namelists_only):
-                compare_result = None
-                compare_comment = ""
-                run_result = ts.get_status(RUN_PHASE)
-                if (run_result is None):
-                    compare_result = "SKIP"
-                    compare_comment = "Test did not make it to run phase"
-                    do_compare = False
-                elif (run_result != TEST_PASS_STATUS):
-                    compare_result = "SKIP"
-                    compare_comment = "Run phase did not pass"
-                    do_compare = False
-                else:
-                    do_compare = True
-            else:
-                do_compare = False
-
-            if nl_do_compare or do_compare:
-                with Case(test_dir) as case:
-                    if nl_do_compare:
-                        nl_success = compare_namelists(case, baseline_name, baseline_root, logfile_name, compiler)
-                        if nl_success:
-                            nl_compare_result = TEST_PASS_STATUS
-                            nl_compare_comment = ""
-                        else:
-                            nl_compare_result = TEST_FAIL_STATUS
-                            nl_compare_comment = "See %s/%s" % (test_dir, logfile_name)
-                            all_pass_or_skip = False
-
-                    if do_compare:
-                        success, detailed_comments = compare_history(case, baseline_name, baseline_root, log_id, compiler)
-                        if success:
-                            compare_result = TEST_PASS_STATUS
-                        else:
-                            compare_result = TEST_FAIL_STATUS
-                            all_pass_or_skip = False
-
-                        # Following the logic in SystemTestsCommon._compare_baseline:
-                        # We'll print the comment if it's a brief one-liner; otherwise
-                        # the comment will only appear in the log file
-                        if "\n" not in detailed_comments:
-                            compare_comment = detailed_comments
-
-            brief_result = ""
-            if not hist_only:
-                brief_result += "%s %s %s %s\n" % (nl_compare_result, test_name, NAMELIST_PHASE, nl_compare_comment)
-
-            if not namelists_only:
-                brief_result += "%s %s %s" % (compare_result, test_name, BASELINE_PHASE)
-                if compare_comment:
-                    brief_result += " %s" % compare_comment
-                brief_result += "\n"
-
-            print brief_result,
-
-            append_status(brief_result, logfile_name, caseroot=test_dir)
-
-            if detailed_comments:
-                append_status("Detailed comments:\n" + detailed_comments, logfile_name, caseroot=test_dir)
+    start_time = time.time()
+    timings = []
+    args_list = [(os.path.dirname(test_status_file), baseline_name, baseline_root, compiler, compare_tests,
+                  namelists_only, hist_only, log_id, logfile_name)
+                 for test_status_file in test_status_files]
+    for result, output, elapsed in run_in_pool(_compare_test, args_list, parallel):
+        sys.stdout.write(output)
+        if result is None:
+            continue
+
+        test_name, brief_result, pass_or_skip = result
+        all_pass_or_skip &= pass_or_skip
+        timings.append((test_name, elapsed))
+        print brief_result,
+
+    if verbose or parallel > 1:
+        print_timing_summary(timings, start_time)
 
     return all_pass_or_skip
@@ -0,0 +1,205 @@
+"""
+Single pass analysis of coupler logs. The memory highwater records, the
+throughput, the successful termination marker and the per day timestamps of a
+cpl.log are extracted while the log is decompressed once, and the result is
+cached as JSON in a hidden file next to the log (.<log name>.summary) so that the
+other test phases do not have to read the log again.
+"""
+
+from CIME.XML.standard_module_setup import *
+
+import gzip, json, re, tempfile
+
+logger = logging.getLogger(__name__)
+
+_CACHE_VERSION = 2
+
+_READ_SIZE = 4 * 1024 * 1024
+
+# Matched against blocks of whole lines, [^\n] keeps a match within one line
+_MEMORY_RE = re.compile(r"model date =[ \t]+(\w+)[^\n]*memory =[ \t]+(\d+\.?\d+)[^\n]*highwater")
+_THROUGHPUT_RE = re.compile(r"# simulated years / cmp-day =[ \t]+(\d+\.\d+)(?:\s|$)")
+_TSTAMP_RE = re.compile(r"tStamp_write: model date =[ \t]+(\d+)[ \t]+(\d+) wall clock = [^\n]* "
+                        r"avg dt =[ \t]+(\S+)[ \t]+dt =[ \t]+(\S+)")
+_COMPLETE_MARKER = "SUCCESSFUL TERMINATION"
+
+# path -> (size, mtime, CplLogSummary) of the logs analyzed by this process
+_SUMMARIES = {}
+
+class CplLogSummary(object):
+    """
+    What the test phases need to know about a coupler log:
+    memory    : list of (model date, highwater memory in MB)
+    throughput: simulated years / cmp-day, None if the log does not report it
+    complete  : True if the log contains SUCCESSFUL TERMINATION
+    compressed: True if the log was gzipped
+    tstamps   : list of (model date, seconds, avg dt, dt) of the daily timestamps
+
+    >>> summary = CplLogSummary()
+    >>> summary.scan_text(
+    ...     " tStamp_write: model date =   560102       0 wall clock = 2016-03-20 13:45:09 avg dt =    14.92 dt =    14.92\\n"
+    ...     " memory_write: model date =   560102       0 memory =     798.09 MB (highwater)       2941.33 MB (usage)\\n"
+    ...     " memory_write: model date =   560103       0 memory =     798.37 MB (highwater)       2941.33 MB (usage)\\n"
+    ...     " # simulated years / cmp-day =        3.21\\n"
+    ...     "  SUCCESSFUL TERMINATION\\n")
+    >>> summary.memory, summary.throughput, summary.complete, summary.tstamps
+    ([(560102.0, 798.09), (560103.0, 798.37)], 3.21, True, [(560102, 0, 14.92, 14.92)])
+    >>> summary.get_mem_usage()
+    [(560102.0, 798.09)]
+    """
+
+    def __init__(self):
+        self.memory = []
+        self.throughput = None
+        self.complete = False
+        self.compressed = False
+        self.tstamps = []
+
+    def scan_text(self, text):
+        """
+        Add the records in text, which must consist of whole lines
+        """
+        for m in _MEMORY_RE.finditer(text):
+            try:
+                self.memory.append((float(m.group(1)), float(m.group(2))))
+            except ValueError:
+                pass
+
+        for m in _TSTAMP_RE.finditer(text):
+            self.tstamps.append((int(m.group(1)), int(m.group(2)), float(m.group(3)), float(m.group(4))))
+
+        if self.throughput is None:
+            m = _THROUGHPUT_RE.search(text)
+            if m:
+                self.throughput = float(m.group(1))
+
+        if not self.complete and _COMPLETE_MARKER in text:
+            self.complete = True
+
+    def get_mem_usage(self):
+        """
+        The memory records without the last one, which is sometimes
+        artificially high
+        """
+        return self.memory[:-1]
+
+    def to_json(self):
+        """
+        The summary as plain lists and numbers, see from_json
+        """
+        return {"memory"     : self.memory,
+                "throughput" : self.throughput,
+                "complete"   : self.complete,
+                "compressed" : self.compressed,
+                "tstamps"    : self.tstamps}
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        The summary saved by to_json, raises ValueError if data is malformed
+
+        >>> summary = CplLogSummary()
+        >>> summary.scan_text(" # simulated years / cmp-day =        3.21\\n")
+        >>> CplLogSummary.from_json(json.loads(json.dumps(summary.to_json()))).throughput
+        3.21
+        >>> CplLogSummary.from_json({"memory" : "rm -rf"})
+        Traceback (most recent call last):
+            ...
+        ValueError: Malformed cpl log summary
+        """
+        summary = cls()
+        try:
+            summary.memory = [(float(date), float(mem)) for date, mem in data["memory"]]
+            summary.throughput = None if data["throughput"] is None else float(data["throughput"])
+            summary.complete = bool(data["complete"])
+            summary.compressed = bool(data["compressed"])
+            summary.tstamps = [(int(date), int(secs), float(avg_dt), float(dt))
+                               for date, secs, avg_dt, dt in data["tstamps"]]
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("Malformed cpl log summary")
+        return summary
+
+###############################################################################
+def _iter_blocks(fd):
+###############################################################################
+    """
+    Yield the content of fd in large blocks that end at a line end
+    """
+    pending = ""
+    for block in iter(lambda: fd.read(_READ_SIZE), ""):
+        end = block.rfind("\n") + 1
+        if end == 0:
+            pending += block
+        else:
+            yield pending + block[:end]
+            pending = block[end:]
+    if pending:
+        yield pending + "\n"
+
+###############################################################################
+def _get_cache_path(cpllog):
+###############################################################################
+    # hidden, so that it never matches the cpl.log.* globs of the log users
+    return os.path.join(os.path.dirname(cpllog), ".%s.summary" % os.path.basename(cpllog))
+
+###############################################################################
+def _read_cache(cache_path, size, mtime):
+###############################################################################
+    try:
+        with open(cache_path, "r") as fd:
+            data = json.load(fd)
+        if (data.get("version"), data.get("size"), data.get("mtime")) == (_CACHE_VERSION, size, mtime):
+            return CplLogSummary.from_json(data.get("summary"))
+    except (IOError, OSError, ValueError, AttributeError):
+        pass
+    return None
+
+###############################################################################
+def _write_cache(cache_path, summary, size, mtime, mode):
+###############################################################################
+    try:
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(cache_path), prefix=".cpl_log_summary.")
+        with os.fdopen(fd, "w") as fout:
+            json.dump({"version" : _CACHE_VERSION, "size" : size, "mtime" : mtime,
+                       "summary" : summary.to_json()}, fout)
+        os.chmod(tmpfile, mode)
+        os.rename(tmpfile, cache_path)
+    except (IOError, OSError) as e:
+        # e.g. a read-only baseline directory, the summary is just not cached
+        logger.debug("Could not cache summary of cpl log in %s: %s" % (cache_path, e))
+
+###############################################################################
+def get_cpl_log_summary(cpllog, use_cache=True):
+###############################################################################
+    """
+    Return the CplLogSummary of cpllog (gzipped or not), or None if cpllog is
+    None or does not exist. The log is only read if it changed since its
+    summary was cached.
+    """
+    if cpllog is None or not os.path.isfile(cpllog):
+        return None
+
+    stat = os.stat(cpllog)
+    # Readable by whoever can read the log, but only writable by its owner
+    size, mtime, mode = stat.st_size, stat.st_mtime, stat.st_mode & 0o644
+    if use_cache:
+        cached = _SUMMARIES.get(cpllog)
+        if cached is not None and cached[:2] == (size, mtime):
+            return cached[2]
+        summary = _read_cache(_get_cache_path(cpllog), size, mtime)
+        if summary is not None:
+            _SUMMARIES[cpllog] = (size, mtime, summary)
+            return summary
+
+    summary = CplLogSummary()
+    with open(cpllog, "rb") as fd:
+        summary.compressed = fd.read(2) == "\x1f\x8b"
+    with (gzip.open(cpllog, "rb") if summary.compressed else open(cpllog, "r")) as fd:
+        for block in _iter_blocks(fd):
+            summary.scan_text(block)
+    logger.debug("Scanned cpl log %s" % cpllog)
+
+    if use_cache:
+        _write_cache(_get_cache_path(cpllog), summary, size, mtime, mode)
+        _SUMMARIES[cpllog] = (size, mtime, summary)
+    return summary
@@ -7,10 +7,111 @@ information from a run.
 
 from CIME.XML.standard_module_setup import *
 
-import datetime, shutil, re
+import datetime, shutil, re, json, csv
 
 logger = logging.getLogger(__name__)
 
+# A line of the GPTL stats file starts with the quoted timer name, followed by
+# "processes threads count walltotal wallmax (proc thrd) wallmin (proc thrd)"
+_TIMER_NAME_RE = re.compile(r'\s*"([^"]*)"')
+_TIMER_COUNT_RE = re.compile(r'\s*(\d+)\s*\d+\s*(\S+)')
+_TIMER_SINGLE_COUNT_RE = re.compile(r'\s+(\d+)\s')
+_TIMER_WALL_RE = re.compile(r'\s*\d+\s*\d+\s*\S+\s*\S+\s*(\d*\.\d+)'
+                            r'\s*\(.*\)\s*(\d*\.\d+)\s*\(.*\)')
+
+TIMING_TABLE_COLUMNS = ("heading", "nprocs", "ncount", "min", "max")
+
+###############################################################################
+def parse_timing_stats(lines):
+###############################################################################
+    """
+    Parse the lines of a GPTL stats file in a single pass and return a dict of
+    timer name -> [nprocs, ncount, min, max]. nprocs and ncount are None if no
+    line of the timer has a process count, min and max are None if no line of
+    the timer has wallclock statistics. The first line of a timer wins.
+
+    >>> stats = parse_timing_stats([
+    ...     'name        processes  threads        count      walltotal   wallmax (proc   thrd  )   wallmin (proc   thrd  )\\n',
+    ...     '"CPL:INIT"          4        4 4.000000e+00   1.124000e+01     2.925 (      1      0)     2.680 (      3      0)\\n',
+    ...     '"CPL:RUN_LOOP"      4        4 1.920000e+03   4.564584e+02   114.594 (      2      0)   113.515 (      0      0)\\n',
+    ...     '"CPL:RUN_LOOP"      8        8 1.000000e+00   1.000000e+00     1.000 (      2      0)     1.000 (      0      0)\\n',
+    ...     '"CPL:SINGLE"   12 \\n'])
+    >>> sorted(stats.keys())
+    ['CPL:INIT', 'CPL:RUN_LOOP', 'CPL:SINGLE']
+    >>> stats["CPL:RUN_LOOP"]
+    [4, 1920, 113.515, 114.594]
+    >>> stats["CPL:SINGLE"]
+    [1, 12, None, None]
+    """
+    timers = {}
+    for line in lines:
+        m = _TIMER_NAME_RE.match(line)
+        if m is None:
+            continue
+        heading = m.group(1)
+        pos = m.end()
+        timer = timers.get(heading)
+        if timer is None:
+            timer = [None, None, None, None]
+
+        if timer[0] is None:
+            count = _TIMER_COUNT_RE.match(line, pos)
+            if count:
+                try:
+                    timer[0:2] = int(float(count.group(1))), int(float(count.group(2)))
+                except ValueError:
+                    logger.debug("Skipping malformed timer line: %s" % line)
+            else:
+                count = _TIMER_SINGLE_COUNT_RE.match(line, pos)
+                if count:
+                    timer[0:2] = 1, int(float(count.group(1)))
+
+        if timer[2] is None:
+            wall = _TIMER_WALL_RE.match(line, pos)
+            if wall:
+                timer[2:4] = float(wall.group(2)), float(wall.group(1))
+
+        if heading not in timers and (timer[0] is not None or timer[2] is not None):
+            timers[heading] = timer
+    return timers
+
+###############################################################################
+def write_timing_table(timers, filename, metadata=None):
+###############################################################################
+    """
+    Write the timers returned by parse_timing_stats to filename, as csv if
+    filename ends with .csv and as json otherwise. metadata (a dict) is stored
+    along with the timers in json, and as leading comment lines in csv.
+
+    >>> import tempfile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> timers = {"CPL:RUN": [4, 20, 1.5, 2.0], "CPL:INIT": [None, None, 0.5, 0.75]}
+    >>> write_timing_table(timers, os.path.join(tmpdir, "t.csv"), {"lid": "1-1"})
+    >>> print open(os.path.join(tmpdir, "t.csv")).read().strip()
+    # lid: 1-1
+    heading,nprocs,ncount,min,max
+    CPL:INIT,,,0.5,0.75
+    CPL:RUN,4,20,1.5,2.0
+    >>> write_timing_table(timers, os.path.join(tmpdir, "t.json"), {"lid": "1-1"})
+    >>> json.load(open(os.path.join(tmpdir, "t.json")))["timers"]["CPL:RUN"]["ncount"]
+    20
+    >>> shutil.rmtree(tmpdir)
+    """
+    metadata = {} if metadata is None else metadata
+    with open(filename, "w") as fd:
+        if filename.endswith(".csv"):
+            for key, value in sorted(metadata.items()):
+                fd.write("# %s: %s\n" % (key, value))
+            writer = csv.writer(fd, lineterminator="\n")
+            writer.writerow(TIMING_TABLE_COLUMNS)
+            for heading, timer in sorted(timers.items()):
+                writer.writerow([heading] + ["" if value is None else value for value in timer])
+        else:
+            table = dict(metadata)
+            table["timers"] = dict([(heading, dict(zip(TIMING_TABLE_COLUMNS[1:], timer)))
+                                    for heading, timer in timers.items()])
+            json.dump(table, fd, indent=1, sort_keys=True)
+
 class _GetTimingInfo:
     def __init__(self, name):
         self.name = name
@@ -19,11 +120,12 @@ class _GetTimingInfo:
         self.adays = 0
 
 class _TimingParser:
-    def __init__(self, case, lid="999999-999999"):
+    def __init__(self, case, lid="999999-999999", table_formats=("json",)):
         self.case = case
         self.caseroot = case.get_value("CASEROOT")
         self.lid = lid
-        self.finlines = None
+        self.table_formats = table_formats
+        self.timers = None
         self.fout = None
         self.adays=0
         self.models = {}
@@ -67,39 +169,16 @@ class _TimingParser:
                                    minv=mind, maxv=maxd))
 
     def gettime2(self, heading_padded):
-        nprocs = 0
-        ncount = 0
-
-        heading = '"' + heading_padded.strip() + '"'
-        for line in self.finlines:
-            m = re.match(r'\s*%s\s*(\d+)\s*\d+\s*(\S+)'%heading, line)
-            if m:
-                nprocs = int(float(m.groups()[0]))
-                ncount = int(float(m.groups()[1]))
-                return (nprocs, ncount)
-            else:
-                m = re.match(r'\s*%s\s+(\d+)\s'%heading, line)
-                if m:
-                    nprocs = 1
-                    ncount = int(float(m.groups()[0]))
-                    return (nprocs, ncount)
-        return (0, 0)
+        timer = self.timers.get(heading_padded.strip())
+        if timer is None or timer[0] is None:
+            return (0, 0)
+        return (timer[0], timer[1])
 
     def gettime(self, heading_padded):
-        found = False
-        heading = '"' + heading_padded.strip() + '"'
-        minval = 0
-        maxval = 0
-
-        for line in self.finlines:
-            m = re.match(r'\s*%s\s*\d+\s*\d+\s*\S+\s*\S+\s*(\d*\.\d+)'
-                         r'\s*\(.*\)\s*(\d*\.\d+)\s*\(.*\)'%heading, line)
-            if m:
-                maxval = float(m.groups()[0])
-                minval = float(m.groups()[1])
-                found = True
-                return (minval, maxval, found)
-        return (0, 0, False)
+        timer = self.timers.get(heading_padded.strip())
+        if timer is None or timer[2] is None:
+            return (0, 0, False)
+        return (timer[2], timer[3], True)
 
     def getTiming(self):
         ninst = self.case.get_value("NINST_CPL")
@@ -194,13 +273,20 @@ class _TimingParser:
 
         os.chdir(self.caseroot)
         try:
-            fin = open(finfilename, "r")
-            self.finlines = fin.readlines()
-            fin.close()
+            with open(finfilename, "r") as fin:
+                self.timers = parse_timing_stats(fin)
         except Exception, e:
             logger.critical("Unable to open file %s" % finfilename)
             raise e
 
+        for table_format in self.table_formats:
+            write_timing_table(self.timers,
+                               os.path.join(timingDir, "%s_timing%s_stats.%s.%s" %
+                                            (cime_model, inst_label, self.lid, table_format)),
+                               {"case" : caseid, "lid" : self.lid, "machine" : mach,
+                                "compiler" : self.case.get_value("COMPILER"),
+                                "instance" : inst})
+
         tlen = 1.0
         if ncpl_base_period == "decade":
             tlen = 3650.0
@@ -618,6 +704,10 @@ class _TimingParser:
 
         self.fout.close()
 
-def get_timing(case, lid):
-    parser = _TimingParser(case, lid)
+def get_timing(case, lid, table_formats=("json",)):
+    """
+    Write the timing profile of run lid, and the parsed timer table in each of
+    table_formats ("json", "csv"), to $CASEROOT/timing
+    """
+    parser = _TimingParser(case, lid, table_formats)
     parser.getTiming()
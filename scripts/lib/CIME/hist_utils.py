@@ -5,9 +5,19 @@ Functions for actions pertaining to history files.
 from CIME.XML.standard_module_setup import *
 from CIME.test_status import TEST_NO_BASELINES_COMMENT
 
-import logging, glob, os, shutil, re, stat
+from multiprocessing.dummy import Pool as ThreadPool
+import logging, glob, os, shutil, re, stat, time, hashlib, fcntl, tempfile
 logger = logging.getLogger(__name__)
 
+# Used when the case does not set CPRNC_MAX_PROCS
+_DEFAULT_CPRNC_MAX_PROCS = 4
+
+# Sidecar manifest in baseline directories holding the digests of the baseline
+# hist files, one "<sha1> <size> <mtime> <basename>" line per file
+BASELINE_DIGESTS_FILENAME = "hist_digests"
+
+_READ_CHUNK_SIZE = 4 * 1024 * 1024
+
 def _iter_model_file_substrs(case):
     models = case.get_compset_components()
     models.append('cpl')
@@ -173,7 +183,146 @@ def _hists_match(model, hists1, hists2, suffix1="", suffix2=""):
 
     return one_not_two, two_not_one, match_ups
 
-def _compare_hists(case, from_dir1, from_dir2, suffix1="", suffix2="", outfile_suffix=""):
+def _get_file_digest(filepath):
+    hasher = hashlib.sha1()
+    with open(filepath, "rb") as fd:
+        for chunk in iter(lambda: fd.read(_READ_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def _read_baseline_digests(baseline_dir):
+    """
+    Return a dict of basename -> (digest, size, mtime) from the digest manifest
+    in baseline_dir, empty if there is none
+    """
+    digests = {}
+    manifest = os.path.join(baseline_dir, BASELINE_DIGESTS_FILENAME)
+    if os.path.isfile(manifest):
+        with open(manifest, "r") as fd:
+            for line in fd:
+                fields = line.split()
+                if len(fields) == 4:
+                    digests[fields[3]] = (fields[0], int(fields[1]), int(fields[2]))
+    return digests
+
+def _write_baseline_digests(baseline_dir, digests):
+    """
+    Write the digest manifest of baseline_dir, dropping entries for files that
+    no longer exist
+    """
+    manifest = os.path.join(baseline_dir, BASELINE_DIGESTS_FILENAME)
+    tmp_manifest = "%s.%d.tmp" % (manifest, os.getpid())
+    with open(tmp_manifest, "w") as fd:
+        for basename, (digest, size, mtime) in sorted(digests.items()):
+            if os.path.isfile(os.path.join(baseline_dir, basename)):
+                fd.write("%s %d %d %s\n" % (digest, size, mtime, basename))
+    os.rename(tmp_manifest, manifest)
+
+def _copy_baseline_file(src, baseline):
+    """
+    Copy src to baseline through a temporary file, so that comparisons running
+    at the same time see either the old or the new baseline file
+    """
+    fd, tmpfile = tempfile.mkstemp(prefix=".%s." % os.path.basename(baseline),
+                                   dir=os.path.dirname(baseline))
+    os.close(fd)
+    try:
+        shutil.copy(src, tmpfile)
+        os.rename(tmpfile, baseline)
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+def _get_digest_entry(filepath):
+    return (_get_file_digest(filepath), os.path.getsize(filepath), int(os.path.getmtime(filepath)))
+
+def _files_are_identical(file1, file2, digests2):
+    """
+    Check whether file1 and file2 are bit-for-bit identical without reading
+    more than needed. digests2 may hold the precomputed digest of file2 by
+    basename, in which case file2 is not read at all.
+
+    >>> import tempfile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> file1, file2, file3 = [os.path.join(tmpdir, name) for name in ("a.nc", "b.nc", "c.nc")]
+    >>> for filepath, contents in ((file1, "abc"), (file2, "abc"), (file3, "abd")):
+    ...     with open(filepath, "w") as fd:
+    ...         fd.write(contents)
+    >>> _files_are_identical(file1, file2, {})
+    True
+    >>> _files_are_identical(file1, file3, {})
+    False
+    >>> _files_are_identical(file1, file3, {"c.nc" : _get_digest_entry(file2)[:1] + _get_digest_entry(file3)[1:]})
+    True
+    >>> _files_are_identical(file1, file2, {"b.nc" : ("0" * 40, 3, 0)})
+    True
+    >>> shutil.rmtree(tmpdir)
+    """
+    size = os.path.getsize(file1)
+    if size != os.path.getsize(file2):
+        return False
+
+    digest_entry = digests2.get(os.path.basename(file2))
+    if digest_entry is not None and digest_entry[1:] == (size, int(os.path.getmtime(file2))):
+        return _get_file_digest(file1) == digest_entry[0]
+
+    # No usable digest, compare the files chunk by chunk
+    with open(file1, "rb") as fd1, open(file2, "rb") as fd2:
+        while True:
+            chunk1 = fd1.read(_READ_CHUNK_SIZE)
+            if chunk1 != fd2.read(_READ_CHUNK_SIZE):
+                return False
+            if not chunk1:
+                return True
+
+def _get_cprnc_max_procs(case, num_procs):
+    if num_procs is None:
+        num_procs = case.get_value("CPRNC_MAX_PROCS")
+    if num_procs is None:
+        num_procs = _DEFAULT_CPRNC_MAX_PROCS
+    expect(num_procs > 0, "Number of cprnc processes must be positive, got %s" % num_procs)
+    return num_procs
+
+def _run_cprnc_jobs(case, jobs, from_dir1, from_dir2, outfile_suffix, num_procs):
+    """
+    Run cprnc for each (model, hist1, hist2, multiinst_cpl_compare) in jobs with at
+    most num_procs at once. Returns the (success, comments, identical) of each job
+    in the order of jobs, identical is True if cprnc was skipped because the
+    files are bit-for-bit identical.
+    """
+    digests2 = _read_baseline_digests(from_dir2)
+
+    def run_job(job):
+        model, hist1, hist2, multiinst_cpl_compare = job
+        start_time = time.time()
+        if _files_are_identical(hist1, hist2, digests2):
+            logger.info("%s and %s are identical, skipped cprnc in %.2f seconds" %
+                        (hist1, hist2, time.time() - start_time))
+            return True, "", True
+
+        result = cprnc(model, hist1, hist2, case, from_dir1,
+                       multiinst_cpl_compare = multiinst_cpl_compare,
+                       outfile_suffix = outfile_suffix)
+        logger.info("cprnc of %s and %s took %.2f seconds" % (hist1, hist2, time.time() - start_time))
+        return result + (False,)
+
+    if not jobs:
+        return []
+
+    # No point in using more threads than files
+    num_procs = min(num_procs, len(jobs))
+
+    start_time = time.time()
+    pool = ThreadPool(num_procs)
+    results = pool.map(run_job, jobs)
+    pool.close()
+    pool.join()
+    logger.info("Compared %d pairs of hist files with %d cprnc processes in %.2f seconds" %
+                (len(jobs), num_procs, time.time() - start_time))
+
+    return results
+
+def _compare_hists(case, from_dir1, from_dir2, suffix1="", suffix2="", outfile_suffix="", num_procs=None):
     if from_dir1 == from_dir2:
         expect(suffix1 != suffix2, "Comparing files to themselves?")
 
@@ -183,31 +332,48 @@ def _compare_hists(case, from_dir1, from_dir2, suffix1="", suffix2="", outfile_s
     comments = "Comparing hists for case '%s' dir1='%s', suffix1='%s',  dir2='%s' suffix2='%s'\n" % \
         (testcase, from_dir1, suffix1, from_dir2, suffix2)
     multiinst_cpl_compare = False
+
+    # Match up the files of all models first, so that all of the cprnc
+    # comparisons can be run at once. model_comments holds the comments that
+    # come before the cprnc results of each model.
+    model_comments = []
+    jobs = []
     for model in _iter_model_file_substrs(case):
         if model == 'cpl' and suffix2 == 'multiinst':
             multiinst_cpl_compare = True
-        comments += "  comparing model '%s'\n" % model
+        model_comment = "  comparing model '%s'\n" % model
         hists1 = _get_latest_hist_files(testcase, model, from_dir1, suffix1)
         hists2 = _get_latest_hist_files(testcase, model, from_dir2, suffix2)
         if len(hists1) == 0 and len(hists2) == 0:
-            comments += "    no hist files found for model %s\n" % model
+            model_comment += "    no hist files found for model %s\n" % model
+            model_comments.append((model_comment, 0))
             continue
 
         one_not_two, two_not_one, match_ups = _hists_match(model, hists1, hists2, suffix1, suffix2)
         for item in one_not_two:
-            comments += "    File '%s' had no counterpart in '%s' with suffix '%s'\n" % (item, from_dir2, suffix2)
+            model_comment += "    File '%s' had no counterpart in '%s' with suffix '%s'\n" % (item, from_dir2, suffix2)
             all_success = False
         for item in two_not_one:
-            comments += "    File '%s' had no counterpart in '%s' with suffix '%s'\n" % (item, from_dir1, suffix1)
+            model_comment += "    File '%s' had no counterpart in '%s' with suffix '%s'\n" % (item, from_dir1, suffix1)
             all_success = False
 
         num_compared += len(match_ups)
-
+        model_comments.append((model_comment, len(match_ups)))
         for hist1, hist2 in match_ups:
-            success, cprnc_comments = cprnc(model, hist1, hist2, case, from_dir1,
-                                            multiinst_cpl_compare = multiinst_cpl_compare,
-                                            outfile_suffix = outfile_suffix)
-            if success:
+            jobs.append((model, hist1, hist2, multiinst_cpl_compare))
+
+    results = _run_cprnc_jobs(case, jobs, from_dir1, from_dir2, outfile_suffix,
+                              _get_cprnc_max_procs(case, num_procs))
+
+    job_idx = 0
+    for model_comment, num_jobs in model_comments:
+        comments += model_comment
+        for _, hist1, hist2, _ in jobs[job_idx:job_idx + num_jobs]:
+            success, cprnc_comments, identical = results[job_idx]
+            job_idx += 1
+            if identical:
+                comments += "    %s matched %s (bit-for-bit identical, cprnc not run)\n" % (hist1, hist2)
+            elif success:
                 comments += "    %s matched %s\n" % (hist1, hist2)
             else:
                 comments += "    %s did NOT match %s\n" % (hist1, hist2)
@@ -220,19 +386,21 @@ def _compare_hists(case, from_dir1, from_dir2, suffix1="", suffix2="", outfile_s
 
     return all_success, comments
 
-def compare_test(case, suffix1, suffix2):
+def compare_test(case, suffix1, suffix2, num_procs=None):
     """
     Compares two sets of component history files in the testcase directory
 
     case - The case containing the hist files to compare
     suffix1 - The suffix that identifies the first batch of hist files
     suffix1 - The suffix that identifies the second batch of hist files
+    num_procs - Optionally, the maximum number of cprnc processes to run at
+        once, otherwise CPRNC_MAX_PROCS of the case
 
     returns (SUCCESS, comments)
     """
     rundir   = case.get_value("RUNDIR")
 
-    return _compare_hists(case, rundir, rundir, suffix1, suffix2)
+    return _compare_hists(case, rundir, rundir, suffix1, suffix2, num_procs=num_procs)
 
 def cprnc(model, file1, file2, case, rundir, multiinst_cpl_compare=False, outfile_suffix=""):
     """
@@ -280,14 +448,17 @@ def cprnc(model, file1, file2, case, rundir, multiinst_cpl_compare=False, outfil
     else:
         return (cpr_stat == 0 and "files seem to be IDENTICAL" in out, out)
 
-def compare_baseline(case, baseline_dir=None, outfile_suffix=""):
+def compare_baseline(case, baseline_dir=None, outfile_suffix="", num_procs=None):
     """
     compare the current test output to a baseline result
 
     case - The case containing the hist files to be compared against baselines
     baseline_dir - Optionally, specify a specific baseline dir, otherwise it will be computed from case config
     outfile_suffix - if non-blank, then the cprnc output file name ends with
-        this suffix (with a '.' added before the given suffix)
+        this suffix (with a '.' added before the given suffix). Hist files that
+        are bit-for-bit identical to their baselines get no cprnc output file.
+    num_procs - Optionally, the maximum number of cprnc processes to run at
+        once, otherwise CPRNC_MAX_PROCS of the case
 
     returns (SUCCESS, comments)
     SUCCESS means all hist files matched their corresponding baseline
@@ -305,7 +476,8 @@ def compare_baseline(case, baseline_dir=None, outfile_suffix=""):
         if not os.path.isdir(bdir):
             return False, "ERROR %s baseline directory '%s' does not exist" % (TEST_NO_BASELINES_COMMENT,bdir)
 
-    return _compare_hists(case, rundir, basecmp_dir, outfile_suffix = outfile_suffix)
+    return _compare_hists(case, rundir, basecmp_dir, outfile_suffix = outfile_suffix,
+                          num_procs = num_procs)
 
 def get_extension(model, filepath):
     """
@@ -361,7 +533,11 @@ def generate_baseline(case, baseline_dir=None, allow_baseline_overwrite=False):
     testcase = case.get_value("CASE")
 
     if not os.path.isdir(basegen_dir):
-        os.makedirs(basegen_dir)
+        try:
+            os.makedirs(basegen_dir)
+        except OSError:
+            # Another process generating baselines may have created it first
+            expect(os.path.isdir(basegen_dir), "Could not create baseline directory %s" % basegen_dir)
 
     if (os.path.isdir(os.path.join(basegen_dir,testcase)) and
         not allow_baseline_overwrite):
@@ -369,31 +545,45 @@ def generate_baseline(case, baseline_dir=None, allow_baseline_overwrite=False):
 
     comments = "Generating baselines into '%s'\n" % basegen_dir
     num_gen = 0
-    for model in _iter_model_file_substrs(case):
-        comments += "  generating for model '%s'\n" % model
-        hists =  _get_latest_hist_files(testcase, model, rundir)
-        logger.debug("latest_files: %s" % hists)
-        num_gen += len(hists)
-        for hist in hists:
-            basename = hist[hist.rfind(model):]
-            baseline = os.path.join(basegen_dir, basename)
-            if os.path.exists(baseline):
-                os.remove(baseline)
-
-            #special care for multi-instance cases,
-            #only keep first instance and
-            #remove instance string from filename
-            m = re.search("(.*%s.*)_([0-9]{4})(.h.*)"%model, baseline)
-            if m is not None:
-                if m.group(2) != '0001':
-                    continue
-                baseline = m.group(1)+m.group(3)
-
-                logger.debug("Found multiinstance hist file %s"%hist)
-            shutil.copy(hist, baseline)
-            comments += "    generating baseline '%s' from file %s\n" % (baseline, hist)
 
-    expect(num_gen > 0, "Could not generate any hist files for case '%s', something is seriously wrong" % testcase)
+    # Baseline directories may be shared by processes blessing tests at the
+    # same time, serialize the updates of the files and the digest manifest
+    with open(os.path.join(basegen_dir, ".baseline_gen.lock"), "w") as lock_fd:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        try:
+            digests = _read_baseline_digests(basegen_dir)
+            for model in _iter_model_file_substrs(case):
+                comments += "  generating for model '%s'\n" % model
+                hists =  _get_latest_hist_files(testcase, model, rundir)
+                logger.debug("latest_files: %s" % hists)
+                num_gen += len(hists)
+                for hist in hists:
+                    basename = hist[hist.rfind(model):]
+                    baseline = os.path.join(basegen_dir, basename)
+
+                    #special care for multi-instance cases,
+                    #only keep first instance and
+                    #remove instance string from filename
+                    m = re.search("(.*%s.*)_([0-9]{4})(.h.*)"%model, baseline)
+                    if m is not None:
+                        # Remove stale baselines that kept the instance string,
+                        # other baselines are replaced by _copy_baseline_file
+                        if os.path.exists(baseline):
+                            os.remove(baseline)
+                        if m.group(2) != '0001':
+                            continue
+                        baseline = m.group(1)+m.group(3)
+
+                        logger.debug("Found multiinstance hist file %s"%hist)
+                    _copy_baseline_file(hist, baseline)
+                    digests[os.path.basename(baseline)] = _get_digest_entry(baseline)
+                    comments += "    generating baseline '%s' from file %s\n" % (baseline, hist)
+
+            expect(num_gen > 0, "Could not generate any hist files for case '%s', something is seriously wrong" % testcase)
+            # Lets compare_baseline check for identical files without reading the baselines
+            _write_baseline_digests(basegen_dir, digests)
+        finally:
+            fcntl.flock(lock_fd, fcntl.LOCK_UN)
     #make sure permissions are open in baseline directory
     for root, _, files in os.walk(basegen_dir):
         for name in files:
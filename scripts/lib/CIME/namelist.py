@@ -81,6 +81,12 @@ groups are separated by (optional) whitespace and comments, and nothing else.
 # column numbers for error-reporting purposes. The `_settings` attribute
 # holds the final output, i.e. the variable name-value pairs.
 #
+# Runs of characters that do not need any decision (whitespace, names, the
+# inside of literals) are found with the precompiled `_SCAN_*` regexes or
+# `str.find` on the whole text, starting at the current position, and then
+# consumed by a single `_advance`. The text is never sliced from the current
+# position to the end, which would make parsing quadratic in the file size.
+#
 # Parsing errors are signaled by one of two exceptions. The first is
 # `_NamelistParseError`, which always signals an unrecoverable error. This is
 # caught and translated to a user-visible error in `parse`. The second is
@@ -150,6 +156,14 @@ FORTRAN_LITERAL_REGEXES['logical'] = re.compile(r"^\.?[tf][^=/ \n]*$",
 # Repeated value prefix.
 FORTRAN_REPEAT_PREFIX_REGEX = re.compile(r"^[0-9]*[1-9]+[0-9]*\*")
 
+# Scanners used by the parser with `regex.match(text, pos)`.
+_SCAN_REPEAT_PREFIX = re.compile(r"[0-9]*[1-9]+[0-9]*\*")
+_SCAN_WHITESPACE = re.compile(r"[ \n]*")
+_SCAN_NAME = re.compile(r"[^ \n=+]*")
+_SCAN_GROUP_NAME = re.compile(r"[^ \n]*")
+_SCAN_VALUE = re.compile(r"[^ \n,/()]*")
+_SCAN_VALUE_OR_NAME = re.compile(r"[^ \n,/()=+]*")
+
 
 def is_valid_fortran_name(string):
     """Check that a variable name is allowed in Fortran.
@@ -884,7 +898,9 @@ class Namelist(object):
         self._groups = {}
         if groups is not None:
             for group_name in groups:
-                expect(group_name is not None, " Got None in groups %s"%groups)
+                # Only format the (large) error message if it is needed
+                if group_name is None:
+                    expect(False, " Got None in groups %s"%groups)
                 group_lc = group_name.lower()
                 self._groups[group_lc] = collections.OrderedDict()
                 for variable_name in groups[group_name]:
@@ -1331,22 +1347,45 @@ class _NamelistParser(object): # pylint:disable=too-few-public-methods
         """
         assert nchars >= 0, \
             "_NamelistParser attempted to 'advance' backwards"
-        new_pos = min(self._pos + nchars, self._len)
-        consumed_text = self._text[self._pos:new_pos]
+        old_pos = self._pos
+        new_pos = min(old_pos + nchars, self._len)
         self._pos = new_pos
-        lines = consumed_text.count('\n')
+        lines = self._text.count('\n', old_pos, new_pos)
         self._line += lines
         # If we started a new line, set self._col to be relative to the start of
         # the current line.
         if lines > 0:
-            self._col = -(consumed_text.rfind('\n') + 1)
-        self._col += len(consumed_text)
+            self._col = -(self._text.rfind('\n', old_pos, new_pos) + 1 - old_pos)
+        self._col += new_pos - old_pos
         end_of_file = new_pos == self._len
         if check_eof:
             return end_of_file
         elif end_of_file:
             raise _NamelistEOF(message=None)
 
+    def _advance_to(self, char):
+        r"""Advance to the next occurrence of `char`.
+
+        Equivalent to calling `_advance` until the current character is `char`,
+        so the end of file is an error if `char` is not found.
+
+        >>> x = _NamelistParser('ab\ncd')
+        >>> x._advance_to('c')
+        >>> (x._pos, x._line, x._col)
+        (3, 2, 0)
+        >>> x._advance_to('c')
+        >>> x._pos
+        3
+        >>> x._advance_to('e')
+        Traceback (most recent call last):
+            ...
+        _NamelistEOF: Unexpected end of file encountered in namelist.
+        """
+        char_pos = self._text.find(char, self._pos)
+        if char_pos == -1:
+            char_pos = self._len
+        self._advance(char_pos - self._pos)
+
     def _eat_whitespace(self, allow_initial_comment=False):
         r"""Advance until the next non-whitespace character.
 
@@ -1391,10 +1430,11 @@ class _NamelistParser(object): # pylint:disable=too-few-public-methods
         eaten = False
         comment_allowed = allow_initial_comment
         while True:
-            while self._curr() in (' ', '\n'):
-                comment_allowed |= self._curr() == '\n'
+            end = _SCAN_WHITESPACE.match(self._text, self._pos).end()
+            if end > self._pos:
+                comment_allowed |= self._text.find('\n', self._pos, end) != -1
                 eaten = True
-                self._advance()
+                self._advance(end - self._pos)
             # Note the reliance on short-circuit `and` here.
             if not (comment_allowed and self._eat_comment()):
                 break
@@ -1432,13 +1472,13 @@ class _NamelistParser(object): # pylint:disable=too-few-public-methods
         """
         if self._curr() != '!':
             return False
-        newline_pos = self._text[self._pos:].find('\n')
+        newline_pos = self._text.find('\n', self._pos)
         if newline_pos == -1:
             # This is the last line.
             self._advance(self._len - self._pos)
         else:
             # Advance to the next line.
-            self._advance(newline_pos)
+            self._advance(newline_pos - self._pos)
             # Advance to the first character of the next line.
             self._advance()
         return True
@@ -1541,9 +1581,8 @@ class _NamelistParser(object): # pylint:disable=too-few-public-methods
         u'foo'
         """
         old_pos = self._pos
-        separators = (' ', '\n', '=', '+') if allow_equals else (' ', '\n')
-        while self._curr() not in separators:
-            self._advance()
+        scanner = _SCAN_NAME if allow_equals else _SCAN_GROUP_NAME
+        self._advance(scanner.match(self._text, old_pos).end() - old_pos)
         text = self._text[old_pos:self._pos]
         if '(' in text:
             expect(')' in text,"Parsing error ")
@@ -1599,8 +1638,7 @@ class _NamelistParser(object): # pylint:disable=too-few-public-methods
         old_pos = self._pos
         self._advance()
         while True:
-            while self._curr() != delimiter:
-                self._advance()
+            self._advance_to(delimiter)
             # Avoid end-of-file condition.
             if self._pos == self._len - 1:
                 break
@@ -1633,8 +1671,7 @@ class _NamelistParser(object): # pylint:disable=too-few-public-methods
         _NamelistParseError: Error in parsing namelist: '(A,B)' is not a valid complex literal
         """
         old_pos = self._pos
-        while self._curr() != ')':
-            self._advance()
+        self._advance_to(')')
         text = self._text[old_pos:self._pos+1]
         if not is_valid_fortran_namelist_literal("complex", text):
             raise _NamelistParseError("%r is not a valid complex literal"
@@ -1656,13 +1693,8 @@ class _NamelistParser(object): # pylint:disable=too-few-public-methods
         >>> _NamelistParser('a=')._look_ahead_for_equals(0)
         False
         """
-        for test_pos in range(pos, self._len):
-            if self._text[test_pos] not in (' ', '\n'):
-                if self._text[test_pos] == '=':
-                    return True
-                else:
-                    break
-        return False
+        test_pos = _SCAN_WHITESPACE.match(self._text, pos).end()
+        return test_pos < self._len and self._text[test_pos] == '='
 
     def _look_ahead_for_plusequals(self, pos):
         r"""Look ahead to see if the next two non-whitespace character are '+='.
@@ -1679,12 +1711,9 @@ class _NamelistParser(object): # pylint:disable=too-few-public-methods
         >>> _NamelistParser('a+=')._look_ahead_for_plusequals(0)
         False
         """
-        for test_pos in range(pos, self._len):
-            if self._text[test_pos] not in (' ', '\n'):
-                if self._text[test_pos] == '+':
-                    return self._look_ahead_for_equals(test_pos + 1)
-                else:
-                    break
+        test_pos = _SCAN_WHITESPACE.match(self._text, pos).end()
+        if test_pos < self._len and self._text[test_pos] == '+':
+            return self._look_ahead_for_equals(test_pos + 1)
         return False
 
     def _parse_literal(self, allow_name=False, allow_eof_end=False):
@@ -1800,10 +1829,9 @@ class _NamelistParser(object): # pylint:disable=too-few-public-methods
             return u''
         # Deal with a repeated value prefix.
         old_pos = self._pos
-        if FORTRAN_REPEAT_PREFIX_REGEX.search(self._text[self._pos:]):
+        if _SCAN_REPEAT_PREFIX.match(self._text, self._pos):
             allow_name = False
-            while self._curr() != '*':
-                self._advance()
+            self._advance_to('*')
             if self._advance(check_eof=allow_eof_end):
                 # In case the file ends with the 'r*' form of null value.
                 return self._text[old_pos:]
@@ -1820,10 +1848,16 @@ class _NamelistParser(object): # pylint:disable=too-few-public-methods
         # Deal with non-delimited literals.
         new_pos = self._pos
         separators = [' ', '\n', ',', '/']
+        scanner = _SCAN_VALUE
         if allow_name:
             separators.append('=')
             separators.append('+')
-        while new_pos != self._len and self._text[new_pos] not in separators:
+            scanner = _SCAN_VALUE_OR_NAME
+        while True:
+            # skip the characters that are neither separators nor parentheses
+            new_pos = scanner.match(self._text, new_pos).end()
+            if new_pos == self._len or self._text[new_pos] in separators:
+                break
             # allow commas if they are inside ()
             if self._text[new_pos] == '(':
                 separators.remove(',')
@@ -0,0 +1,378 @@
+"""
+Local performance archive: an append-only SQLite database of the timing
+profiles that get_timing writes ($MODEL_timing.$CASE.$LID) and that the
+provenance functions copy into SAVE_TIMING_DIR. Every run is stored once with
+its machine, compiler, PE layout, throughput and per component run times,
+along with the GPTL timers of $MODEL_timing_stats.$LID.json when it is
+present, so that trends across cases, machines and compilers can be queried
+without reading the archived files again.
+"""
+
+from CIME.XML.standard_module_setup import *
+
+import glob, gzip, json, re, sqlite3, time
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    path TEXT PRIMARY KEY, mtime REAL, run_id INTEGER);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY, caseid TEXT, lid TEXT, instance INTEGER, user TEXT,
+    run_date TEXT, machine TEXT, compiler TEXT, compset TEXT, grid TEXT,
+    run_length REAL, total_pes INTEGER, cost_pes INTEGER, model_cost REAL,
+    throughput REAL, init_time REAL, run_time REAL, final_time REAL,
+    UNIQUE (caseid, lid, instance, user));
+CREATE INDEX IF NOT EXISTS runs_by_machine ON runs (machine, compiler, run_date);
+CREATE INDEX IF NOT EXISTS runs_by_case ON runs (caseid, run_date);
+CREATE TABLE IF NOT EXISTS components (
+    run_id INTEGER, component TEXT, comp TEXT, comp_pes INTEGER, rootpe INTEGER,
+    ntasks INTEGER, nthrds INTEGER, ninst INTEGER, pstrid INTEGER, run_time REAL,
+    seconds_per_mday REAL, myears_per_wday REAL, PRIMARY KEY (run_id, component));
+CREATE TABLE IF NOT EXISTS timers (
+    run_id INTEGER, heading TEXT, nprocs INTEGER, ncount INTEGER, min REAL, max REAL,
+    PRIMARY KEY (run_id, heading));
+"""
+
+_RUN_COLUMNS = ("caseid", "lid", "instance", "user", "run_date", "machine", "compiler",
+                "compset", "grid", "run_length", "total_pes", "cost_pes", "model_cost",
+                "throughput", "init_time", "run_time", "final_time")
+
+_COMPONENT_COLUMNS = ("component", "comp", "comp_pes", "rootpe", "ntasks", "nthrds",
+                      "ninst", "pstrid", "run_time", "seconds_per_mday", "myears_per_wday")
+
+# $MODEL_timing[_$INST].$CASE.$LID[.gz], the case name may contain dots
+_REPORT_NAME_RE = re.compile(r"^(\w+?)_timing(_\d{4})?\.(.+)\.(\d{6}-\d{6})(\.gz)?$")
+
+_REPORT_HEADER_RE = re.compile(r"^\s+(Case|LID|Machine|User|grid|compset)\s*:\s*(.*?)\s*$")
+_REPORT_PATTERNS = (
+    ("run_length", float, re.compile(r"^\s+run_length\s*:\s*(\S+) days")),
+    ("total_pes", int, re.compile(r"^\s+total pes active\s*:\s*(\d+)")),
+    ("cost_pes", int, re.compile(r"^\s+pe count for cost estimate\s*:\s*(\d+)")),
+    ("model_cost", float, re.compile(r"^\s+Model Cost:\s*(\S+)")),
+    ("throughput", float, re.compile(r"^\s+Model Throughput:\s*(\S+)")),
+    ("init_time", float, re.compile(r"^\s+Init Time\s*:\s*(\S+)")),
+    ("final_time", float, re.compile(r"^\s+Final Time\s*:\s*(\S+)")),
+)
+_REPORT_LAYOUT_RE = re.compile(r"^\s+(\w+) = (\S+)\s+(\d+)\s+(\d+)\s+(\d+)\s+x\s+(\d+)\s+(\d+)\s+\((\d+)\s*\)")
+_REPORT_RUN_TIME_RE = re.compile(r"^\s+(\w+) Run Time:\s*(\S+) seconds\s+(\S+) seconds/mday\s+(\S+) myears/wday")
+
+###############################################################################
+def _open_text(path):
+###############################################################################
+    """
+    Open path for reading, transparently decompressing gzip files (the
+    timing profile is named .gz whether or not it is compressed)
+    """
+    with open(path, "rb") as fd:
+        magic = fd.read(2)
+    return gzip.open(path, "rb") if magic == "\x1f\x8b" else open(path, "r")
+
+###############################################################################
+def lid_to_date(lid):
+###############################################################################
+    """
+    >>> lid_to_date("170512-093015")
+    '2017-05-12 09:30:15'
+    >>> lid_to_date("999999-999999") is None
+    True
+    """
+    try:
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.strptime(lid, "%y%m%d-%H%M%S"))
+    except ValueError:
+        return None
+
+###############################################################################
+def parse_timing_report(lines):
+###############################################################################
+    """
+    Parse the text of a timing profile written by get_timing, returns a dict
+    of run values and a list of component dicts
+
+    >>> run, comps = parse_timing_report([
+    ...     "  Case        : mycase\\n",
+    ...     "  LID         : 170512-093015\\n",
+    ...     "  Machine     : yellowstone\\n",
+    ...     "  run_length  : 5 days (4.97916666667 for ocean)\\n",
+    ...     "  atm = cam        64       0        64     x 1       1      (1     ) \\n",
+    ...     "  cpl = cpl        64       0        64     x 1       1      (1     ) \\n",
+    ...     "  total pes active           : 64 \\n",
+    ...     "    Model Throughput:        12.34   simulated_years/day \\n",
+    ...     "    TOT Run Time:      38.123 seconds        7.625 seconds/mday        31.05 myears/wday \\n",
+    ...     "    ATM Run Time:      20.000 seconds        4.000 seconds/mday        59.18 myears/wday \\n"])
+    >>> run["caseid"], run["lid"], run["machine"], run["run_length"], run["total_pes"], run["throughput"], run["run_time"]
+    ('mycase', '170512-093015', 'yellowstone', 5.0, 64, 12.34, 38.123)
+    >>> [(c["component"], c["comp"], c["ntasks"], c["myears_per_wday"]) for c in comps]
+    [('ATM', 'cam', 64, 59.18), ('CPL', 'cpl', 64, None)]
+    """
+    run = {}
+    comps = {}
+    order = []
+    header_keys = {"Case" : "caseid", "LID" : "lid", "Machine" : "machine",
+                   "User" : "user", "grid" : "grid", "compset" : "compset"}
+    for line in lines:
+        m = _REPORT_HEADER_RE.match(line)
+        if m:
+            run.setdefault(header_keys[m.group(1)], m.group(2))
+            continue
+
+        m = _REPORT_LAYOUT_RE.match(line)
+        if m:
+            name = m.group(1).upper()
+            comps[name] = dict(zip(_COMPONENT_COLUMNS,
+                                   [name, m.group(2)] + [int(value) for value in m.groups()[2:]]))
+            order.append(name)
+            continue
+
+        m = _REPORT_RUN_TIME_RE.match(line)
+        if m:
+            name = m.group(1)
+            times = [float(value) for value in m.groups()[1:]]
+            if name == "TOT":
+                run["run_time"] = times[0]
+            elif name in comps:
+                comps[name].update(zip(_COMPONENT_COLUMNS[-3:], times))
+            continue
+
+        for key, convert, pattern in _REPORT_PATTERNS:
+            m = pattern.match(line)
+            if m:
+                run.setdefault(key, convert(m.group(1)))
+                break
+
+    components = []
+    for name in order:
+        for key in _COMPONENT_COLUMNS[-3:]:
+            comps[name].setdefault(key, None)
+        components.append(comps[name])
+    return run, components
+
+###############################################################################
+def find_timing_reports(paths):
+###############################################################################
+    """
+    Yield (path, instance) of the timing profiles in paths, directories
+    are searched recursively
+    """
+    for path in paths:
+        if os.path.isfile(path):
+            candidates = [path]
+        else:
+            candidates = []
+            for dirpath, _, filenames in os.walk(path):
+                candidates.extend([os.path.join(dirpath, filename) for filename in filenames])
+
+        for candidate in candidates:
+            m = _REPORT_NAME_RE.match(os.path.basename(candidate))
+            if m and "_stats" not in m.group(3):
+                yield candidate, int(m.group(2)[1:]) if m.group(2) else 0
+
+###############################################################################
+def _find_companion(report, pattern):
+###############################################################################
+    """
+    Return the first existing file named pattern (with an optional .gz) in the
+    directory of report or its CaseDocs.$LID subdirectory
+    """
+    dirname = os.path.dirname(report)
+    for candidate in (pattern, os.path.join("CaseDocs.*", pattern)):
+        for suffix in ("", ".gz"):
+            matches = glob.glob(os.path.join(dirname, candidate + suffix))
+            if matches:
+                return matches[0]
+    return None
+
+###############################################################################
+def _read_companions(report, run, instance):
+###############################################################################
+    """
+    Return the timers of the json timer table next to report, and fill in
+    the compiler of run from it or from an archived env_build.xml
+    """
+    m = _REPORT_NAME_RE.match(os.path.basename(report))
+    model, lid = m.group(1), m.group(4)
+    inst_label = "_%04d" % instance if instance else ""
+    timers = {}
+
+    table = _find_companion(report, "%s_timing%s_stats.%s.json" % (model, inst_label, lid))
+    if table is not None:
+        try:
+            with _open_text(table) as fd:
+                data = json.load(fd)
+            timers = data.get("timers", {})
+            if data.get("compiler"):
+                run.setdefault("compiler", data["compiler"])
+        except (IOError, ValueError) as e:
+            logger.warning("Could not read timer table %s: %s" % (table, e))
+
+    if "compiler" not in run:
+        env_build = _find_companion(report, "env_build.xml.%s" % lid)
+        if env_build is not None:
+            with _open_text(env_build) as fd:
+                m = re.search(r'id="COMPILER"\s+value="([^"]*)"', fd.read())
+            if m:
+                run["compiler"] = m.group(1)
+    return timers
+
+###############################################################################
+class PerfArchive(object):
+###############################################################################
+    """
+    The performance archive database. Runs are only ever added, a run that is
+    already in the archive (same case, lid, instance and user) is skipped.
+
+    >>> import tempfile, shutil
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> archive = PerfArchive(os.path.join(tmpdir, "perf.db"))
+    >>> for lid, tput in [("170101-000000", 10.0), ("170102-000000", 10.4), ("170103-000000", 7.5)]:
+    ...     archive.add_run({"caseid" : "c1", "lid" : lid, "machine" : "m", "compiler" : "intel",
+    ...                      "throughput" : tput, "total_pes" : 64},
+    ...                     [{"component" : "ATM", "ntasks" : 64, "myears_per_wday" : tput * 2}])
+    1
+    2
+    3
+    >>> archive.add_run({"caseid" : "c1", "lid" : "170103-000000"}, []) is None
+    True
+    >>> [(run["lid"], run["value"]) for run in archive.query_runs(machine="m", component="ATM")]
+    [(u'170101-000000', 20.0), (u'170102-000000', 20.8), (u'170103-000000', 15.0)]
+    >>> [(run["lid"], round(drop, 3)) for run, drop in find_regressions(archive.query_runs(), 10)]
+    [(u'170103-000000', 0.265)]
+    >>> archive.close()
+    >>> shutil.rmtree(tmpdir)
+    """
+
+    def __init__(self, path, timeout=60):
+        self._conn = sqlite3.connect(path, timeout=timeout)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def add_run(self, run, components, timers=None):
+        """
+        Add a run, returns its id or None if the run is already archived
+        """
+        run = dict(run)
+        run.setdefault("instance", 0)
+        run.setdefault("user", "")
+        run.setdefault("run_date", lid_to_date(run.get("lid", "")))
+        with self._conn:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO runs (%s) VALUES (%s)" %
+                (", ".join(_RUN_COLUMNS), ", ".join("?" * len(_RUN_COLUMNS))),
+                [run.get(key) for key in _RUN_COLUMNS])
+            if cursor.rowcount == 0:
+                return None
+            run_id = cursor.lastrowid
+            self._conn.executemany(
+                "INSERT INTO components (run_id, %s) VALUES (?, %s)" %
+                (", ".join(_COMPONENT_COLUMNS), ", ".join("?" * len(_COMPONENT_COLUMNS))),
+                [[run_id] + [comp.get(key) for key in _COMPONENT_COLUMNS] for comp in components])
+            if timers:
+                self._conn.executemany(
+                    "INSERT INTO timers (run_id, heading, nprocs, ncount, min, max) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(run_id, heading, timer.get("nprocs"), timer.get("ncount"), timer.get("min"), timer.get("max"))
+                     for heading, timer in timers.items()])
+        return run_id
+
+    def ingest(self, paths):
+        """
+        Add the runs of all timing profiles under paths that have not been
+        ingested yet, returns (number of new runs, number of skipped files)
+        """
+        known = dict(self._conn.execute("SELECT path, mtime FROM sources").fetchall())
+        added, skipped = 0, 0
+        for report, instance in find_timing_reports(paths):
+            report = os.path.abspath(report)
+            mtime = os.path.getmtime(report)
+            if known.get(report) == mtime:
+                skipped += 1
+                continue
+
+            try:
+                with _open_text(report) as fd:
+                    run, components = parse_timing_report(fd)
+            except (IOError, ValueError) as e:
+                logger.warning("Could not read timing profile %s: %s" % (report, e))
+                continue
+
+            if "lid" not in run or "caseid" not in run:
+                logger.warning("%s is not a timing profile, skipping" % report)
+                continue
+
+            run["instance"] = instance
+            timers = _read_companions(report, run, instance)
+            run_id = self.add_run(run, components, timers)
+            if run_id is not None:
+                added += 1
+                logger.debug("Archived %s as run %d" % (report, run_id))
+            with self._conn:
+                self._conn.execute("INSERT OR REPLACE INTO sources (path, mtime, run_id) VALUES (?, ?, ?)",
+                                   (report, mtime, run_id))
+        return added, skipped
+
+    def query_runs(self, machine=None, compiler=None, case=None, compset=None, grid=None,
+                   since=None, component=None, last=None):
+        """
+        Return the runs matching all given filters in run order as a list of
+        dicts. case is a glob pattern, since a lid or date prefix. Each run
+        has a "value" key: the throughput of the run, or the myears/wday of
+        component if one is given.
+        """
+        if component is None:
+            query = "SELECT runs.*, runs.throughput AS value FROM runs"
+            params = []
+        else:
+            query = "SELECT runs.*, components.ntasks, components.nthrds, components.myears_per_wday AS value " \
+                "FROM runs JOIN components ON components.run_id = runs.id AND components.component = ?"
+            params = [component.upper()]
+
+        conditions = []
+        for column, value in (("machine", machine), ("compiler", compiler),
+                              ("compset", compset), ("grid", grid)):
+            if value is not None:
+                conditions.append("runs.%s = ?" % column)
+                params.append(value)
+        if case is not None:
+            conditions.append("runs.caseid GLOB ?")
+            params.append(case)
+        if since is not None:
+            conditions.append("runs.run_date >= ?")
+            params.append(lid_to_date(since) or since)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        query += " ORDER BY runs.run_date DESC, runs.id DESC"
+        if last is not None:
+            query += " LIMIT ?"
+            params.append(last)
+
+        rows = [dict(row) for row in self._conn.execute(query, params)]
+        rows.reverse()
+        return rows
+
+###############################################################################
+def find_regressions(runs, threshold, window=5):
+###############################################################################
+    """
+    Return (run, relative drop) for the runs in runs (as returned by
+    query_runs) whose value is more than threshold percent below the median of
+    the previous window runs with the same machine, compiler, compset, grid
+    and pe count
+    """
+    history = {}
+    regressions = []
+    for run in runs:
+        if run["value"] is None:
+            continue
+        key = (run["machine"], run["compiler"], run["compset"], run["grid"], run["total_pes"])
+        previous = history.setdefault(key, [])
+        if previous:
+            values = sorted(previous[-window:])
+            median = values[len(values) // 2] if len(values) % 2 else \
+                (values[len(values) // 2 - 1] + values[len(values) // 2]) / 2.0
+            if median > 0 and run["value"] < median * (1.0 - threshold / 100.0):
+                regressions.append((run, 1.0 - run["value"] / median))
+        previous.append(run["value"])
+    return regressions
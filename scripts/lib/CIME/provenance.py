@@ -89,6 +89,26 @@ def save_build_provenance(case, lid=None):
         elif model == "cesm":
             save_build_provenance_cesm(case, lid=lid)
 
+def save_sharedlib_build_times(case, build_times, lid=None):
+    """
+    Record how long each shared library took to build with the build
+    provenance in EXEROOT, the run provenance archives it with the timings
+    of the run.
+    """
+    with SharedArea():
+        exeroot = case.get_value("EXEROOT")
+        lid = os.environ["LID"] if lid is None else lid
+        times_prov = os.path.join(exeroot, "sharedlib_build_times.%s.txt" % lid)
+        with open(times_prov, "w") as fd:
+            for lib, seconds in sorted(build_times.items()):
+                fd.write("%s %.2f\n" % (lib, seconds))
+
+        # Like the other build provenance, the generic name is the most recent
+        generic_name = os.path.join(exeroot, "sharedlib_build_times.txt")
+        if os.path.lexists(generic_name):
+            os.remove(generic_name)
+        os.symlink(times_prov, generic_name)
+
 def save_prerun_provenance_acme(case, lid=None):
     if not case.get_value("SAVE_TIMING"):
         return
@@ -169,7 +189,8 @@ def save_prerun_provenance_acme(case, lid=None):
     # Copy some items from build provenance
     blddir_globs_to_copy = [
         "GIT_LOGS_HEAD",
-        "build_environment.txt"
+        "build_environment.txt",
+        "sharedlib_build_times.txt"
         ]
     for blddir_glob_to_copy in blddir_globs_to_copy:
         for item in glob.glob(os.path.join(blddir, blddir_glob_to_copy)):
@@ -8,13 +8,14 @@ phases. All other phases need to handle their own status because
 they can be run outside the context of TestScheduler.
 """
 
-import traceback, stat, threading, time, glob
+import traceback, stat, threading, time, glob, collections, Queue
 from CIME.XML.standard_module_setup import *
 import CIME.compare_namelists
 import CIME.utils
 from update_acme_tests import get_recommended_test_time
 from CIME.utils import append_status, append_testlog, TESTS_FAILED_ERR_CODE, parse_test_name, get_full_test_name, get_model
 from CIME.test_status import *
+from CIME.test_status_index import create_test_index
 from CIME.XML.machines import Machines
 from CIME.XML.env_test import EnvTest
 from CIME.XML.files import Files
@@ -23,10 +24,14 @@ from CIME.XML.tests import Tests
 from CIME.case import Case
 from CIME.wait_for_tests import wait_for_tests
 from CIME.check_lockedfiles import lock_file
+from CIME.build import get_sharedlib_dir
 import CIME.test_utils
 
 logger = logging.getLogger(__name__)
 
+# Seconds between checks for Ctrl-C while waiting for a test phase to finish
+_COMPLETION_POLL_SEC = 1
+
 # Phases managed by TestScheduler
 TEST_START = "INIT" # Special pseudo-phase just for test_scheduler bookkeeping
 PHASES = [TEST_START, CREATE_NEWCASE_PHASE, XML_PHASE, SETUP_PHASE,
@@ -72,6 +77,63 @@ def _translate_test_names_for_new_pecount(test_names, force_procs, force_threads
 
     return new_test_names
 
+###############################################################################
+class _ReadyTests(object):
+###############################################################################
+    """
+    Tests whose next phase can be started, bucketed by the number of procs
+    that phase needs. Every bucket keeps its tests in the order they became
+    ready, so finding the next test to start only looks at the head of each
+    bucket instead of at every ready test.
+
+    >>> ready = _ReadyTests()
+    >>> ready.add("A", 4, 1.0, "MODEL_BUILD")
+    >>> ready.add("B", 1, 2.0, "RUN")
+    >>> ready.add("C", 4, 3.0, "MODEL_BUILD")
+    >>> ready.pop(2)
+    ('B', 1, 2.0, 'RUN')
+    >>> ready.pop(2) is None
+    True
+    >>> ready.pop(8)
+    ('A', 4, 1.0, 'MODEL_BUILD')
+    >>> [item[0] for item in ready.pop_all()], bool(ready)
+    (['C'], False)
+    """
+
+    def __init__(self):
+        self._buckets = {} # procs -> deque of (test, procs, ready time, phase)
+
+    def __nonzero__(self):
+        return bool(self._buckets)
+
+    def add(self, test, procs_needed, ready_time, phase):
+        self._buckets.setdefault(procs_needed, collections.deque()).append((test, procs_needed, ready_time, phase))
+
+    def pop(self, procs_avail):
+        """
+        Remove and return the test that has been ready the longest among
+        those that need at most procs_avail procs, None if there is none
+        """
+        oldest = None
+        for procs_needed, bucket in self._buckets.iteritems():
+            if procs_needed <= procs_avail and (oldest is None or bucket[0][2] < oldest[0][2]):
+                oldest = bucket
+        if oldest is None:
+            return None
+
+        item = oldest.popleft()
+        if not oldest:
+            del self._buckets[item[1]]
+        return item
+
+    def pop_all(self):
+        """
+        Remove and return all tests, in the order they became ready
+        """
+        items = sorted([item for bucket in self._buckets.values() for item in bucket], key=lambda item: item[2])
+        self._buckets = {}
+        return items
+
 ###############################################################################
 class TestScheduler(object):
 ###############################################################################
@@ -203,6 +265,18 @@ class TestScheduler(object):
 
         self._procs_avail = self._proc_pool
 
+        # Consumer threads put the name of their test here when they finish
+        self._completion_queue = Queue.Queue()
+
+        # Shared library directory of each test and the directories
+        # whose libraries have been built by one of the tests
+        self._sharedlib_dirs = {}
+        self._sharedlib_dirs_built = set()
+
+        # phase -> list of seconds spent waiting for resources / running
+        self._phase_wait_times = {}
+        self._phase_run_times = {}
+
         # Setup phases
         self._phases = list(PHASES)
         if self._no_setup:
@@ -606,37 +680,68 @@ class TestScheduler(object):
             return max_cores
 
         elif (phase == SHAREDLIB_BUILD_PHASE):
-            # Will force serialization of sharedlib builds
-            # TODO - instead of serializing, compute all library configs needed and build
-            # them all in parallel
-            if get_model() == "cesm":
-                for _, _, running_phase in threads_in_flight.values():
-                    if (running_phase == SHAREDLIB_BUILD_PHASE):
-                        return self._proc_pool + 1
-
-            return 1
+            # Sharedlib builds of different configurations run in parallel,
+            # builds of the same configuration are serialized and all but the
+            # first one reuse the libraries it built
+            sharedlib_dir, gmake_j = self._get_sharedlib_config(test)
+            for running_test, (_, _, running_phase) in threads_in_flight.iteritems():
+                if running_phase == SHAREDLIB_BUILD_PHASE and \
+                        self._sharedlib_dirs[running_test][0] == sharedlib_dir:
+                    return self._proc_pool + 1
+
+            if sharedlib_dir in self._sharedlib_dirs_built:
+                return 1
+            else:
+                return min(gmake_j, self._proc_pool)
         elif (phase == MODEL_BUILD_PHASE):
             # Model builds now happen in parallel
             return 4
         else:
             return 1
 
+    ###########################################################################
+    def _get_sharedlib_config(self, test):
+    ###########################################################################
+        """
+        Return the shared library directory of test and the number of make
+        jobs its build uses
+        """
+        if test not in self._sharedlib_dirs:
+            case = Case(self._get_test_dir(test))
+            sharedlib_dir = get_sharedlib_dir(case)
+            if sharedlib_dir not in [item[0] for item in self._sharedlib_dirs.values()]:
+                logger.info("Test %s is the first to need shared libraries in %s" % (test, sharedlib_dir))
+            self._sharedlib_dirs[test] = (sharedlib_dir, case.get_value("GMAKE_J"))
+
+        return self._sharedlib_dirs[test]
+
     ###########################################################################
     def _wait_for_something_to_finish(self, threads_in_flight):
     ###########################################################################
+        """
+        Block until at least one thread in flight finishes, release its
+        resources and return the names of the finished tests.
+        """
         expect(len(threads_in_flight) <= self._parallel_jobs, "Oversubscribed?")
         finished_tests = []
         while not finished_tests:
-            for test, thread_info in threads_in_flight.iteritems():
-                if not thread_info[0].is_alive():
-                    finished_tests.append((test, thread_info[1]))
-
-            if not finished_tests:
-                time.sleep(0.2)
+            # A get without timeout cannot be interrupted by Ctrl-C in python 2
+            try:
+                finished_tests.append(self._completion_queue.get(timeout=_COMPLETION_POLL_SEC))
+            except Queue.Empty:
+                pass
+        while True:
+            try:
+                finished_tests.append(self._completion_queue.get_nowait())
+            except Queue.Empty:
+                break
 
-        for finished_test, procs_needed in finished_tests:
+        for finished_test in finished_tests:
+            thread, procs_needed, _ = threads_in_flight.pop(finished_test)
+            thread.join()
             self._procs_avail += procs_needed
-            del threads_in_flight[finished_test]
+
+        return finished_tests
 
     ###########################################################################
     def _update_test_status_file(self, test, test_phase, status):
@@ -655,12 +760,16 @@ class TestScheduler(object):
         before_time = time.time()
         success, errors = self._run_catch_exceptions(test, test_phase, phase_method)
         elapsed_time = time.time() - before_time
+        self._phase_run_times.setdefault(test_phase, []).append(elapsed_time)
         status  = (TEST_PEND_STATUS if test_phase == RUN_PHASE and not \
                    self._no_batch else TEST_PASS_STATUS) if success else TEST_FAIL_STATUS
 
         if status != TEST_PEND_STATUS:
             self._update_test_status(test, test_phase, status)
 
+        if test_phase == SHAREDLIB_BUILD_PHASE and success:
+            self._sharedlib_dirs_built.add(self._sharedlib_dirs[test][0])
+
         if not self._work_remains(test):
             self._completed_tests += 1
             total = len(self._tests)
@@ -692,60 +801,112 @@ class TestScheduler(object):
             self._update_test_status(test, RUN_PHASE, TEST_PEND_STATUS)
             self._consumer(test, RUN_PHASE, self._run_phase)
 
+    ###########################################################################
+    def _consumer_thread(self, test, test_phase, phase_method):
+    ###########################################################################
+        try:
+            self._consumer(test, test_phase, phase_method)
+        finally:
+            self._completion_queue.put(test)
+
     ###########################################################################
     def _producer(self):
     ###########################################################################
         threads_in_flight = {} # test-name -> (thread, procs, phase)
-        while True:
-            work_to_do = False
-            num_threads_launched_this_iteration = 0
-            for test in self._tests:
-                logger.debug("test_name: " + test)
-                # If we have no workers available, immediately wait
-                if len(threads_in_flight) == self._parallel_jobs:
-                    self._wait_for_something_to_finish(threads_in_flight)
+        ready = _ReadyTests()
+        # Sharedlib builds in flight, sharedlib dir -> test, and the tests
+        # waiting for them because they build the same configuration
+        sharedlib_builds = {}
+        sharedlib_waiting = {}
+
+        def add_ready(test, ready_time):
+            logger.debug("test_name: " + test)
+            test_phase, test_status = self._get_test_data(test)
+            expect(test_status != TEST_PEND_STATUS, test)
+            next_phase = self._phases[self._phases.index(test_phase) + 1]
+            if next_phase == SHAREDLIB_BUILD_PHASE:
+                sharedlib_dir = self._get_sharedlib_config(test)[0]
+                if sharedlib_dir in sharedlib_builds:
+                    sharedlib_waiting.setdefault(sharedlib_dir, []).append((test, ready_time))
+                    return
+            # Builds of the same sharedlib configuration are kept apart above
+            ready.add(test, self._get_procs_needed(test, next_phase, {}), ready_time, next_phase)
 
-                if self._work_remains(test):
-                    work_to_do = True
-                    if test not in threads_in_flight:
-                        test_phase, test_status = self._get_test_data(test)
-                        expect(test_status != TEST_PEND_STATUS, test)
-                        next_phase = self._phases[self._phases.index(test_phase) + 1]
-                        procs_needed = self._get_procs_needed(test, next_phase, threads_in_flight)
-
-                        if procs_needed <= self._procs_avail:
-                            self._procs_avail -= procs_needed
-
-                            # Necessary to print this way when multiple threads printing
-                            logger.info("Starting %s for test %s with %d procs" %
-                                        (next_phase, test, procs_needed))
-
-                            self._update_test_status(test, next_phase, TEST_PEND_STATUS)
-                            new_thread = threading.Thread(target=self._consumer,
-                                args=(test, next_phase, getattr(self, "_%s_phase" % next_phase.lower())) )
-                            threads_in_flight[test] = (new_thread, procs_needed, next_phase)
-                            new_thread.start()
-                            num_threads_launched_this_iteration += 1
-                        else:
-                            if not threads_in_flight:
-                                msg = "Phase '%s' for test '%s' required more processors, %d, than this machine can provide, %d" % \
-                                    (next_phase, test, procs_needed, self._procs_avail)
-                                logger.warning(msg)
-                                self._update_test_status(test, next_phase, TEST_PEND_STATUS)
-                                self._update_test_status(test, next_phase, TEST_FAIL_STATUS)
-                                self._log_output(test, msg)
-                                self._update_test_status_file(test, next_phase, TEST_FAIL_STATUS)
-                                num_threads_launched_this_iteration += 1
-
-            if not work_to_do:
-                break
+        for test in self._tests:
+            if self._work_remains(test):
+                add_ready(test, time.time())
+
+        while ready or threads_in_flight:
+            # Start as many ready tests as resources allow, the others stay
+            # ready until the next event
+            while len(threads_in_flight) < self._parallel_jobs and self._procs_avail > 0:
+                item = ready.pop(self._procs_avail)
+                if item is None:
+                    break
 
-            if num_threads_launched_this_iteration == 0:
-                # No free resources, wait for something in flight to finish
-                self._wait_for_something_to_finish(threads_in_flight)
+                test, procs_needed, ready_time, next_phase = item
+                if next_phase == SHAREDLIB_BUILD_PHASE:
+                    sharedlib_dir = self._get_sharedlib_config(test)[0]
+                    if sharedlib_dir in sharedlib_builds:
+                        # Another test started building the same configuration
+                        sharedlib_waiting.setdefault(sharedlib_dir, []).append((test, ready_time))
+                        continue
+                    sharedlib_builds[sharedlib_dir] = test
+
+                self._procs_avail -= procs_needed
+                self._phase_wait_times.setdefault(next_phase, []).append(time.time() - ready_time)
+
+                # Necessary to print this way when multiple threads printing
+                logger.info("Starting %s for test %s with %d procs" %
+                            (next_phase, test, procs_needed))
+
+                self._update_test_status(test, next_phase, TEST_PEND_STATUS)
+                new_thread = threading.Thread(target=self._consumer_thread,
+                    args=(test, next_phase, getattr(self, "_%s_phase" % next_phase.lower())) )
+                threads_in_flight[test] = (new_thread, procs_needed, next_phase)
+                new_thread.start()
+
+            if not threads_in_flight:
+                # All procs are available, the remaining tests can never start
+                for test, procs_needed, _, next_phase in ready.pop_all():
+                    msg = "Phase '%s' for test '%s' required more processors, %d, than this machine can provide, %d" % \
+                        (next_phase, test, procs_needed, self._procs_avail)
+                    logger.warning(msg)
+                    self._update_test_status(test, next_phase, TEST_PEND_STATUS)
+                    self._update_test_status(test, next_phase, TEST_FAIL_STATUS)
+                    self._log_output(test, msg)
+                    self._update_test_status_file(test, next_phase, TEST_FAIL_STATUS)
+                continue
+
+            for test in self._wait_for_something_to_finish(threads_in_flight):
+                sharedlib_dir = self._sharedlib_dirs.get(test, (None, None))[0]
+                if sharedlib_builds.get(sharedlib_dir) == test:
+                    # The waiting tests now reuse the libraries or, if the
+                    # build failed, the first of them builds them again
+                    del sharedlib_builds[sharedlib_dir]
+                    for waiting_test, ready_time in sharedlib_waiting.pop(sharedlib_dir, []):
+                        add_ready(waiting_test, ready_time)
+                if self._work_remains(test):
+                    add_ready(test, time.time())
 
-        for unfinished_thread, _, _ in threads_in_flight.values():
-            unfinished_thread.join()
+    ###########################################################################
+    def _log_phase_timing(self):
+    ###########################################################################
+        """
+        Report, per phase, the time tests spent waiting for resources and
+        the time they spent running
+        """
+        logger.info("Phase timing (seconds):")
+        logger.info("  %-20s %6s %12s %12s %12s %12s" %
+                    ("phase", "count", "wait total", "wait max", "run total", "run max"))
+        for phase in self._phases:
+            waits = self._phase_wait_times.get(phase, [])
+            runs = self._phase_run_times.get(phase, [])
+            if waits or runs:
+                logger.info("  %-20s %6d %12.1f %12.1f %12.1f %12.1f" %
+                            (phase, max(len(waits), len(runs)),
+                             sum(waits), max(waits) if waits else 0.0,
+                             sum(runs), max(runs) if runs else 0.0))
 
     ###########################################################################
     def _setup_cs_files(self):
@@ -760,6 +921,8 @@ class TestScheduler(object):
                                         ("<TESTROOT>", self._test_root)
             if not os.path.exists(self._test_root):
                 os.makedirs(self._test_root)
+            # Status changes of the tests are recorded in the index cs.status reads
+            create_test_index(self._test_root)
             cs_status_file = os.path.join(self._test_root, "cs.status.%s" % self._test_id)
             with open(cs_status_file, "w") as fd:
                 fd.write(template)
@@ -818,6 +981,8 @@ class TestScheduler(object):
 
         expect(threading.active_count() == 1, "Leftover threads?")
 
+        self._log_phase_timing()
+
         wait_handles_report = False
         if not self._no_run and not self._no_batch:
             if wait:
@@ -21,15 +21,36 @@ Additional important design decisions:
 2) If the user repeats a core state, that invalidates all subsequent state. For
    example, if a user rebuilds their case, then any of the post-run states like the
    RUN state are no longer valid.
+3) Every change to the phase statuses is appended to a journal next to the
+   TestStatus file (.TestStatus.journal) under a file lock, and the TestStatus file
+   is then replaced atomically by a text view of the journal. Changes by other
+   writers are merged on flush instead of being overwritten, readers never see a
+   partially written TestStatus file, and long lived readers call update() to
+   consume only the journal records that were added since their last read. The
+   journal is compacted to the current state (again atomically) when it grows
+   much larger than the state.
+4) If the test root has a status index (see test_status_index.py), every flush
+   also records the overall status and current phase of the test there.
 """
 
 from CIME.XML.standard_module_setup import *
+from CIME.test_status_index import update_test_index
 
 from collections import OrderedDict
 
-import os
+import os, fcntl
 
 TEST_STATUS_FILENAME = "TestStatus"
+TEST_STATUS_JOURNAL_FILENAME = ".TestStatus.journal"
+_TEST_STATUS_LOCK_FILENAME = ".TestStatus.lock"
+
+# Journal records, one tab separated line each
+_JOURNAL_NAME = "N"   # N <test name>, the first record
+_JOURNAL_SET = "S"    # S <phase> <status> <comments>
+_JOURNAL_DEL = "D"    # D <phase>
+
+# The journal is compacted when it holds this many more records than phases
+_JOURNAL_COMPACT_SLACK = 200
 
 # The statuses that a phase can be in
 TEST_PEND_STATUS = "PEND"
@@ -98,6 +119,31 @@ def _test_helper2(file_contents, wait_for_run=False, check_throughput=False, che
                                       check_memory=check_memory,
                                       ignore_namelists=ignore_namelists)
 
+def _format_journal_record(record):
+    return "\t".join([" ".join(str(field).split()) if field else "" for field in record]) + "\n"
+
+def _apply_journal_record(phase_statuses, record):
+    if record[0] == _JOURNAL_SET:
+        phase_statuses[record[1]] = (record[2], record[3] if len(record) > 3 else "")
+    elif record[0] == _JOURNAL_DEL:
+        phase_statuses.pop(record[1], None)
+
+def _get_file_signature(filename):
+    try:
+        stat_result = os.stat(filename)
+    except OSError:
+        return None
+    return (stat_result.st_ino, stat_result.st_mtime, stat_result.st_size)
+
+def _replace_file(filename, contents):
+    """
+    Atomically replace the contents of filename
+    """
+    tmpfile = os.path.join(os.path.dirname(filename), ".%s.tmp.%d" % (os.path.basename(filename), os.getpid()))
+    with open(tmpfile, "w") as fd:
+        fd.write(contents)
+    os.rename(tmpfile, filename)
+
 class TestStatus(object):
 
     def __init__(self, test_dir=None, test_name=None, no_io=False):
@@ -111,18 +157,30 @@ class TestStatus(object):
         """
         test_dir = os.getcwd() if test_dir is None else test_dir
         self._filename = os.path.join(test_dir, TEST_STATUS_FILENAME)
+        self._journal = os.path.join(test_dir, TEST_STATUS_JOURNAL_FILENAME)
         self._phase_statuses = OrderedDict() # {name -> (status, comments)}
         self._test_name = test_name
         self._ok_to_modify = False
         self._no_io = no_io
 
-        if os.path.exists(self._filename):
+        # The state as of the last journal record read (or of the TestStatus file
+        # if there is no journal) and the changes made since then
+        self._base_statuses = OrderedDict()
+        self._pending = []
+        self._journal_id = None # (inode, offset of the next record) of the journal
+        self._journal_records = 0
+        self._view_signature = None
+
+        if not no_io and os.path.exists(self._journal):
+            self._read_journal()
+        elif os.path.exists(self._filename):
             self._parse_test_status_file()
         else:
             expect(test_name is not None, "Must provide test_name if TestStatus file doesn't exist")
 
     def __enter__(self):
         self._ok_to_modify = True
+        self.update()
         return self
 
     def __exit__(self, *_):
@@ -189,17 +247,25 @@ class TestStatus(object):
             phase_idx = ALL_PHASES.index(phase)
             for subsequent_phase in ALL_PHASES[phase_idx+1:]:
                 if subsequent_phase in self._phase_statuses:
-                    del self._phase_statuses[subsequent_phase]
+                    self._del_phase(subsequent_phase)
                 if subsequent_phase.startswith(COMPARE_PHASE):
                     for stored_phase in self._phase_statuses.keys():
                         if stored_phase.startswith(COMPARE_PHASE):
-                            del self._phase_statuses[stored_phase]
+                            self._del_phase(stored_phase)
 
-        self._phase_statuses[phase] = (status, comments) # Can overwrite old phase info
+        self._set_phase(phase, status, comments) # Can overwrite old phase info
 
         if status == TEST_PASS_STATUS and phase in CORE_PHASES and phase != CORE_PHASES[-1]:
             next_core_phase = CORE_PHASES[CORE_PHASES.index(phase)+1]
-            self._phase_statuses[next_core_phase] = (TEST_PEND_STATUS, "")
+            self._set_phase(next_core_phase, TEST_PEND_STATUS, "")
+
+    def _set_phase(self, phase, status, comments):
+        self._phase_statuses[phase] = (status, comments)
+        self._pending.append((_JOURNAL_SET, phase, status, comments))
+
+    def _del_phase(self, phase):
+        del self._phase_statuses[phase]
+        self._pending.append((_JOURNAL_DEL, phase))
 
     def get_status(self, phase):
         return self._phase_statuses[phase][0] if phase in self._phase_statuses else None
@@ -207,6 +273,26 @@ class TestStatus(object):
     def get_comment(self, phase):
         return self._phase_statuses[phase][1] if phase in self._phase_statuses else None
 
+    def get_current_phase(self):
+        r"""
+        The first phase that did not pass, or the last phase if all passed
+
+        >>> ts = TestStatus(test_dir="/", test_name="ERS.foo.A", no_io=True)
+        >>> ts._parse_test_status("PASS ERS.foo.A MODEL_BUILD\nPEND ERS.foo.A RUN")
+        >>> ts.get_current_phase()
+        'RUN'
+        >>> ts = TestStatus(test_dir="/", test_name="ERS.foo.A", no_io=True)
+        >>> ts._parse_test_status("PASS ERS.foo.A RUN\nPASS ERS.foo.A COMPARE_base_rest")
+        >>> ts.get_current_phase()
+        'COMPARE_base_rest'
+        """
+        current_phase = None
+        for phase, data in self._phase_statuses.iteritems():
+            current_phase = phase
+            if data[0] != TEST_PASS_STATUS:
+                break
+        return current_phase
+
     def phase_statuses_dump(self, prefix=''):
         """
         Args:
@@ -224,9 +310,131 @@ class TestStatus(object):
         return result
 
     def flush(self):
-        if self._phase_statuses and not self._no_io:
-            with open(self._filename, "w") as fd:
-                fd.write(self.phase_statuses_dump())
+        """
+        Merge the changes made through this object into the journal and
+        rewrite the TestStatus file. Changes that other writers made since
+        this object last read the journal are applied first.
+        """
+        if not self._phase_statuses or self._no_io:
+            return
+        if not self._pending and os.path.exists(self._journal) and os.path.exists(self._filename):
+            return
+
+        test_dir = os.path.dirname(self._filename)
+        with open(os.path.join(test_dir, _TEST_STATUS_LOCK_FILENAME), "a") as lock_fd:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(self._journal):
+                    self._read_journal(keep_pending=True)
+                else:
+                    self._journal_id = None
+
+                if self._journal_id is None or \
+                        self._journal_records + len(self._pending) > len(self._phase_statuses) + _JOURNAL_COMPACT_SLACK:
+                    self._write_compacted_journal()
+                else:
+                    data = "".join([_format_journal_record(record) for record in self._pending])
+                    fd = os.open(self._journal, os.O_WRONLY | os.O_APPEND)
+                    try:
+                        os.write(fd, data)
+                    finally:
+                        os.close(fd)
+                    self._journal_id = (self._journal_id[0], self._journal_id[1] + len(data))
+                    self._journal_records += len(self._pending)
+
+                self._base_statuses = OrderedDict(self._phase_statuses)
+                self._pending = []
+                _replace_file(self._filename, self.phase_statuses_dump())
+                update_test_index(test_dir, self._test_name, self.get_overall_test_status(),
+                                  self.get_current_phase(), os.path.getmtime(self._filename))
+            finally:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+
+    def update(self):
+        """
+        Pick up the changes that other writers made since this object last
+        read the TestStatus, only the new part of the journal is read.
+        Returns True if anything changed.
+
+        >>> import tempfile, shutil
+        >>> tmpdir = tempfile.mkdtemp()
+        >>> with TestStatus(test_dir=tmpdir, test_name="ERS.foo.A") as ts:
+        ...     ts.set_status(CREATE_NEWCASE_PHASE, "PASS")
+        >>> reader = TestStatus(test_dir=tmpdir)
+        >>> reader.update()
+        False
+        >>> with TestStatus(test_dir=tmpdir) as ts:
+        ...     ts.set_status(XML_PHASE, "FAIL")
+        >>> reader.update(), reader.get_status(XML_PHASE)
+        (True, 'FAIL')
+        >>> with ts:
+        ...     ts.set_status(XML_PHASE, "PASS")
+        >>> with reader:
+        ...     reader.set_status(SETUP_PHASE, "PASS")
+        >>> print open(os.path.join(tmpdir, TEST_STATUS_FILENAME)).read(),
+        PASS ERS.foo.A CREATE_NEWCASE
+        PASS ERS.foo.A XML
+        PASS ERS.foo.A SETUP
+        PEND ERS.foo.A SHAREDLIB_BUILD
+        >>> shutil.rmtree(tmpdir)
+        """
+        if self._no_io:
+            return False
+        old_statuses = OrderedDict(self._phase_statuses)
+        if os.path.exists(self._journal):
+            self._read_journal(keep_pending=True)
+        elif os.path.exists(self._filename) and _get_file_signature(self._filename) != self._view_signature:
+            self._phase_statuses = OrderedDict()
+            self._parse_test_status_file()
+            for record in self._pending:
+                _apply_journal_record(self._phase_statuses, record)
+        return self._phase_statuses != old_statuses
+
+    def _read_journal(self, keep_pending=False):
+        """
+        Read the journal records added since the last read, from the start if
+        the journal was compacted since then. With keep_pending, the unflushed
+        changes of this object are reapplied on top of the new state.
+        """
+        with open(self._journal, "r") as fd:
+            inode = os.fstat(fd.fileno()).st_ino
+            if self._journal_id is None or self._journal_id[0] != inode or \
+                    os.fstat(fd.fileno()).st_size < self._journal_id[1]:
+                self._base_statuses = OrderedDict()
+                self._journal_records = 0
+                offset = 0
+            else:
+                offset = self._journal_id[1]
+            fd.seek(offset)
+            data = fd.read()
+
+        # A record that is being appended right now is picked up next time
+        data = data[:data.rfind("\n") + 1]
+        for line in data.splitlines():
+            record = line.split("\t")
+            if record[0] == _JOURNAL_NAME:
+                if self._test_name is None:
+                    self._test_name = record[1]
+            else:
+                _apply_journal_record(self._base_statuses, record)
+                self._journal_records += 1
+        self._journal_id = (inode, offset + len(data))
+
+        self._phase_statuses = OrderedDict(self._base_statuses)
+        if keep_pending:
+            for record in self._pending:
+                _apply_journal_record(self._phase_statuses, record)
+        else:
+            self._pending = []
+
+    def _write_compacted_journal(self):
+        records = [(_JOURNAL_NAME, self._test_name)]
+        for phase, (status, comments) in self._phase_statuses.iteritems():
+            records.append((_JOURNAL_SET, phase, status, comments))
+        data = "".join([_format_journal_record(record) for record in records])
+        _replace_file(self._journal, data)
+        self._journal_id = (os.stat(self._journal).st_ino, len(data))
+        self._journal_records = len(records) - 1
 
     def _parse_test_status(self, file_contents):
         """
@@ -265,8 +473,10 @@ class TestStatus(object):
                 logging.warning("In TestStatus file for test '%s', line '%s' not in expected format" % (self._test_name, line))
 
     def _parse_test_status_file(self):
+        self._view_signature = _get_file_signature(self._filename)
         with open(self._filename, "r") as fd:
             self._parse_test_status(fd.read())
+        self._base_statuses = OrderedDict(self._phase_statuses)
 
     def get_overall_test_status(self, wait_for_run=False, check_throughput=False, check_memory=False, ignore_namelists=False, ignore_memleak=False):
         r"""
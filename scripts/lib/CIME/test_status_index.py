@@ -0,0 +1,243 @@
+"""
+Index of the tests in a test root. Once a test root has an index (TestScheduler
+creates one in every test root it uses, --rebuild-index of the status tools
+creates one in older test roots), every status change made through TestStatus
+appends a record with the test name, test id, overall status, current phase
+and TestStatus mtime of the test to <test_root>/.test_status_index. Tools like
+cs.status then answer from this single file instead of listing the test root
+and parsing the TestStatus file of every test in it.
+
+The index is append only; the last record of a test directory wins. Writers
+and the compaction that drops the superseded records are serialized with a
+lock file, readers never lock.
+"""
+
+from CIME.XML.standard_module_setup import *
+
+from collections import namedtuple
+
+import fcntl
+
+TEST_STATUS_INDEX_FILENAME = ".test_status_index"
+_TEST_STATUS_INDEX_LOCK_FILENAME = ".test_status_index.lock"
+
+# Compact once the index holds this many more records than tests
+_INDEX_COMPACT_SLACK = 1000
+
+logger = logging.getLogger(__name__)
+
+# test_dir is the name of the test directory within the test root
+TestIndexEntry = namedtuple("TestIndexEntry", ["test_dir", "test_name", "test_id", "status", "phase", "mtime"])
+
+###############################################################################
+def get_test_index_path(test_root):
+###############################################################################
+    return os.path.join(test_root, TEST_STATUS_INDEX_FILENAME)
+
+###############################################################################
+def get_test_id(test_dir):
+###############################################################################
+    """
+    The test id of a test directory, the last component of its name
+
+    >>> get_test_id("/scratch/ERS.f19_g16.A.yellowstone_intel.20161018_101010")
+    '20161018_101010'
+    """
+    return os.path.basename(os.path.normpath(test_dir)).split(".")[-1]
+
+###############################################################################
+def has_test_status(test_dir):
+###############################################################################
+    """
+    Whether test_dir holds the status of a test. Removed tests keep their
+    records in the index until it is rebuilt, readers skip them with this.
+    """
+    from CIME.test_status import TEST_STATUS_FILENAME, TEST_STATUS_JOURNAL_FILENAME
+
+    return os.path.isfile(os.path.join(test_dir, TEST_STATUS_FILENAME)) or \
+        os.path.isfile(os.path.join(test_dir, TEST_STATUS_JOURNAL_FILENAME))
+
+###############################################################################
+def index_entry_is_current(test_root, entry):
+###############################################################################
+    """
+    Whether entry still describes its test, i.e. the TestStatus file of the
+    test exists and was not changed since the entry was recorded, e.g. by
+    older versions that do not update the index
+    """
+    from CIME.test_status import TEST_STATUS_FILENAME
+
+    try:
+        mtime = os.path.getmtime(os.path.join(test_root, entry.test_dir, TEST_STATUS_FILENAME))
+    except OSError:
+        return False
+    # Compared like recorded in the index, entries of a rebuild hold the exact mtime
+    return "%.2f" % mtime == "%.2f" % entry.mtime
+
+###############################################################################
+def _format_index_record(entry):
+###############################################################################
+    """
+    >>> _format_index_record(TestIndexEntry("ERS.foo.A.T1", "ERS.foo.A", "T1", "PEND", "RUN", 1476792000.5))
+    'ERS.foo.A.T1\\tERS.foo.A\\tT1\\tPEND\\tRUN\\t1476792000.50\\n'
+    """
+    return "%s\t%s\t%s\t%s\t%s\t%.2f\n" % entry
+
+###############################################################################
+def _parse_index(contents):
+###############################################################################
+    """
+    Return (entries, number of records) of the index contents, the last
+    record of a test directory wins. A partially written last record is ignored.
+
+    >>> entries, records = _parse_index("A.T1\\tA\\tT1\\tPEND\\tRUN\\t1.00\\nB.T1\\tB\\tT1\\tPASS\\tRUN\\t2.00\\n"
+    ...                                 "A.T1\\tA\\tT1\\tFAIL\\tRUN\\t3.00\\nC.T2\\tC\\tT2")
+    >>> records, [(entry.test_dir, entry.status, entry.mtime) for entry in sorted(entries.values())]
+    (3, [('A.T1', 'FAIL', 3.0), ('B.T1', 'PASS', 2.0)])
+    """
+    entries = {}
+    records = 0
+    num_fields = len(TestIndexEntry._fields)
+    # The last item is empty or a partially written record
+    for line in contents.split("\n")[:-1]:
+        fields = line.split("\t")
+        if len(fields) != num_fields:
+            continue
+        try:
+            fields[-1] = float(fields[-1])
+        except ValueError:
+            continue
+        entries[fields[0]] = TestIndexEntry._make(fields)
+        records += 1
+    return entries, records
+
+###############################################################################
+def _write_index(test_root, entries):
+###############################################################################
+    """
+    Atomically replace the index, the caller holds the lock
+    """
+    index_path = get_test_index_path(test_root)
+    tmpfile = os.path.join(test_root, ".%s.tmp.%d" % (TEST_STATUS_INDEX_FILENAME, os.getpid()))
+    with open(tmpfile, "w") as fd:
+        fd.write("".join([_format_index_record(entry) for entry in entries]))
+    os.rename(tmpfile, index_path)
+
+###############################################################################
+class _IndexLock(object):
+###############################################################################
+
+    def __init__(self, test_root, blocking=True):
+        self._lock_path = os.path.join(test_root, _TEST_STATUS_INDEX_LOCK_FILENAME)
+        self._blocking = blocking
+        self._fd = None
+        self.acquired = False
+
+    def __enter__(self):
+        self._fd = open(self._lock_path, "a")
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX if self._blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self.acquired = True
+        except IOError:
+            if self._blocking:
+                raise
+        return self
+
+    def __exit__(self, *_):
+        if self.acquired:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._fd.close()
+
+###############################################################################
+def create_test_index(test_root):
+###############################################################################
+    """
+    Make sure test_root has an index, so that the status changes of its tests
+    are recorded. Tests already in test_root are added to a new index.
+    """
+    if not os.path.exists(get_test_index_path(test_root)):
+        rebuild_test_index(test_root)
+
+###############################################################################
+def update_test_index(test_dir, test_name, status, phase, mtime):
+###############################################################################
+    """
+    Record the status of the test in test_dir in the index of its test root.
+    Does nothing if the test root has no index.
+    """
+    test_root = os.path.dirname(os.path.abspath(test_dir))
+    index_path = get_test_index_path(test_root)
+    if not os.path.exists(index_path):
+        return
+
+    test_dir = os.path.basename(os.path.abspath(test_dir))
+    record = _format_index_record(TestIndexEntry(test_dir, test_name, get_test_id(test_dir), status, phase, mtime))
+    try:
+        # The lock keeps the record from being appended to an index that is
+        # being replaced by a compaction or a rebuild
+        with _IndexLock(test_root):
+            fd = os.open(index_path, os.O_WRONLY | os.O_APPEND)
+            try:
+                os.write(fd, record)
+            finally:
+                os.close(fd)
+    except (IOError, OSError) as e:
+        # e.g. a test root shared with other users, the test itself is not affected
+        logger.debug("Could not update test status index %s: %s" % (index_path, e))
+
+###############################################################################
+def read_test_index(test_root):
+###############################################################################
+    """
+    Return a dict test directory name -> TestIndexEntry of the tests in
+    test_root, or None if test_root has no index
+    """
+    index_path = get_test_index_path(test_root)
+    try:
+        with open(index_path, "r") as fd:
+            contents = fd.read()
+    except IOError:
+        return None
+
+    entries, records = _parse_index(contents)
+    if records > len(entries) + _INDEX_COMPACT_SLACK:
+        try:
+            with _IndexLock(test_root, blocking=False) as lock:
+                # Only compact if no record was appended since the index was read
+                if lock.acquired and os.path.getsize(index_path) == len(contents):
+                    _write_index(test_root, sorted(entries.values()))
+        except (IOError, OSError) as e:
+            logger.debug("Could not compact test status index %s: %s" % (index_path, e))
+
+    return entries
+
+###############################################################################
+def rebuild_test_index(test_root):
+###############################################################################
+    """
+    Recreate the index of test_root from the TestStatus files of the tests in
+    it. This is the recovery path for test roots that were used before they
+    had an index or whose tests were changed or removed by other means.
+    Returns the new entries like read_test_index.
+    """
+    from CIME.test_status import TestStatus, TEST_STATUS_FILENAME
+
+    entries = {}
+    for test_dir in sorted(os.listdir(test_root)):
+        full_test_dir = os.path.join(test_root, test_dir)
+        status_file = os.path.join(full_test_dir, TEST_STATUS_FILENAME)
+        if not has_test_status(full_test_dir):
+            continue
+        try:
+            ts = TestStatus(test_dir=full_test_dir)
+            mtime = os.path.getmtime(status_file) if os.path.isfile(status_file) else 0.0
+        except (SystemExit, Exception) as e: # pylint: disable=broad-except
+            logger.warning("Skipping %s in test status index: %s" % (full_test_dir, e))
+            continue
+        entries[test_dir] = TestIndexEntry(test_dir, ts.get_name(), get_test_id(test_dir),
+                                           ts.get_overall_test_status(), ts.get_current_phase(), mtime)
+
+    with _IndexLock(test_root):
+        _write_index(test_root, sorted(entries.values()))
+    logger.info("Rebuilt test status index of %s with %d tests" % (test_root, len(entries)))
+    return entries
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+import unittest
+import shutil
+import tempfile
+import threading
+import time
+import os
+from CIME.utils import get_cime_root
+from CIME.build import _build_in_dependency_order, _get_sharedlib_dependencies
+from CIME.tests.case_fake import CaseFake
+
+# ========================================================================
+# Define some parameters
+# ========================================================================
+
+_SHAREDLIBS = ["mpi-serial", "gptl", "mct", "pio", "csm_share"]
+
+class TestSharedlibBuildOrder(unittest.TestCase):
+
+    # ========================================================================
+    # Test helper functions
+    # ========================================================================
+
+    def setUp(self):
+        self._tmpdir = tempfile.mkdtemp()
+        self._case = CaseFake(os.path.join(self._tmpdir, "case"))
+        self._casetools = os.path.join(self._tmpdir, "case", "Tools")
+        os.makedirs(self._casetools)
+        self._case.set_value("CASETOOLS", self._casetools)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+    def useMakefile(self, model):
+        """Copy the machines Makefile of model into the case Tools directory"""
+        shutil.copy(os.path.join(get_cime_root(), "config", model, "machines", "Makefile"),
+                    self._casetools)
+
+    def buildInOrder(self, dependencies, max_parallel=len(_SHAREDLIBS)):
+        """Build fake libraries, return {lib: (start time, end time)}"""
+        times = {}
+        lock = threading.Lock()
+
+        def build(lib):
+            start = time.time()
+            time.sleep(0.05)
+            with lock:
+                times[lib] = (start, time.time())
+            return None
+
+        errors = _build_in_dependency_order(_SHAREDLIBS, dependencies, max_parallel, build)
+        self.assertEqual(errors, [])
+        return times
+
+    def assertBuiltAfterDependencies(self, dependencies, times):
+        for lib, deps in dependencies.items():
+            for dep in deps:
+                self.assertTrue(times[dep][1] <= times[lib][0],
+                                msg="%s started before %s finished" % (lib, dep))
+
+    # ========================================================================
+    # Begin actual tests
+    # ========================================================================
+
+    def test_pio_after_gptl(self):
+        for model in ("cesm", "acme"):
+            self.useMakefile(model)
+            dependencies = _get_sharedlib_dependencies(self._case, _SHAREDLIBS)
+
+            # $(PIOLIB) : $(MPISERIAL) $(GPTLLIB)
+            self.assertEqual(sorted(dependencies["pio"]), ["gptl", "mpi-serial"])
+            self.assertEqual(sorted(dependencies["csm_share"]), ["gptl", "mct", "pio"])
+            self.assertEqual(dependencies["gptl"], ["mpi-serial"])
+
+            times = self.buildInOrder(dependencies)
+            self.assertBuiltAfterDependencies(dependencies, times)
+
+    def test_independent_libs_in_parallel(self):
+        self.useMakefile("cesm")
+        dependencies = _get_sharedlib_dependencies(self._case, _SHAREDLIBS)
+        times = self.buildInOrder(dependencies)
+
+        # gptl and mct only depend on mpi-serial
+        self.assertTrue(times["gptl"][0] < times["mct"][1] and times["mct"][0] < times["gptl"][1])
+
+    def test_serial_without_makefile(self):
+        dependencies = _get_sharedlib_dependencies(self._case, _SHAREDLIBS)
+        times = self.buildInOrder(dependencies)
+
+        starts = sorted(_SHAREDLIBS, key=lambda lib: times[lib][0])
+        self.assertEqual(starts, _SHAREDLIBS)
+        self.assertBuiltAfterDependencies(dependencies, times)
+
+if __name__ == '__main__':
+    unittest.main()
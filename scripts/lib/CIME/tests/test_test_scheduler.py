@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import unittest
+from CIME.test_scheduler import TestScheduler, SHAREDLIB_BUILD_PHASE, MODEL_BUILD_PHASE
+
+# ========================================================================
+# Define some parameters
+# ========================================================================
+
+_PROC_POOL = 16
+_GMAKE_J = 8
+
+class TestSharedlibBuildScheduling(unittest.TestCase):
+
+    # ========================================================================
+    # Test helper functions
+    # ========================================================================
+
+    def setUp(self):
+        # Only the state used by the sharedlib scheduling, setting up a real
+        # TestScheduler needs a configured machine
+        self._scheduler = TestScheduler.__new__(TestScheduler)
+        self._scheduler._proc_pool = _PROC_POOL
+        self._scheduler._sharedlib_dirs = {}
+        self._scheduler._sharedlib_dirs_built = set()
+        self._threads_in_flight = {}
+
+    def addTest(self, test, sharedlib_dir):
+        self._scheduler._sharedlib_dirs[test] = (sharedlib_dir, _GMAKE_J)
+
+    def startPhase(self, test, phase):
+        self._threads_in_flight[test] = (None, 1, phase)
+
+    def procsNeeded(self, test):
+        return self._scheduler._get_procs_needed(test, SHAREDLIB_BUILD_PHASE, self._threads_in_flight)
+
+    # ========================================================================
+    # Begin actual tests
+    # ========================================================================
+
+    def test_distinct_configs_in_parallel(self):
+        self.addTest("A", "/sharedlibroot/gnu/openmpi/nodebug/nothreads")
+        self.addTest("B", "/sharedlibroot/gnu/openmpi/debug/nothreads")
+        self.startPhase("A", SHAREDLIB_BUILD_PHASE)
+
+        self.assertEqual(self.procsNeeded("B"), _GMAKE_J)
+
+    def test_same_config_waits_then_reuses(self):
+        self.addTest("A", "/sharedlibroot/gnu/openmpi/nodebug/nothreads")
+        self.addTest("B", "/sharedlibroot/gnu/openmpi/nodebug/nothreads")
+        self.startPhase("A", SHAREDLIB_BUILD_PHASE)
+
+        # More procs than the pool holds, B cannot start while A builds
+        self.assertTrue(self.procsNeeded("B") > _PROC_POOL)
+
+        # Once A built the libraries, B only reuses them
+        del self._threads_in_flight["A"]
+        self._scheduler._sharedlib_dirs_built.add("/sharedlibroot/gnu/openmpi/nodebug/nothreads")
+        self.assertEqual(self.procsNeeded("B"), 1)
+
+    def test_other_phases_do_not_block(self):
+        self.addTest("A", "/sharedlibroot/gnu/openmpi/nodebug/nothreads")
+        self.addTest("B", "/sharedlibroot/gnu/openmpi/nodebug/nothreads")
+        self.startPhase("A", MODEL_BUILD_PHASE)
+
+        self.assertEqual(self.procsNeeded("B"), _GMAKE_J)
+
+    def test_gmake_j_limited_by_pool(self):
+        self._scheduler._proc_pool = _GMAKE_J // 2
+        self.addTest("A", "/sharedlibroot/gnu/openmpi/nodebug/nothreads")
+
+        self.assertEqual(self.procsNeeded("A"), _GMAKE_J // 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+import unittest
+import multiprocessing
+import shutil
+import tempfile
+import os
+from CIME.test_status import *
+
+# ========================================================================
+# Define some parameters
+# ========================================================================
+
+_TEST_NAME = "ERS.f19_g16_rx1.A.fake_testing_only"
+_NUM_WRITERS = 4
+_NUM_PHASES = 5
+
+def _write_compare_phases(test_dir, writer):
+    """Set the COMPARE phases of one writer, reopening the TestStatus every time"""
+    for idx in range(3 * _NUM_PHASES):
+        with TestStatus(test_dir=test_dir) as ts:
+            ts.set_status("COMPARE_w%d_%d" % (writer, idx % _NUM_PHASES),
+                          TEST_PASS_STATUS if idx % 2 else TEST_FAIL_STATUS,
+                          comments="idx=%d" % idx)
+
+class TestTestStatusJournal(unittest.TestCase):
+
+    # ========================================================================
+    # Test helper functions
+    # ========================================================================
+
+    def setUp(self):
+        self._test_dir = tempfile.mkdtemp()
+        with TestStatus(test_dir=self._test_dir, test_name=_TEST_NAME) as ts:
+            ts.set_status(CREATE_NEWCASE_PHASE, TEST_PASS_STATUS)
+
+    def tearDown(self):
+        shutil.rmtree(self._test_dir, ignore_errors=True)
+
+    def assertSameStatuses(self, ts1, ts2):
+        self.assertEqual(list(ts1), list(ts2))
+        for phase, _ in ts1:
+            self.assertEqual(ts1.get_comment(phase), ts2.get_comment(phase))
+
+    def readTestStatusFile(self):
+        """Parse the TestStatus text view without the journal"""
+        ts = TestStatus(test_dir="/", test_name=_TEST_NAME)
+        with open(os.path.join(self._test_dir, TEST_STATUS_FILENAME), "r") as fd:
+            ts._parse_test_status(fd.read())
+        return ts
+
+    # ========================================================================
+    # Begin actual tests
+    # ========================================================================
+
+    def test_merge_of_overlapping_writers(self):
+        ts1 = TestStatus(test_dir=self._test_dir)
+        ts2 = TestStatus(test_dir=self._test_dir)
+        with ts1:
+            ts1.set_status(XML_PHASE, TEST_PASS_STATUS)
+            with ts2:
+                ts2.set_status("COMPARE_base_rest", TEST_FAIL_STATUS)
+
+        ts = TestStatus(test_dir=self._test_dir)
+        self.assertEqual(ts.get_status(CREATE_NEWCASE_PHASE), TEST_PASS_STATUS)
+        self.assertEqual(ts.get_status(XML_PHASE), TEST_PASS_STATUS)
+        self.assertEqual(ts.get_status("COMPARE_base_rest"), TEST_FAIL_STATUS)
+        self.assertSameStatuses(ts, self.readTestStatusFile())
+
+    def test_concurrent_writers(self):
+        reader = TestStatus(test_dir=self._test_dir)
+        writers = [multiprocessing.Process(target=_write_compare_phases, args=(self._test_dir, writer))
+                   for writer in range(_NUM_WRITERS)]
+        for writer in writers:
+            writer.start()
+        while any([writer.is_alive() for writer in writers]):
+            reader.update()
+        for writer in writers:
+            writer.join()
+            self.assertEqual(writer.exitcode, 0)
+        reader.update()
+
+        ts = TestStatus(test_dir=self._test_dir)
+        for writer in range(_NUM_WRITERS):
+            for idx in range(_NUM_PHASES):
+                # The last of the three updates of the phase wins
+                phase = "COMPARE_w%d_%d" % (writer, idx)
+                last = 2 * _NUM_PHASES + idx
+                self.assertEqual(ts.get_status(phase), TEST_PASS_STATUS if last % 2 else TEST_FAIL_STATUS)
+                self.assertEqual(ts.get_comment(phase), "idx=%d" % last)
+
+        self.assertSameStatuses(reader, ts)
+        self.assertSameStatuses(ts, self.readTestStatusFile())
+
+    def test_legacy_test_status_file(self):
+        shutil.rmtree(self._test_dir)
+        os.makedirs(self._test_dir)
+        with open(os.path.join(self._test_dir, TEST_STATUS_FILENAME), "w") as fd:
+            fd.write("PASS %s %s\nPEND %s %s\n" % (_TEST_NAME, CREATE_NEWCASE_PHASE, _TEST_NAME, XML_PHASE))
+
+        with TestStatus(test_dir=self._test_dir) as ts:
+            ts.set_status(XML_PHASE, TEST_PASS_STATUS)
+
+        ts = TestStatus(test_dir=self._test_dir)
+        self.assertEqual(ts.get_name(), _TEST_NAME)
+        self.assertEqual(ts.get_status(CREATE_NEWCASE_PHASE), TEST_PASS_STATUS)
+        self.assertEqual(ts.get_status(XML_PHASE), TEST_PASS_STATUS)
+        self.assertTrue(os.path.isfile(os.path.join(self._test_dir, TEST_STATUS_JOURNAL_FILENAME)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,13 +2,17 @@
 Common functions used by cime python scripts
 Warning: you cannot use CIME Classes in this module as it causes circular dependencies
 """
-import logging, gzip, sys, os, time, re, shutil, glob, string, random
+import logging, gzip, sys, os, time, re, shutil, glob, string, random, StringIO, multiprocessing
+import cPickle, traceback
 import stat as statlib
 import warnings
 # Return this error code if the scripts worked but tests failed
 TESTS_FAILED_ERR_CODE = 100
 logger = logging.getLogger(__name__)
 
+# The filter that warnings.simplefilter("ignore") adds
+_IGNORE_ALL_WARNINGS = ("ignore", None, Warning, None, 0)
+
 def expect(condition, error_msg, exc_type=SystemExit, error_prefix="ERROR:"):
     """
     Similar to assert except doesn't generate an ugly stacktrace. Useful for
@@ -21,7 +25,10 @@ def expect(condition, error_msg, exc_type=SystemExit, error_prefix="ERROR:"):
     SystemExit: ERROR: error2
     """
     # Without this line we get a futurewarning on the use of condition below
-    warnings.filterwarnings("ignore")
+    # (only add the filter once, python 2 does not remove duplicate filters
+    # so the list of filters would grow with every call)
+    if not warnings.filters or warnings.filters[0] != _IGNORE_ALL_WARNINGS:
+        warnings.simplefilter("ignore")
     if not condition:
         if logger.isEnabledFor(logging.DEBUG):
             import pdb
@@ -1258,3 +1265,78 @@ class SharedArea(object):
 
     def __exit__(self, *_):
         os.umask(self._orig_umask)
+
+###############################################################################
+def run_in_pool(func, args_list, parallel):
+###############################################################################
+    """
+    Call func(*args) for each args in args_list, using up to parallel processes.
+    Yields (result, output, elapsed) in the order of args_list as soon as the
+    results are available, where output is what func printed to stdout.
+
+    An exception raised by func, including the SystemExit of a failed expect,
+    is raised again here after printing the output of that call.
+
+    >>> [result for result, _, _ in run_in_pool(int, [("1",), ("2",)], 2)]
+    [1, 2]
+    >>> list(run_in_pool(expect, [(True, "ok"), (False, "failed")], 2))
+    Traceback (most recent call last):
+        ...
+    SystemExit: ERROR: failed
+    """
+    if parallel <= 1:
+        for args in args_list:
+            start = time.time()
+            result = func(*args)
+            yield result, "", time.time() - start
+    else:
+        pool = multiprocessing.Pool(parallel)
+        try:
+            for result, output, elapsed, error in pool.imap(_call_captured, [(func, args) for args in args_list]):
+                if error is not None:
+                    pool.terminate()
+                    sys.stdout.write(output)
+                    raise error
+                yield result, output, elapsed
+        finally:
+            pool.close()
+            pool.join()
+
+###############################################################################
+def _call_captured(func_and_args):
+###############################################################################
+    """
+    Pool worker of run_in_pool. Exceptions are returned rather than raised,
+    a worker process exiting on SystemExit would leave the pool waiting for
+    its result forever.
+    """
+    func, args = func_and_args
+    start = time.time()
+    stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+    result, error = None, None
+    try:
+        result = func(*args)
+    except (SystemExit, Exception) as e:
+        error = e
+        try:
+            cPickle.dumps(error)
+        except Exception:
+            error = RuntimeError("%s raised an exception:\n%s" % (func.__name__, traceback.format_exc()))
+    finally:
+        output = sys.stdout.getvalue()
+        sys.stdout = stdout
+    return result, output, time.time() - start, error
+
+###############################################################################
+def print_timing_summary(timings, start_time):
+###############################################################################
+    """
+    Print the time spent on each test, timings is a list of (test_name, seconds)
+    """
+    if not timings:
+        return
+    print "Timing summary:"
+    for test_name, elapsed in timings:
+        print "  %8.1f seconds %s" % (elapsed, test_name)
+    print "  %8.1f seconds total (%.1f seconds wall clock)" % \
+        (sum([elapsed for _, elapsed in timings]), time.time() - start_time)
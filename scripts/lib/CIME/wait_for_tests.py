@@ -1,4 +1,4 @@
-import os, time, threading, Queue, socket, signal, distutils.spawn, shutil, glob
+import os, time, socket, signal, distutils.spawn, shutil, glob, select, errno, struct
 import logging
 import xml.etree.ElementTree as xmlet
 
@@ -10,7 +10,11 @@ from CIME.test_status import *
 SIGNAL_RECEIVED           = False
 ACME_MAIN_CDASH           = "ACME_Climate"
 CDASH_DEFAULT_BUILD_GROUP = "ACME_Latest"
-SLEEP_INTERVAL_SEC        = .1
+SLEEP_INTERVAL_SEC        = 1
+# With inotify, changes are seen as they happen, but a file system that does
+# not deliver inotify events (e.g. NFS written from another node) is still
+# scanned this often
+INOTIFY_SCAN_INTERVAL_SEC = 5
 
 ###############################################################################
 def signal_handler(*_):
@@ -258,57 +262,225 @@ NightlyStartTime: %s UTC
     CIME.utils.run_cmd_no_fail("ctest -VV -D NightlySubmit", verbose=True)
 
 ###############################################################################
-def wait_for_test(test_path, results, wait, check_throughput, check_memory, ignore_namelists, ignore_memleak):
+class _InotifyWatcher(object):
+###############################################################################
+    """
+    Minimal inotify interface, through ctypes so that no extra python
+    package is needed. Raises OSError if inotify is not available.
+    """
+
+    _IN_MODIFY      = 0x00000002
+    _IN_CLOSE_WRITE = 0x00000008
+    _IN_MOVED_TO    = 0x00000080
+    _IN_CREATE      = 0x00000100
+    _EVENT_HEADER   = struct.Struct("iIII")
+
+    def __init__(self):
+        import ctypes, ctypes.util
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError(errno.ENOSYS, "libc not found")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, "inotify_init"):
+            raise OSError(errno.ENOSYS, "inotify not supported")
+        self._fd = self._libc.inotify_init()
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self._watched_dirs = {}
+
+    def add_watch(self, dirpath):
+        """
+        Watch dirpath for files being written, returns False if it cannot be watched
+        """
+        mask = self._IN_MODIFY | self._IN_CLOSE_WRITE | self._IN_MOVED_TO | self._IN_CREATE
+        wd = self._libc.inotify_add_watch(self._fd, dirpath, mask)
+        if wd < 0:
+            return False
+        self._watched_dirs[wd] = dirpath
+        return True
+
+    def read_events(self, timeout):
+        """
+        Wait up to timeout seconds for events, returns the set of
+        (dirpath, filename) that changed
+        """
+        changed = set()
+        try:
+            readable = select.select([self._fd], [], [], timeout)[0]
+        except select.error as e:
+            # Interrupted by a signal
+            if e.args[0] == errno.EINTR:
+                return changed
+            raise
+
+        if readable:
+            data = os.read(self._fd, 64 * 1024)
+            offset = 0
+            while offset < len(data):
+                wd, _, _, name_len = self._EVENT_HEADER.unpack_from(data, offset)
+                offset += self._EVENT_HEADER.size
+                name = data[offset:offset + name_len].rstrip("\0")
+                offset += name_len
+                if wd in self._watched_dirs:
+                    changed.add((self._watched_dirs[wd], name))
+
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+###############################################################################
+def _get_test_status_filepath(test_path):
 ###############################################################################
     if (os.path.isdir(test_path)):
-        test_status_filepath = os.path.join(test_path, TEST_STATUS_FILENAME)
+        return os.path.join(test_path, TEST_STATUS_FILENAME)
     else:
-        test_status_filepath = test_path
+        return test_path
 
-    logging.debug("Watching file: '%s'" % test_status_filepath)
+###############################################################################
+def _get_file_signature(filepath):
+###############################################################################
+    try:
+        stat_result = os.stat(filepath)
+    except OSError:
+        return None
+    # The inode changes when the file is replaced by a rename, even within
+    # the mtime resolution and with the same size
+    return (stat_result.st_mtime, stat_result.st_size, stat_result.st_ino)
 
-    while (True):
-        if (os.path.exists(test_status_filepath)):
+###############################################################################
+def _check_test(test_path, test_status_filepath, final, check_throughput, check_memory, ignore_namelists, ignore_memleak,
+                test_statuses=None):
+###############################################################################
+    """
+    Returns (test_name, test_path, test_status) if the test is finished, or
+    if final is True, otherwise None. test_statuses (test status filepath ->
+    TestStatus) keeps the TestStatus objects between checks so that only the
+    changes since the previous check are read.
+    """
+    if (os.path.exists(test_status_filepath)):
+        ts = None if test_statuses is None else test_statuses.get(test_status_filepath)
+        if (ts is None):
             ts = TestStatus(test_dir=os.path.dirname(test_status_filepath))
-            test_name = ts.get_name()
-            test_status = ts.get_overall_test_status(wait_for_run=True, # Important
-                                                     check_throughput=check_throughput,
-                                                     check_memory=check_memory, ignore_namelists=ignore_namelists,
-                                                     ignore_memleak=ignore_memleak)
-
-            if (test_status == TEST_PEND_STATUS and (wait and not SIGNAL_RECEIVED)):
-                time.sleep(SLEEP_INTERVAL_SEC)
-                logging.debug("Waiting for test to finish")
-            else:
-                results.put( (test_name, test_path, test_status) )
-                break
-
+            if (test_statuses is not None):
+                test_statuses[test_status_filepath] = ts
         else:
-            if (wait and not SIGNAL_RECEIVED):
-                logging.debug("File '%s' does not yet exist" % test_status_filepath)
-                time.sleep(SLEEP_INTERVAL_SEC)
-            else:
-                test_name = os.path.abspath(test_status_filepath).split("/")[-2]
-                results.put( (test_name, test_path, "File '%s' doesn't exist" % test_status_filepath) )
-                break
+            ts.update()
+        test_name = ts.get_name()
+        test_status = ts.get_overall_test_status(wait_for_run=True, # Important
+                                                 check_throughput=check_throughput,
+                                                 check_memory=check_memory, ignore_namelists=ignore_namelists,
+                                                 ignore_memleak=ignore_memleak)
+
+        if (test_status == TEST_PEND_STATUS and not final):
+            logging.debug("Waiting for test to finish")
+            return None
+        else:
+            return (test_name, test_path, test_status)
+
+    elif (not final):
+        logging.debug("File '%s' does not yet exist" % test_status_filepath)
+        return None
+
+    else:
+        test_name = os.path.abspath(test_status_filepath).split("/")[-2]
+        return (test_name, test_path, "File '%s' doesn't exist" % test_status_filepath)
 
 ###############################################################################
 def wait_for_tests_impl(test_paths, no_wait=False, check_throughput=False, check_memory=False, ignore_namelists=False, ignore_memleak=False):
 ###############################################################################
-    results = Queue.Queue()
-
+    """
+    Watch the TestStatus files of all tests from a single loop, a TestStatus
+    file is only re-parsed after it changed. Changes are picked up through
+    inotify when it is available and by periodically checking the mtime and
+    size of the files of unfinished tests.
+    """
+    # test status filepath -> test path, for all tests that are not finished
+    pending = {}
     for test_path in test_paths:
-        t = threading.Thread(target=wait_for_test, args=(test_path, results, not no_wait, check_throughput, check_memory, ignore_namelists, ignore_memleak))
-        t.daemon = True
-        t.start()
+        test_status_filepath = _get_test_status_filepath(test_path)
+        logging.debug("Watching file: '%s'" % test_status_filepath)
+        pending[test_status_filepath] = test_path
+
+    watcher = None
+    scan_interval = SLEEP_INTERVAL_SEC
+    if (not no_wait):
+        try:
+            watcher = _InotifyWatcher()
+            for test_status_filepath in pending:
+                if (not watcher.add_watch(os.path.dirname(os.path.abspath(test_status_filepath)))):
+                    logging.debug("Could not watch '%s', relying on scanning" % test_status_filepath)
+            scan_interval = INOTIFY_SCAN_INTERVAL_SEC
+        except OSError as e:
+            logging.debug("inotify not available (%s), relying on scanning" % e)
+            watcher = None
+
+    signatures = {}
+    test_statuses = {}
+    to_check = set(pending)
+    next_scan = time.time() + scan_interval
+    results = []
+    num_tests = len(pending)
+    try:
+        while (pending):
+            final = no_wait or SIGNAL_RECEIVED
+            if (final):
+                to_check = set(pending)
+
+            for test_status_filepath in sorted(to_check):
+                if (test_status_filepath not in pending):
+                    continue
+
+                signatures[test_status_filepath] = _get_file_signature(test_status_filepath)
+                try:
+                    result = _check_test(pending[test_status_filepath], test_status_filepath, final,
+                                         check_throughput, check_memory, ignore_namelists, ignore_memleak,
+                                         test_statuses)
+                except (SystemExit, IOError) as e:
+                    if (final):
+                        raise
+                    # Most likely caught the file while it was being written, retry
+                    # on the next scan
+                    logging.debug("Could not read '%s': %s" % (test_status_filepath, e))
+                    del signatures[test_status_filepath]
+                    test_statuses.pop(test_status_filepath, None)
+                    result = None
+
+                if (result is not None):
+                    del pending[test_status_filepath]
+                    test_statuses.pop(test_status_filepath, None)
+                    results.append(result)
+                    logging.info("Finished test '%s' with status '%s' (%d of %d)" %
+                                 (result[0], result[2], len(results), num_tests))
+
+            if (final):
+                break
 
-    while threading.active_count() > 1:
-        time.sleep(1)
+            # Wait for something to change
+            to_check = set()
+            if (pending and watcher is not None):
+                pending_by_dir = {}
+                for test_status_filepath in pending:
+                    pending_by_dir.setdefault(os.path.dirname(os.path.abspath(test_status_filepath)), []).append(test_status_filepath)
+                for dirpath, filename in watcher.read_events(max(0, next_scan - time.time())):
+                    if (filename.startswith(TEST_STATUS_FILENAME)):
+                        to_check.update(pending_by_dir.get(dirpath, []))
+            elif (pending):
+                time.sleep(max(0, next_scan - time.time()))
+
+            if (time.time() >= next_scan):
+                for test_status_filepath in pending:
+                    if (_get_file_signature(test_status_filepath) != signatures.get(test_status_filepath)):
+                        to_check.add(test_status_filepath)
+                next_scan = time.time() + scan_interval
+
+    finally:
+        if (watcher is not None):
+            watcher.close()
 
     test_results = {}
     completed_test_paths = []
-    while (not results.empty()):
-        test_name, test_path, test_status = results.get()
+    for test_name, test_path, test_status in results:
         if (test_name in test_results):
             prior_path, prior_status = test_results[test_name]
             if (test_status == prior_status):
@@ -911,6 +911,37 @@ class O_TestTestScheduler(TestCreateTestCommon):
             self.assertEqual(ts.get_status(CIME.test_scheduler.SUBMIT_PHASE),         TEST_PASS_STATUS)
             self.assertEqual(ts.get_status(CIME.test_scheduler.RUN_PHASE),         TEST_PASS_STATUS)
 
+    ###########################################################################
+    def test_d_sharedlib_configs(self):
+    ###########################################################################
+        # Two tests share the non-debug libraries, the debug test needs its own
+        tests = update_acme_tests.get_full_test_names(["TESTRUNPASS_P1.f19_g16_rx1.A",
+                                                       "TESTRUNPASS_P2.f19_g16_rx1.A",
+                                                       "TESTRUNPASS_D_P1.f19_g16_rx1.A"],
+                                                      self._machine, self._compiler)
+        test_id="%s-%s" % (self._baseline_name, CIME.utils.get_timestamp())
+        ct = TestScheduler(tests, test_id=test_id, no_batch=NO_BATCH, no_run=True,test_root=TEST_ROOT,output_root=TEST_ROOT)
+
+        log_lvl = logging.getLogger().getEffectiveLevel()
+        logging.disable(logging.CRITICAL)
+        try:
+            ct.run_tests()
+        finally:
+            logging.getLogger().setLevel(log_lvl)
+
+        test_statuses = glob.glob("%s/*%s/TestStatus" % (self._testroot, test_id))
+        self.assertEqual(len(tests), len(test_statuses))
+        for test_status in test_statuses:
+            ts = TestStatus(test_dir=os.path.dirname(test_status))
+            self.assertEqual(ts.get_status(CIME.test_scheduler.SHAREDLIB_BUILD_PHASE), TEST_PASS_STATUS, msg=ts.get_name())
+            self.assertEqual(ts.get_status(CIME.test_scheduler.MODEL_BUILD_PHASE), TEST_PASS_STATUS, msg=ts.get_name())
+
+        sharedlib_dirs = set([sharedlib_dir for sharedlib_dir, _ in ct._sharedlib_dirs.values()])
+        self.assertEqual(len(sharedlib_dirs), 2, msg="Expected separate debug and non-debug libraries, got %s" % sharedlib_dirs)
+        self.assertEqual(ct._sharedlib_dirs_built, sharedlib_dirs)
+        for sharedlib_dir in sharedlib_dirs:
+            self.assertTrue(os.path.isdir(sharedlib_dir), msg="Missing shared libraries %s" % sharedlib_dir)
+
 ###############################################################################
 class P_TestJenkinsGenericJob(TestCreateTestCommon):
 ###############################################################################
@@ -1468,6 +1499,33 @@ class K_TestCimeCase(TestCreateTestCommon):
         result = run_cmd_assert_result(self, "./xmlquery --value PIO_CONFIG_OPTS", from_dir=casedir)
         self.assertEqual(result, "-opt1 -opt2")
 
+    ###########################################################################
+    def test_cime_case_value_cache(self):
+    ###########################################################################
+        run_cmd_assert_result(self, "%s/create_test TESTRUNPASS_P1.f19_g16_rx1.A -t %s --no-build --test-root %s --output-root %s"
+                              % (SCRIPT_DIR, self._baseline_name, self._testroot, self._testroot))
+
+        casedir = os.path.join(self._testroot,
+                               "%s.%s" % (CIME.utils.get_full_test_name("TESTRUNPASS_P1.f19_g16_rx1.A", machine=self._machine, compiler=self._compiler), self._baseline_name))
+        self.assertTrue(os.path.isdir(casedir), msg="Missing casedir '%s'" % casedir)
+
+        with Case(casedir, read_only=False) as case:
+            # A negative NTASKS is a node count, it depends on PES_PER_NODE
+            # without referencing it
+            case.set_value("NTASKS_ATM", -1)
+            pes_per_node = case.get_value("PES_PER_NODE")
+            self.assertEqual(case.get_value("NTASKS_ATM"), pes_per_node)
+
+            case.set_value("PES_PER_NODE", pes_per_node + 1)
+            self.assertEqual(case.get_value("NTASKS_ATM"), pes_per_node + 1)
+
+            # A value that references the changed variable
+            rundir = case.get_value("RUNDIR")
+            case.set_value("CIME_OUTPUT_ROOT", os.path.join(self._testroot, "other_output_root"))
+            self.assertEqual(case.get_value("RUNDIR"),
+                             os.path.join(self._testroot, "other_output_root", case.get_value("CASE"), "run"))
+            self.assertNotEqual(case.get_value("RUNDIR"), rundir)
+
     ###########################################################################
     def test_cime_case_test_walltime_mgmt_1(self):
     ###########################################################################
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+import sys, getopt, time
+import numpy as np
+import pyEnsLib
+
+#This routine compares the batched global mean calculation with the
+#per level calculation on synthetic CAM SE, CAM FV and OCN grids
+
+def usage():
+    print '\n Benchmarks the global mean calculation of pyCECT on synthetic grids. \n'
+    print '  ------------------------'
+    print '   Args for bench_global_mean : '
+    print '  ------------------------'
+    print '   bench_global_mean.py'
+    print '   -h                   : prints out this usage message'
+    print '   --nvars <num>        : Number of 3d variables per file (default = 20)'
+    print '   --nfiles <num>       : Number of files (default = 3)'
+    print '   --grids <names>      : Comma separated list of se, fv and pop (default = se,fv,pop)'
+    print '   '
+
+#
+# Global means of one 3d variable as calculated before batched_area_avg,
+# one level at a time
+#
+def per_level_global_mean(data, area_wgt, is_SE, FillValue=None, z_wgt=None):
+    nlev = data.shape[0]
+    gm_lev = np.zeros(nlev)
+    for k in range(nlev):
+        if FillValue is None:
+            gm_lev[k] = pyEnsLib.area_avg(data[k], area_wgt, is_SE)
+        else:
+            gm_lev[k] = pyEnsLib.pop_area_avg(np.ma.masked_values(data[k], FillValue), area_wgt)
+    if z_wgt is None:
+        return np.mean(gm_lev)
+    return np.average(gm_lev, weights=z_wgt)
+
+def batched_global_mean(data, area_wgt, is_SE, FillValue=None, z_wgt=None):
+    gm_lev = pyEnsLib.batched_area_avg(data, area_wgt, is_SE, FillValue)
+    if z_wgt is None:
+        return np.mean(gm_lev)
+    return np.average(gm_lev, weights=z_wgt)
+
+#
+# Synthetic fields and weights: (shape of one 3d variable, area_wgt, is_SE, FillValue, z_wgt)
+#
+def make_grid(name):
+    rng = np.random.RandomState(0)
+    if name == 'se':
+        ncol = 48602
+        area_wgt = rng.uniform(0.5, 1.5, ncol)
+        return (30, ncol), area_wgt / np.sum(area_wgt), True, None, None
+    elif name == 'fv':
+        nlat, nlon = 192, 288
+        lat = np.linspace(-np.pi / 2, np.pi / 2, nlat)
+        return (30, nlat, nlon), np.cos(lat), False, None, None
+    elif name == 'pop':
+        nlat, nlon = 384, 320
+        return (60, nlat, nlon), rng.uniform(1.0e12, 4.0e12, (nlat, nlon)), False, 9.96921e+36, rng.uniform(1.0, 250.0, 60)
+    print 'ERROR: unknown grid ' + name
+    sys.exit(2)
+
+def make_field(shape, FillValue, seed):
+    rng = np.random.RandomState(seed)
+    field = (rng.randn(*shape) * 10.0 + 280.0).astype(np.float32)
+    if FillValue is not None:
+        #land points, and fewer valid points at depth
+        for k in range(shape[0]):
+            field[k, :, :shape[2] * (k + 10) // (shape[0] + 20)] = FillValue
+    return field
+
+def main(argv):
+    nvars = 20
+    nfiles = 3
+    grids = ['se', 'fv', 'pop']
+    try:
+        opts, args = getopt.getopt(argv, "h", ["nvars=", "nfiles=", "grids="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt == '--nvars':
+            nvars = int(arg)
+        elif opt == '--nfiles':
+            nfiles = int(arg)
+        elif opt == '--grids':
+            grids = arg.split(',')
+
+    for name in grids:
+        shape, area_wgt, is_SE, FillValue, z_wgt = make_grid(name)
+        fields = [make_field(shape, FillValue, seed) for seed in range(nvars)]
+
+        timings = []
+        results = []
+        for method in (per_level_global_mean, batched_global_mean):
+            start = time.time()
+            for fcount in range(nfiles):
+                gm = [method(field, area_wgt, is_SE, FillValue, z_wgt) for field in fields]
+            timings.append(time.time() - start)
+            results.append(np.array(gm))
+
+        maxdiff = np.max(np.abs(results[0] - results[1]) / np.abs(results[0]))
+        print '%-4s %-16s per level %8.3fs  batched %8.3fs  speedup %6.1fx  max rel diff %.2e' % \
+            (name, 'x'.join([str(n) for n in shape]), timings[0], timings[1], timings[0] / timings[1], maxdiff)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
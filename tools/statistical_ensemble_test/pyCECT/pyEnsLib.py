@@ -10,6 +10,11 @@ import random
 import asaptools.simplecomm as simplecomm 
 import fnmatch
 import glob
+import atexit
+import multiprocessing
+import tempfile
+import signal
+import Queue
 
 #
 # Parse header file of a netcdf to get the varaible 3d/2d/1d list
@@ -31,6 +36,8 @@ def calc_rmsz(o_files,var_name3d,var_name2d,is_SE,opts_dict):
        cumul=opts_dict['cumul']
     else:
        cumul=False
+    if 'mem_budget' in opts_dict and opts_dict['mem_budget'] > 0 and not popens:
+       return calc_rmsz_streaming(o_files,var_name3d,var_name2d,is_SE,opts_dict)
     input_dims = o_files[0].dimensions
     if popens:
        nbin = opts_dict['nbin']
@@ -178,6 +185,136 @@ def calc_rmsz(o_files,var_name3d,var_name2d,is_SE,opts_dict):
      
     return Zscore3d,Zscore2d,ens_avg3d,ens_stddev3d,ens_avg2d,ens_stddev2d,gm3d,gm2d
 
+#
+# Number of ensemble members converted to float64 at the same time by the
+# streaming RMSZ calculation
+#
+STREAM_MEMBER_CHUNK=8
+
+#
+# Update the count, mean and sum of squared deviations (m2) of an ensemble
+# with a chunk of members (Welford's algorithm, merging the statistics of the
+# whole chunk at once)
+#
+def welford_update(count,mean,m2,chunk):
+  n_chunk=chunk.shape[0]
+  chunk=chunk.astype(np.float64)
+  mean_chunk=np.mean(chunk,axis=0)
+  m2_chunk=np.sum(np.square(chunk-mean_chunk),axis=0)
+  if count == 0:
+    return n_chunk,mean_chunk,m2_chunk
+  total=count+n_chunk
+  delta=mean_chunk-mean
+  mean=mean+delta*(float(n_chunk)/total)
+  m2=m2+m2_chunk+np.square(delta)*(float(count)*n_chunk/total)
+  return total,mean,m2
+
+#
+# Calculate the ensemble mean and stddev of one variable, and for each member
+# the sum of the squared Z-scores against the ensemble without that member and
+# the number of points without variance in that ensemble. The field is read in
+# blocks of levels (or rows for 2d variables) sized so that the members of a
+# block fit in mem_budget bytes.
+#
+def stream_field_rmsz(o_files,vname,tslice,mem_budget,threshold):
+  nfiles=len(o_files)
+  field_shape=o_files[0].variables[vname].shape[1:]
+  nrow=field_shape[0]
+  row_points=int(np.prod(field_shape[1:]))
+  # float32 members plus the float64 temporaries of one member chunk
+  row_bytes=row_points*(4*nfiles+8*(4+4*STREAM_MEMBER_CHUNK))
+  block_rows=max(1,min(nrow,int(mem_budget//row_bytes)))
+
+  ens_avg=np.zeros(field_shape,dtype=np.float32)
+  ens_stddev=np.zeros(field_shape,dtype=np.float32)
+  zsum=np.zeros(nfiles,dtype=np.float64)
+  novar=np.zeros(nfiles,dtype=np.int64)
+  # the mean of the ensemble without member i is mean-(x_i-mean)/(nfiles-1)
+  scale=float(nfiles)/(nfiles-1)
+
+  for start in range(0,nrow,block_rows):
+    end=min(start+block_rows,nrow)
+    block=np.empty((nfiles,end-start)+field_shape[1:],dtype=np.float32)
+    for fcount,this_file in enumerate(o_files):
+      block[fcount]=this_file.variables[vname][tslice,start:end]
+
+    count,mean,m2=0,None,None
+    for first in range(0,nfiles,STREAM_MEMBER_CHUNK):
+      count,mean,m2=welford_update(count,mean,m2,block[first:first+STREAM_MEMBER_CHUNK])
+    ens_avg[start:end]=mean
+    ens_stddev[start:end]=np.sqrt(m2/nfiles)
+
+    for first in range(0,nfiles,STREAM_MEMBER_CHUNK):
+      last=min(first+STREAM_MEMBER_CHUNK,nfiles)
+      dev=block[first:last].astype(np.float64)-mean
+      stddev_loo=np.sqrt(np.maximum(m2-scale*np.square(dev),0.)/(nfiles-1))
+      valid=stddev_loo>threshold
+      zscore=np.where(valid,scale*dev/np.where(valid,stddev_loo,1.),0.)
+      zsum[first:last]+=np.sum(np.square(zscore).reshape(last-first,-1),axis=1)
+      novar[first:last]+=np.sum((~valid).reshape(last-first,-1),axis=1)
+
+  return ens_avg,ens_stddev,zsum,novar
+
+#
+# Same results as calc_rmsz for cam ensembles, without holding every member's
+# full field in memory. Selected with mem_budget (in MB).
+#
+def calc_rmsz_streaming(o_files,var_name3d,var_name2d,is_SE,opts_dict):
+    threshold=1e-12
+    tslice = opts_dict['tslice']
+    mem_budget = opts_dict['mem_budget']*1024*1024
+    if 'cumul' in opts_dict:
+       cumul=opts_dict['cumul']
+    else:
+       cumul=False
+    # the Z-scores of a member are taken against the ensemble without it
+    if len(o_files) < 2:
+      print 'ERROR: the RMSZ scores need an ensemble of at least 2 members, got '+str(len(o_files))
+      sys.exit(2)
+    input_dims = o_files[0].dimensions
+    nlev=input_dims["lev"]
+    if (is_SE == True):
+      shape2d=(input_dims["ncol"],)
+    elif 'nlon' in input_dims:
+      shape2d=(input_dims["nlat"],input_dims["nlon"])
+    else:
+      shape2d=(input_dims["lat"],input_dims["lon"])
+    npts2d=int(np.prod(shape2d))
+    npts3d=nlev*npts2d
+
+    ens_avg3d=np.zeros((len(var_name3d),nlev)+shape2d,dtype=np.float32)
+    ens_stddev3d=np.zeros((len(var_name3d),nlev)+shape2d,dtype=np.float32)
+    ens_avg2d=np.zeros((len(var_name2d),)+shape2d,dtype=np.float32)
+    ens_stddev2d=np.zeros((len(var_name2d),)+shape2d,dtype=np.float32)
+    Zscore3d = np.zeros((len(var_name3d),len(o_files)),dtype=np.float32)
+    Zscore2d = np.zeros((len(var_name2d),len(o_files)),dtype=np.float32)
+    gm3d=[]
+    gm2d=[]
+
+    if cumul:
+      temp1,temp2,area_wgt,z_wgt=get_area_wgt(o_files,is_SE,input_dims,nlev,False)
+      gm3d = np.zeros((len(var_name3d)),dtype=np.float32)
+      gm2d = np.zeros((len(var_name2d)),dtype=np.float32)
+
+    for var_names,npts,ens_avg,ens_stddev,Zscore in ((var_name3d,npts3d,ens_avg3d,ens_stddev3d,Zscore3d),
+                                                     (var_name2d,npts2d,ens_avg2d,ens_stddev2d,Zscore2d)):
+      for vcount,vname in enumerate(var_names):
+        ens_avg[vcount],ens_stddev[vcount],zsum,novar=stream_field_rmsz(o_files,vname,tslice,mem_budget,threshold)
+        if cumul:
+          if Zscore is Zscore3d:
+            gm3d[vcount],temp3=calc_global_mean_for_onefile(o_files[-1],area_wgt,[vname],[],ens_avg3d[vcount],temp2,tslice,is_SE,nlev,opts_dict)
+          else:
+            temp3,gm2d[vcount]=calc_global_mean_for_onefile(o_files[-1],area_wgt,[],[vname],temp1,ens_avg2d[vcount],tslice,is_SE,nlev,opts_dict)
+          continue
+
+        for fcount in range(len(o_files)):
+          if (novar[fcount] < npts):
+            Zscore[vcount,fcount]=np.sqrt(zsum[fcount]/(npts-novar[fcount]))
+          else:
+            print "WARNING: no variance in "+vname
+
+    return Zscore3d,Zscore2d,ens_avg3d,ens_stddev3d,ens_avg2d,ens_stddev2d,gm3d,gm2d
+
 #
 # Calculate pop zscore pass rate (ZPR) or pop zpdf values
 #
@@ -390,6 +527,37 @@ def pop_area_avg(data, weight):
     a = np.ma.average(data, weights=weight)
     return a
 
+#
+# Calculate weighted global means of data over its horizontal dimensions for
+# all levels (and variables) at once, as one weighted reduction. The
+# horizontal dimensions are the trailing ones: ncol for CAM SE, lat x lon for
+# CAM FV (weight per latitude) and nlat x nlon for OCN (weight per point).
+# Points equal to FillValue are left out like np.ma.masked_values does, levels
+# without valid points get 0.
+#
+def batched_area_avg(data, weight, is_SE, FillValue=None):
+    data = np.asarray(data)
+    weight = np.asarray(weight, dtype=np.float64)
+    if is_SE or weight.ndim == 2:
+        hdims = weight.ndim
+        wflat = weight.ravel()
+    else:
+        #FV weights are for lat
+        hdims = 2
+        wflat = np.repeat(weight, data.shape[-1])
+
+    flat = data.reshape(-1, wflat.size).astype(np.float64)
+    if FillValue is None:
+        avg = np.dot(flat, wflat) / np.sum(wflat)
+    else:
+        #same tolerance as np.ma.masked_values
+        masked = np.abs(flat - FillValue) <= 1.0e-8 + 1.0e-5 * abs(FillValue)
+        flat[masked] = 0.
+        wsum = np.sum(wflat) - np.dot(masked, wflat)
+        total = np.dot(flat, wflat)
+        avg = np.where(wsum > 0, total / np.where(wsum > 0, wsum, 1.), 0.)
+    return avg.reshape(data.shape[:data.ndim-hdims])
+
 def get_lev(file_dim_dict,lev_name):
     return file_dim_dict[lev_name]
    
@@ -436,7 +604,7 @@ def get_area_wgt(o_files,is_SE,input_dims,nlev,popens):
         output3d = np.zeros((nlev, nlat, nlon))
         output2d = np.zeros((nlat, nlon))
         #area_wgt = np.zeros(nlat) #note gaues weights are length nlat
-        area_wgt = gw
+        area_wgt = gw[:]
 
     return output3d,output2d,area_wgt,z_wgt
 #
@@ -489,28 +657,19 @@ def calc_global_mean_for_onefile_pop(fname, area_wgt,z_wgt,var_name3d, var_name2
     gm3d = np.zeros((n3d),dtype=np.float32)
     gm2d = np.zeros((n2d),dtype=np.float32)
 
-    #calculate global mean for each 3D variable 
+    #calculate global mean for each 3D variable, all levels at once
     for count, vname in enumerate(var_name3d):
-	#if (verbose == True):
-	#    print "calculating GM for variable ", vname
-	gm_lev = np.zeros(nlev)
-	data = fname.variables[vname]
-	output3d[:,:,:] = data[tslice,:,:,:] 
-	for k in range(nlev):
-            moutput3d=np.ma.masked_values(output3d[k,:,:],data._FillValue)
-	    gm_lev[k] = pop_area_avg(moutput3d, area_wgt)
-	#note: averaging over levels should probably be pressure-weighted(TO DO)        
-	gm3d[count] = np.average(gm_lev,weights=z_wgt)         
-	
+        data = fname.variables[vname]
+        output3d[...] = data[tslice]
+        gm_lev = batched_area_avg(output3d, area_wgt, is_SE, data._FillValue)
+        #note: averaging over levels should probably be pressure-weighted(TO DO)        
+        gm3d[count] = np.average(gm_lev,weights=z_wgt)         
+
     #calculate global mean for each 2D variable 
     for count, vname in enumerate(var_name2d):
-	#if (verbose == True):
-	#    print "calculating GM for variable ", vname
-	data = fname.variables[vname]
-	output2d[:,:] = data[tslice,:,:] 
-        moutput2d=np.ma.masked_values(output2d[:,:],data._FillValue)
-	gm2d_mean = pop_area_avg(moutput2d, area_wgt)
-	gm2d[count]=gm2d_mean
+        data = fname.variables[vname]
+        output2d[...] = data[tslice]
+        gm2d[count] = batched_area_avg(output2d, area_wgt, is_SE, data._FillValue)
     return gm3d,gm2d        
 
 #
@@ -528,46 +687,30 @@ def calc_global_mean_for_onefile(fname, area_wgt,var_name3d, var_name2d,output3d
     gm3d = np.zeros((n3d),dtype=np.float32)
     gm2d = np.zeros((n2d),dtype=np.float32)
 
-    #calculate global mean for each 3D variable 
+    #calculate global mean for each 3D variable, all levels at once
     for count, vname in enumerate(var_name3d):
-	#if (verbose == True):
-	#    print "calculating GM for variable ", vname
-	gm_lev = np.zeros(nlev)
         if vname not in fname.variables:
            print 'Error: the testing file does not have the variable '+vname+' that in the ensemble summary file'
            continue
-	data = fname.variables[vname]
-	if (is_SE == True):
-            if not cumul: 
-	        output3d[:,:] = data[tslice,:,:] 
-	    for k in range(nlev):
-		gm_lev[k] = area_avg(output3d[k,:], area_wgt, is_SE)
-	else:
-            if not cumul:
-	        output3d[:,:,:] = data[tslice,:,:,:] 
-	    for k in range(nlev):
-		gm_lev[k] = area_avg(output3d[k,:,:], area_wgt, is_SE)
-	#note: averaging over levels should probably be pressure-weighted(TO DO)        
-	gm3d[count] = np.mean(gm_lev)         
-
-	
-    #calculate global mean for each 2D variable 
+        if not cumul:
+            output3d[...] = fname.variables[vname][tslice]
+        #note: averaging over levels should probably be pressure-weighted(TO DO)        
+        gm3d[count] = np.mean(batched_area_avg(output3d, area_wgt, is_SE))
+
+    #calculate global mean for all 2D variables at once
+    present2d = []
+    values2d = []
     for count, vname in enumerate(var_name2d):
-	#if (verbose == True):
-	#    print "calculating GM for variable ", vname
         if vname not in fname.variables:
            print 'Error: the testing file does not have the variable '+vname+' that in the ensemble summary file'
            continue
-	data = fname.variables[vname]
-	if (is_SE == True):
-            if not cumul:
-	        output2d[:] = data[tslice,:] 
-	    gm2d_mean = area_avg(output2d[:], area_wgt, is_SE)
-	else:
-            if not cumul:
-	        output2d[:,:] = data[tslice,:,:] 
-	    gm2d_mean = area_avg(output2d[:,:], area_wgt, is_SE)
-	gm2d[count]=gm2d_mean
+        present2d.append(count)
+        if cumul:
+            values2d.append(output2d)
+        else:
+            values2d.append(fname.variables[vname][tslice])
+    if present2d:
+        gm2d[present2d] = batched_area_avg(np.array(values2d), area_wgt, is_SE)
 
     return gm3d,gm2d        
 
@@ -1055,8 +1198,11 @@ def EnsSum_usage():
     print '   --mach <num>         : Machine name used in the metadata, (default = yellowstone)'
     print '   --jsonfile <fname>   : Jsonfile to provide that a list of variables that will be excluded  (no default)'
     print '   --mpi_enable         : Enable mpi mode if True'
+    print '   --nproc <num>        : Without mpi, run on num local processes (default = 1)'
     print '   --maxnorm            : Enable to generate max norm ensemble files'
     print '   --gmonly             : Only generate global_mean and PCA loadings (omit RMSZ information)'
+    print '   --mem_budget <MB>    : Compute the RMSZ information in level blocks using about this much memory'
+    print '                          per variable instead of reading all ensemble members at once (default = 0, disabled)'
     print '   '
     print 'Version 1.5.0'
 
@@ -1084,6 +1230,7 @@ def EnsSumPop_usage():
     print '   --mach <num>         : Machine name used in the metadata, (default = yellowstone)'
     print '   --jsonfile <fname>   : Jsonfile to provide that a list of variables that will be included  (no default)'
     print '   --mpi_enable         : Enable mpi mode if True'
+    print '   --nproc <num>        : Without mpi, run on num local processes (default = 1)'
     print '   --zscoreonly         : Only generate zscore, omit global_mean'
     print '   '
     print 'Version 1.0.0'
@@ -1167,6 +1314,174 @@ def get_shape(shape_tuple,shape1,rank):
     shape_tuple=tuple(lst)
     return shape_tuple
  
+#
+# Directory for the shared memory files that carry arrays between ForkComm ranks
+#
+FORKCOMM_SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+#
+# Seconds between the checks for dead ranks while a ForkComm rank waits
+#
+FORKCOMM_POLL_SEC = 5
+
+#
+# Stand-in for the asaptools simplecomm communicator that runs the ranks as
+# forked local processes instead of MPI processes, so that the summary tools
+# can use several cores without MPI. Like under mpirun, every rank continues
+# from the point where the communicator is created. partition, collect and
+# sync have the semantics of the simplecomm ones: partitioned data is sent
+# from rank 0 through queues, arrays collected on rank 0 are passed in shared
+# memory files. Ranks that wait check that the other ranks are still alive,
+# like mpirun the run is aborted if one of them died.
+#
+class ForkComm(object):
+
+    def __init__(self, size):
+        self._size = size
+        self._rank = 0
+        self._manager_pid = os.getpid()
+        self._to_worker = [multiprocessing.Queue() for rank in range(size)]
+        self._to_manager = multiprocessing.Queue()
+        self._barrier = multiprocessing.Condition()
+        self._barrier_count = multiprocessing.Value('i', 0, lock=False)
+        self._barrier_generation = multiprocessing.Value('i', 0, lock=False)
+        self._workers = []
+        self._exited = {}
+        for rank in range(1, size):
+            pid = os.fork()
+            if pid == 0:
+                self._rank = rank
+                self._workers = []
+                break
+            self._workers.append(pid)
+        if self._rank == 0:
+            atexit.register(self._wait_workers)
+
+    def _shm_prefix(self):
+        return 'pyEnsComm.%d.' % self._manager_pid
+
+    def _remove_shm_files(self):
+        shm_dir = tempfile.gettempdir() if FORKCOMM_SHM_DIR is None else FORKCOMM_SHM_DIR
+        for path in glob.glob(os.path.join(shm_dir, self._shm_prefix() + '*')):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _wait_workers(self):
+        for pid in self._workers:
+            if pid not in self._exited:
+                self._exited[pid] = os.waitpid(pid, 0)[1]
+        self._remove_shm_files()
+
+    def _abort(self, msg):
+        print 'ERROR: ' + msg
+        sys.stdout.flush()
+        if self._rank != 0:
+            os._exit(2)
+        for pid in self._workers:
+            if pid not in self._exited:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+        # The atexit handler reaps the workers and removes their shared memory files
+        sys.exit(2)
+
+    def _check_ranks(self):
+        # Workers only exit normally after the last sync, so a worker that
+        # exited while another rank waits for it has failed, even with status 0
+        if self._rank != 0:
+            if os.getppid() != self._manager_pid:
+                self._abort('rank 0 died, aborting rank ' + str(self._rank))
+            return
+        for rank, pid in enumerate(self._workers, 1):
+            if pid not in self._exited:
+                exited_pid, status = os.waitpid(pid, os.WNOHANG)
+                if exited_pid == 0:
+                    continue
+                self._exited[pid] = status
+            self._abort('rank ' + str(rank) + ' exited with status ' + str(self._exited[pid]) + ', aborting')
+
+    def _get(self, queue):
+        while True:
+            try:
+                return queue.get(timeout=FORKCOMM_POLL_SEC)
+            except Queue.Empty:
+                self._check_ranks()
+
+    def get_rank(self):
+        return self._rank
+
+    def get_size(self):
+        return self._size
+
+    def is_manager(self):
+        return self._rank == 0
+
+    def partition(self, data=None, func=None, involved=False, tag=0):
+        if func is None:
+            func = lambda data, index, size: data[index::size]
+        if self._rank != 0:
+            return self._get(self._to_worker[self._rank])
+        offset = 0 if involved else 1
+        for rank in range(1, self._size):
+            self._to_worker[rank].put(func(data, rank - offset, self._size - offset))
+        if involved:
+            return func(data, 0, self._size)
+        return None
+
+    def collect(self, data=None, tag=0):
+        if self._rank != 0:
+            if isinstance(data, np.ndarray):
+                fd, path = tempfile.mkstemp(prefix=self._shm_prefix(), dir=FORKCOMM_SHM_DIR)
+                os.close(fd)
+                np.ascontiguousarray(data).tofile(path)
+                self._to_manager.put((self._rank, (path, data.dtype.str, data.shape), True))
+            else:
+                self._to_manager.put((self._rank, data, False))
+            return None
+        rank, data, in_shm = self._get(self._to_manager)
+        if in_shm:
+            path, dtype, shape = data
+            data = np.fromfile(path, dtype=np.dtype(dtype)).reshape(shape)
+            os.remove(path)
+        return rank, data
+
+    def sync(self):
+        with self._barrier:
+            generation = self._barrier_generation.value
+            self._barrier_count.value += 1
+            if self._barrier_count.value == self._size:
+                self._barrier_count.value = 0
+                self._barrier_generation.value += 1
+                self._barrier.notify_all()
+                return
+        while True:
+            with self._barrier:
+                if self._barrier_generation.value == generation:
+                    self._barrier.wait(FORKCOMM_POLL_SEC)
+                if self._barrier_generation.value != generation:
+                    return
+            # Not holding the lock, the other ranks must not block on an aborted rank
+            self._check_ranks()
+
+#
+# Create the communicator selected by the mpi_enable and nproc options
+#
+def create_comm(opts_dict):
+    if opts_dict['mpi_enable']:
+        return simplecomm.create_comm()
+    if 'nproc' in opts_dict and opts_dict['nproc'] > 1:
+        return ForkComm(opts_dict['nproc'])
+    return simplecomm.create_comm(serial=True)
+
+#
+# True if the ranks of the communicator have to exchange their results
+#
+def is_parallel(opts_dict):
+    return opts_dict['mpi_enable'] or ('nproc' in opts_dict and opts_dict['nproc'] > 1)
+
 #
 # Get the mpi partition list for each processor
 #
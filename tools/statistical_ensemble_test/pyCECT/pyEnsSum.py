@@ -6,7 +6,6 @@ import Nio
 import time
 import re
 from asaptools.partition import EqualStride, Duplicate,EqualLength
-import asaptools.simplecomm as simplecomm 
 import pyEnsLib
 
 #This routine creates a summary file from an ensemble of CAM
@@ -17,7 +16,7 @@ def main(argv):
     print 'Running pyEnsSum!'
 
     # Get command line stuff and store in a dictionary
-    s = 'tag= compset= esize= tslice= res= sumfile= indir= sumfiledir= mach= verbose jsonfile= mpi_enable maxnorm gmonly popens cumul regx= startMon= endMon= fIndex='
+    s = 'tag= compset= esize= tslice= res= sumfile= indir= sumfiledir= mach= verbose jsonfile= mpi_enable maxnorm gmonly popens cumul regx= startMon= endMon= fIndex= mem_budget= nproc='
     optkeys = s.split()
     try: 
         opts, args = getopt.getopt(argv, "h", optkeys)
@@ -49,6 +48,8 @@ def main(argv):
     opts_dict['startMon'] = 1
     opts_dict['endMon'] = 1
     opts_dict['fIndex'] = 151
+    opts_dict['mem_budget'] = 0
+    opts_dict['nproc'] = 1
 
     # This creates the dictionary of input arguments 
     opts_dict = pyEnsLib.getopt_parseconfig(opts,optkeys,'ES',opts_dict)
@@ -71,11 +72,8 @@ def main(argv):
     # The var list that will be excluded
     ex_varlist=[]
 
-    # Create a mpi simplecomm object
-    if opts_dict['mpi_enable']:
-        me=simplecomm.create_comm()
-    else:
-        me=simplecomm.create_comm(not opts_dict['mpi_enable'])
+    # Create a mpi simplecomm object, or local processes with nproc
+    me=pyEnsLib.create_comm(opts_dict)
 
 
     if me.get_rank() == 0:
@@ -84,7 +82,7 @@ def main(argv):
 	    ex_varlist=pyEnsLib.read_jsonlist(opts_dict['jsonfile'],'ES')
 
     # Broadcast the excluded var list to each processor
-    if opts_dict['mpi_enable']:
+    if pyEnsLib.is_parallel(opts_dict):
 	ex_varlist=me.partition(ex_varlist,func=Duplicate(),involved=True)
         
     in_files=[]
@@ -392,7 +390,7 @@ def main(argv):
 	pyEnsLib.calculate_maxnormens(opts_dict,var3_list_loc)
 	pyEnsLib.calculate_maxnormens(opts_dict,var2_list_loc)
 
-    if opts_dict['mpi_enable'] & ( not opts_dict['popens']):
+    if pyEnsLib.is_parallel(opts_dict) & ( not opts_dict['popens']):
 
         if not opts_dict['cumul']:
 	    # Gather the 3d variable results from all processors to the master processor
@@ -6,14 +6,13 @@ import Nio
 import time
 import re
 from asaptools.partition import EqualStride, Duplicate
-import asaptools.simplecomm as simplecomm 
 import pyEnsLib
 
 def main(argv):
     print 'Running pyEnsSumPop!'
 
     # Get command line stuff and store in a dictionary
-    s = 'nyear= nmonth= npert= tag= res= mach= compset= sumfile= indir= tslice= verbose jsonfile= mpi_enable zscoreonly nrand= rand seq= jsondir='
+    s = 'nyear= nmonth= npert= tag= res= mach= compset= sumfile= indir= tslice= verbose jsonfile= mpi_enable zscoreonly nrand= rand seq= jsondir= nproc='
     optkeys = s.split()
     try: 
         opts, args = getopt.getopt(argv, "h", optkeys)
@@ -41,6 +40,7 @@ def main(argv):
     opts_dict['jsonfile'] = ''
     opts_dict['verbose'] = True
     opts_dict['mpi_enable'] = False
+    opts_dict['nproc'] = 1
     opts_dict['zscoreonly'] = False
     opts_dict['popens'] = True
     opts_dict['nrand'] = 40 
@@ -61,11 +61,8 @@ def main(argv):
     # Now find file names in indir
     input_dir = opts_dict['indir']
 
-    # Create a mpi simplecomm object
-    if opts_dict['mpi_enable']:
-        me=simplecomm.create_comm()
-    else:
-        me=simplecomm.create_comm(not opts_dict['mpi_enable'])
+    # Create a mpi simplecomm object, or local processes with nproc
+    me=pyEnsLib.create_comm(opts_dict)
     if opts_dict['jsonfile']:
         # Read in the included var list
         Var2d,Var3d=pyEnsLib.read_jsonlist(opts_dict['jsonfile'],'ESP')
@@ -93,11 +90,6 @@ def main(argv):
         print 'Input directory: ',input_dir,' not found'
         sys.exit(2)
 
-    # Create a mpi simplecomm object
-    if opts_dict['mpi_enable']:
-        me=simplecomm.create_comm()
-    else:
-        me=simplecomm.create_comm(not opts_dict['mpi_enable'])
     #Partition the input file list 
     in_file_list=me.partition(in_files,func=EqualStride(),involved=True)
 
@@ -272,7 +264,7 @@ def main(argv):
     zscore3d,zscore2d,ens_avg3d,ens_stddev3d,ens_avg2d,ens_stddev2d,temp1,temp2=pyEnsLib.calc_rmsz(o_files,Var3d,Var2d,is_SE,opts_dict)    
 
     # Collect from all processors
-    if opts_dict['mpi_enable'] :
+    if pyEnsLib.is_parallel(opts_dict) :
 	# Gather the 3d variable results from all processors to the master processor
 	# Gather global means 3d results
         if not opts_dict['zscoreonly']: